@@ -1,29 +1,123 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
-import base64
 import numpy as np
 import cv2
-import io
-from PIL import Image
 import os
-import pymysql
 import json
 import hashlib
+import logging
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from datetime import datetime, timedelta
 import jwt
 
 from face_recognition_service import FaceRecognitionService
+from face_gallery import FaceGallery
+from gallery_sync import GallerySync
+from image_decode import decode_image, ImageDecodeError
+import bulk_enroll
+import enrollment_guard
+import metrics
 from database_config import db_manager
 
 app = Flask(__name__)
 CORS(app)
 
+# 日志中带上请求的 trace id
+metrics.install_trace_logging()
+logger = logging.getLogger(__name__)
+
 # JWT配置
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 JWT_EXPIRATION_HOURS = 24
 
-# 初始化人脸识别服务
-face_service = FaceRecognitionService()
+# 人脸底库检索索引类型: exact(暴力检索) / float16 / int8 (压缩矩阵粗排 + float32 精排) /
+# hnsw / ivfpq (后两者需要 faiss-cpu), 底库规模的切换点可用 benchmark_gallery_index.py 评估
+GALLERY_INDEX_TYPE = os.environ.get('FACE_GALLERY_INDEX', 'exact')
+
+# 推理后端: keras / onnx (需先运行 export_onnx.py 导出模型)
+# FACE_FACENET_INT8=1 时 onnx 后端的 facenet 使用 int8 动态量化模型
+INFERENCE_BACKEND = os.environ.get('FACE_BACKEND', 'keras')
+FACENET_INT8 = os.environ.get('FACE_FACENET_INT8') == '1'
+
+# 底库增量同步: 每隔 FACE_SYNC_INTERVAL 秒轮询一次变更日志 (0 为关闭),
+# 每隔 FACE_RECONCILE_INTERVAL 秒全量对账一次 (变更日志由 setup_face_change_log.py 创建)
+GALLERY_SYNC_INTERVAL = float(os.environ.get('FACE_SYNC_INTERVAL', 2))
+GALLERY_RECONCILE_INTERVAL = float(os.environ.get('FACE_RECONCILE_INTERVAL', 600))
+
+# 预加载的多进程部署 (wsgi.py) 使用 keras 后端时, 主进程不加载 tensorflow,
+# 模型在每个子进程 fork 之后由 warm_up 加载 (FACE_DEFER_MODELS=1 由 wsgi.py 设置)
+DEFER_MODELS = os.environ.get('FACE_DEFER_MODELS') == '1'
+
+# 初始化人脸识别服务 (开启跨请求微批推理, 最多等待5ms)
+face_service = FaceRecognitionService(micro_batch_wait_ms=5, backend=INFERENCE_BACKEND, quantized=FACENET_INT8,
+                                      load_models=not DEFER_MODELS)
+
+# 常驻内存的人脸底库 (启动时加载一次，注册/禁用/删除时增量维护，
+# 其他节点和 Java 后端的变更由 gallery_sync 按变更日志增量同步)
+face_gallery = FaceGallery(index_type=GALLERY_INDEX_TYPE)
+gallery_sync = GallerySync(
+    face_gallery, db_manager,
+    poll_interval=GALLERY_SYNC_INTERVAL, reconcile_interval=GALLERY_RECONCILE_INTERVAL
+)
+try:
+    gallery_sync.reconcile()
+except Exception as e:
+    print(f"⚠️ 人脸底库加载失败, 将在下次全量对账时重试: {e}")
+
+# 多模板: 每个人最多保留 MAX_FACE_TEMPLATES 张人脸特征 (含主模板),
+# 登录匹配距离落在 [LOGIN_TEMPLATE_MIN_DISTANCE, LOGIN_TEMPLATE_MAX_DISTANCE] 时在后台补充一个模板
+# (距离太近的没有新信息, 太远的不够可靠), 模板列由 migrate_face_encoding.py 创建
+MAX_FACE_TEMPLATES = int(os.environ.get('FACE_MAX_TEMPLATES', 5))
+LOGIN_TEMPLATE_MIN_DISTANCE = 0.3
+LOGIN_TEMPLATE_MAX_DISTANCE = 0.55
+# 同一用户 (本进程内) 至少间隔 FACE_TEMPLATE_INTERVAL 秒才补充一次模板, 连续登录不会反复改写模板
+LOGIN_TEMPLATE_INTERVAL = float(os.environ.get('FACE_TEMPLATE_INTERVAL', 3600))
+template_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='face-template')
+template_last_added = {}    # user_id -> 最近一次补充模板的时间 (monotonic)
+template_lock = threading.Lock()
+
+# 注册查重: 与其他账号的人脸距离不超过 FACE_DUPLICATE_DISTANCE 时视为重复,
+# FACE_DUPLICATE_POLICY 为 reject (拒绝, 返回409) / warn (照常注册并返回冲突) / off
+DUPLICATE_POLICY = os.environ.get('FACE_DUPLICATE_POLICY', enrollment_guard.DEFAULT_POLICY)
+DUPLICATE_DISTANCE = float(os.environ.get('FACE_DUPLICATE_DISTANCE', enrollment_guard.DEFAULT_DISTANCE))
+if DUPLICATE_POLICY not in enrollment_guard.POLICIES:
+    print(f"⚠️ 未知的查重策略 {DUPLICATE_POLICY}, 使用 {enrollment_guard.DEFAULT_POLICY}")
+    DUPLICATE_POLICY = enrollment_guard.DEFAULT_POLICY
+
+# 批量检索 (POST /api/face/search) 单次请求的查询数和候选数上限
+SEARCH_MAX_QUERIES = 256
+SEARCH_MAX_K = 100
+
+# 模型预热完成后才对外报告就绪 (GET /api/ready)
+service_ready = threading.Event()
+
+def warm_up():
+    """加载 (未加载时) 并预热所有模型, 启动底库同步线程并标记就绪, 多进程部署时在每个子进程 fork 之后调用"""
+    face_service.warm_up()
+    gallery_sync.start()
+    service_ready.set()
+
+@app.before_request
+def start_request_trace():
+    """为每个请求分配 trace id 并开始计时"""
+    g.trace_id, g.trace_token = metrics.start_trace(request.headers.get(metrics.TRACE_HEADER))
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def finish_request_trace(response):
+    response.headers[metrics.TRACE_HEADER] = g.get('trace_id', '-')
+    if 'request_start' in g and request.endpoint:
+        metrics.observe_request(request.endpoint, time.perf_counter() - g.request_start)
+    return response
+
+@app.teardown_request
+def end_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        metrics.end_trace(token)
 
 def generate_token(user_info):
     """生成JWT令牌"""
@@ -37,6 +131,32 @@ def generate_token(user_info):
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
 
+def claim_template_slot(user_id):
+    """按用户限流: 距上次补充模板超过 LOGIN_TEMPLATE_INTERVAL 秒时记录本次并返回 True"""
+    now = time.monotonic()
+    with template_lock:
+        last = template_last_added.get(user_id)
+        if last is not None and now - last < LOGIN_TEMPLATE_INTERVAL:
+            return False
+        template_last_added[user_id] = now
+        return True
+
+def add_login_template(name, user_id, encoding, profile):
+    """
+    把登录时的人脸特征追加为该用户的模板, 并更新内存底库 (在 template_executor 中执行)
+    与数据库中已有模板的距离小于 LOGIN_TEMPLATE_MIN_DISTANCE 时不追加 (如其他节点刚补充过相近的模板)
+    """
+    try:
+        templates = db_manager.add_face_template(
+            name, user_id, encoding, MAX_FACE_TEMPLATES, min_distance=LOGIN_TEMPLATE_MIN_DISTANCE
+        )
+        # 期间被禁用/删除的条目不再加回底库
+        if templates is not None and name in face_gallery.snapshot().name_to_entry:
+            face_gallery.upsert(name, templates, user_id=user_id, profile=profile)
+            logger.info(f"已为 {name} 补充人脸模板, 当前共 {len(templates)} 个")
+    except Exception as e:
+        logger.warning(f"补充人脸模板失败: {e}")
+
 def verify_token(token):
     """验证JWT令牌"""
     try:
@@ -47,55 +167,82 @@ def verify_token(token):
     except jwt.InvalidTokenError:
         return None
 
-def base64_to_image(base64_string):
-    """将base64字符串转换为OpenCV图像"""
+ADMIN_ROLE = 20
+
+def authenticate(admin=False):
+    """
+    校验 Authorization: Bearer <token>
+    Returns:
+        (payload, error): 校验失败时 payload 为 None, error 为可直接返回的响应
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None, (jsonify({'success': False, 'message': '缺少认证令牌'}), 401)
+    payload = verify_token(auth_header.split(' ')[1])
+    if not payload:
+        return None, (jsonify({'success': False, 'message': '令牌无效或已过期'}), 401)
+    if admin and payload.get('role') != ADMIN_ROLE:
+        return None, (jsonify({'success': False, 'message': '需要管理员权限'}), 403)
+    return payload, None
+
+def gallery_key(user):
+    """用户在内存底库中的人脸标识, 与 get_all_face_users 一致: 优先 face_id, 否则为用户名"""
+    return user.get('face_id') or user['username']
+
+def get_request_image(data=None):
+    """
+    从请求中读取图像, 支持:
+        JSON 的 image 字段 (base64, 可带 data:image 前缀)
+        multipart/form-data 的 image 文件
+        请求体为图片原始字节 (Content-Type: image/*)
+    Returns:
+        (image, error): 成功时 error 为 None, 失败时 image 为 None
+    """
+    if data and data.get('image'):
+        source = data['image']
+    elif 'image' in request.files:
+        source = request.files['image']
+    elif request.mimetype and request.mimetype.startswith('image/'):
+        source = request.get_data(cache=False)
+    else:
+        return None, '缺少图像数据'
+
+    start = time.perf_counter()
     try:
-        # 检查输入是否为空
-        if not base64_string:
-            print("Base64转图像失败: 输入字符串为空")
-            return None
-        
-        # 移除data:image前缀（如果存在）
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        
-        # 检查base64字符串长度
-        if len(base64_string) < 100:  # 一个有效的图像base64应该很长
-            print(f"Base64转图像失败: base64字符串太短 (长度: {len(base64_string)})")
-            return None
-        
-        # 解码base64
-        try:
-            image_data = base64.b64decode(base64_string)
-        except Exception as decode_error:
-            print(f"Base64转图像失败: base64解码错误 - {decode_error}")
-            return None
-        
-        # 检查解码后的数据长度
-        if len(image_data) < 1000:  # 图像数据应该足够大
-            print(f"Base64转图像失败: 解码后数据太小 (长度: {len(image_data)})")
-            return None
-        
-        # 转换为PIL图像
-        try:
-            pil_image = Image.open(io.BytesIO(image_data))
-        except Exception as pil_error:
-            print(f"Base64转图像失败: PIL图像打开错误 - {pil_error}")
-            return None
-        
-        # 转换为OpenCV格式
-        try:
-            opencv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-        except Exception as cv_error:
-            print(f"Base64转图像失败: OpenCV转换错误 - {cv_error}")
-            return None
-        
-        print(f"Base64转图像成功: 图像尺寸 {opencv_image.shape}")
-        return opencv_image
-        
-    except Exception as e:
-        print(f"Base64转图像失败: 未知错误 - {e}")
-        return None
+        return decode_image(source), None
+    except ImageDecodeError as e:
+        logger.warning(f"图像解码失败: {e}")
+        return None, '图像格式错误'
+    finally:
+        metrics.observe_stage('decode', time.perf_counter() - start)
+
+def check_enrollment(encodings, user_id, account_id=None):
+    """
+    注册前查重 (一次批量检索内存底库)
+    user_id 可以是数字账号ID, 也可以是 Java 端生成的 faceId (此时账号ID 在 account_id 中)
+    无法确定数字账号ID 时分不清哪些是本人已有的人脸, reject 策略降级为 warn
+    Returns:
+        (conflicts, error): 策略为 reject 且有冲突时 error 为可直接返回的409响应
+    """
+    if DUPLICATE_POLICY == 'off':
+        return [], None
+    owner = enrollment_guard.resolve_owner(user_id, account_id, db_manager)
+    conflicts = enrollment_guard.merge_conflicts(enrollment_guard.find_conflicts(
+        face_gallery, encodings, [owner] * len(encodings), DUPLICATE_DISTANCE, db_manager=db_manager
+    ))
+    if not conflicts:
+        return [], None
+    logger.warning(f"用户 {user_id} 注册的人脸与其他账号重复: {enrollment_guard.describe(conflicts)}")
+    if owner is None:
+        logger.warning(f"无法确定 {user_id} 对应的账号, 查重只告警不拒绝")
+        return conflicts, None
+    if DUPLICATE_POLICY == 'reject':
+        return conflicts, (jsonify({
+            'success': False,
+            'message': '该人脸已注册在其他账号下',
+            'conflicts': conflicts
+        }), 409)
+    return conflicts, None
 
 def hash_password(password):
     """密码哈希"""
@@ -103,19 +250,20 @@ def hash_password(password):
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """健康检查"""
+    """
+    健康检查 (存活探针)
+    只读取内存中的底库元数据和连接池指标, 不访问数据库, 可以高频调用
+    """
     try:
-        # 检查数据库连接
-        db_status = db_manager.test_connection()
-        
-        # 获取启用人脸识别的用户数量
-        face_users = db_manager.get_all_face_users()
-        
+        gallery_stats = face_gallery.stats()
         return jsonify({
             'status': 'ok',
             'message': '数据库版本的人脸识别API服务正在运行',
-            'database_status': '已连接' if db_status else '未连接',
-            'face_enabled_users': len(face_users),
+            'ready': service_ready.is_set(),
+            'face_enabled_users': gallery_stats['entries'],
+            'gallery': gallery_stats,
+            'gallery_memory': face_gallery.memory_usage(),
+            'db_pool': db_manager.pool_stats(),
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
@@ -124,6 +272,82 @@ def health_check():
             'message': f'Health check failed: {str(e)}'
         }), 500
 
+#-----------------------------------------------#
+#   深度检查在单独的线程中执行, 同一时间最多一个,
+#   并发的请求共用正在执行的检查, 避免探针堆积占满连接池
+#-----------------------------------------------#
+DEEP_CHECK_TIMEOUT = 3.0
+DEEP_CHECK_MAX_TIMEOUT = 30.0
+_deep_check_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='deep-check')
+_deep_check_lock = threading.Lock()
+_deep_check_future = None
+
+def run_deep_check():
+    """检查数据库连通性, 并对比数据库与内存底库中的人脸数量"""
+    start = time.perf_counter()
+    db_face_users = db_manager.count_face_users()
+    return {
+        'database_status': '已连接',
+        'database_latency_ms': round((time.perf_counter() - start) * 1000, 2),
+        'db_face_users': db_face_users,
+        'gallery_entries': len(face_gallery),
+        'gallery_sync': gallery_sync.stats()
+    }
+
+@app.route('/api/health/deep', methods=['GET'])
+def deep_health_check():
+    """深度健康检查: 访问数据库, 超过 timeout 秒 (默认3秒) 返回503"""
+    global _deep_check_future
+    timeout = min(request.args.get('timeout', DEEP_CHECK_TIMEOUT, type=float), DEEP_CHECK_MAX_TIMEOUT)
+    with _deep_check_lock:
+        if _deep_check_future is None or _deep_check_future.done():
+            _deep_check_future = _deep_check_executor.submit(run_deep_check)
+        future = _deep_check_future
+    try:
+        result = future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        return jsonify({
+            'status': 'timeout',
+            'message': f'深度检查超过 {timeout} 秒未完成'
+        }), 503
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'database_status': '未连接',
+            'message': f'Deep check failed: {str(e)}'
+        }), 503
+    result['status'] = 'ok'
+    result['timestamp'] = datetime.now().isoformat()
+    return jsonify(result)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 指标 (需要安装 prometheus_client)"""
+    metrics.set_gallery_size(len(face_gallery))
+    body, content_type = metrics.render()
+    if body is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'prometheus_client 未安装, Run: pip install prometheus-client'
+        }), 503
+    return Response(body, content_type=content_type)
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """就绪检查: 模型预热完成前返回503"""
+    if not service_ready.is_set():
+        return jsonify({
+            'status': 'starting',
+            'message': '模型预热中'
+        }), 503
+    return jsonify({
+        'status': 'ready',
+        'pid': os.getpid(),
+        'gallery_size': len(face_gallery),
+        'gallery_version': face_gallery.version,
+        'gallery_sync': gallery_sync.stats()
+    })
+
 # 用户注册接口已禁用 - JoyRent使用Spring Boot后端处理用户注册
 # @app.route('/api/user/register', methods=['POST'])
 # def register_user():
@@ -202,11 +426,11 @@ def register_user_face():
             }), 404
         
         # 转换图像
-        image = base64_to_image(data['image'])
+        image, error = get_request_image(data)
         if image is None:
             return jsonify({
                 'success': False,
-                'message': '图像格式错误'
+                'message': error
             }), 400
         
         # 提取人脸特征 (numpy array)
@@ -217,9 +441,17 @@ def register_user_face():
                 'message': '未检测到人脸或人脸质量不佳'
             }), 400
         
+        # 查重: 同一张脸不能注册到多个账号
+        conflicts, error = check_enrollment([face_encoding], user_id, data.get('account_id'))
+        if error:
+            return error
+
         # 将 numpy array 转换为 list 以便 JSON 序列化
         encoding_list = face_encoding.tolist()
         
+        # 这里只提取特征, 不写内存底库: 由 Java 端在百度注册成功后写入 user_face,
+        # 提交后由 gallery_sync 按变更日志加入底库, 注册失败时不会留下没有数据库记录的条目
+
         # 保存图像文件到本地 (用于可视化调试或后续处理，非必须可由Java决定)
         try:
             current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -235,7 +467,8 @@ def register_user_face():
             'success': True,
             'message': '人脸特征提取成功',
             'face_encoding': encoding_list,
-            'user_id': user_id
+            'user_id': user_id,
+            'duplicate_conflicts': conflicts
         })
             
     except Exception as e:
@@ -246,7 +479,10 @@ def register_user_face():
 
 @app.route('/api/user/face/register/upload', methods=['POST'])
 def register_user_face_upload():
-    """用户人脸注册 - 文件上传版本"""
+    """
+    用户人脸注册 - 文件上传版本
+    可上传多个 image 文件 (如不同角度), 第一张检测到人脸的为主模板, 其余作为该用户的其他模板
+    """
     try:
         # 获取表单数据
         user_id = request.form.get('user_id')
@@ -264,8 +500,8 @@ def register_user_face_upload():
                 'message': '缺少图片文件'
             }), 400
         
-        file = request.files['image']
-        if file.filename == '':
+        files = [file for file in request.files.getlist('image') if file.filename != '']
+        if not files:
             return jsonify({
                 'success': False,
                 'message': '未选择文件'
@@ -279,36 +515,51 @@ def register_user_face_upload():
                 'message': '用户不存在'
             }), 404
         
-        # 读取图像文件
-        try:
-            image_data = file.read()
-            nparr = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if image is None:
+        # 读取图像文件并提取人脸特征 (检测不到人脸的图片跳过)
+        image = None
+        encodings = []
+        for file in files[:MAX_FACE_TEMPLATES]:
+            try:
+                decoded = decode_image(file)
+            except ImageDecodeError:
                 return jsonify({
                     'success': False,
                     'message': '图像格式不支持'
                 }), 400
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'message': f'图像读取失败: {str(e)}'
-            }), 400
+            except Exception as e:
+                return jsonify({
+                    'success': False,
+                    'message': f'图像读取失败: {str(e)}'
+                }), 400
+            face_encoding = face_service._encode_face(decoded)
+            if face_encoding is not None:
+                if image is None:
+                    image = decoded
+                encodings.append(face_encoding)
         
-        # 提取人脸特征
-        face_encoding = face_service._encode_face(image)
-        if face_encoding is None:
+        if not encodings:
             return jsonify({
                 'success': False,
                 'message': '未检测到人脸或人脸质量不佳'
             }), 400
+        face_encoding = encodings[0]
         
-        # 保存到数据库
+        # 查重: 同一张脸不能注册到多个账号
+        conflicts, error = check_enrollment(encodings, user['id'], request.form.get('account_id'))
+        if error:
+            return error
+
+        # 保存到数据库 (重新注册时其他模板一并覆盖)
         img_url = f"/face_images/{user['username']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
         success = db_manager.save_user_face_embedding(user_id, face_encoding, img_url)
         
         if success:
+            if not db_manager.save_face_templates(user_id, encodings[1:]):
+                encodings = encodings[:1]
+
+            # 同步到内存底库
+            face_gallery.upsert(gallery_key(user), np.stack(encodings), user_id=user['id'], profile=user)
+
             # 保存图像文件到本地
             try:
                 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -323,6 +574,8 @@ def register_user_face_upload():
             return jsonify({
                 'success': True,
                 'message': f'用户 {user.get("nickname") or user["username"]} 人脸注册成功',
+                'templates': len(encodings),
+                'duplicate_conflicts': conflicts,
                 'userInfo': {
                     'id': user['id'],
                     'username': user['username'],
@@ -398,142 +651,258 @@ def user_login():
             'message': f'登录失败: {str(e)}'
         }), 500
 
+@app.route('/api/user/face/register/bulk', methods=['POST'])
+def register_user_face_bulk():
+    """
+    批量人脸注册 (管理员)
+    multipart/form-data 的 archive 字段为 ZIP, 图片名为 <user_id>.jpg,
+    或在压缩包中附带 manifest.csv (file,user_id); 上万张的导入请使用 bulk_enroll.py
+    """
+    _, error = authenticate(admin=True)
+    if error:
+        return error
+    archive = request.files.get('archive')
+    if archive is None or archive.filename == '':
+        return jsonify({
+            'success': False,
+            'message': '缺少ZIP文件: archive'
+        }), 400
+    try:
+        results = bulk_enroll.enroll_archive(
+            face_service, db_manager, archive, gallery=face_gallery,
+            duplicate_policy=DUPLICATE_POLICY, duplicate_distance=DUPLICATE_DISTANCE
+        )
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({
+            'success': False,
+            'message': f'压缩包无效: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'批量注册失败: {str(e)}'
+        }), 500
+    return jsonify({
+        'success': True,
+        'summary': bulk_enroll.summarize(results),
+        'results': results
+    })
+
 @app.route('/api/user/face/login', methods=['POST'])
 def face_login():
-    """人脸识别登录"""
+    """人脸识别登录 (图像可以是 JSON 中的 base64 / multipart 文件 / 请求体原始字节)"""
     try:
-        data = request.get_json()
-        
-        if not data.get('image'):
-            return jsonify({
-                'success': False,
-                'message': '缺少图像数据'
-            }), 400
+        data = request.get_json(silent=True)
         
         # 转换图像
-        image = base64_to_image(data['image'])
+        image, error = get_request_image(data)
         if image is None:
             return jsonify({
                 'success': False,
-                'message': '图像格式错误'
+                'message': error
             }), 400
         
-        # 获取所有启用人脸识别的用户
-        face_users = db_manager.get_all_face_users()
-        if not face_users:
+        # 本次请求使用的底库版本 (不可变快照, 并发的注册/删除不影响本次比对)
+        gallery = face_gallery.snapshot()
+
+        # 检查内存底库中是否有人脸数据
+        if len(gallery) == 0:
             return jsonify({
                 'success': False,
                 'message': '系统中没有启用人脸识别的用户'
             }), 404
         
-        # 构建人脸数据库
-        known_faces = {}
-        for user in face_users:
-            if user['face_embedding'] is not None:
-                known_faces[user['username']] = user['face_embedding']
+        # 进行人脸识别, 各阶段耗时记入指标
+        timings = {}
+        result = face_service.recognize_face(
+            image, gallery=gallery, profile='login', stop_on_match=True, timings=timings,
+            include_encodings=True
+        )
+        matched = [face_info for face_info in result['faces'] if face_info['name'] != 'Unknown']
+        metrics.observe_timings(timings)
+        metrics.observe_recognition(len(result['faces']), bool(matched))
+        metrics.set_gallery_size(len(gallery))
+        logger.info(
+            f"人脸识别完成: 底库 {len(gallery)} 条 (版本 {gallery.version}), "
+            f"人脸 {len(result['faces'])} 张, 匹配 {len(matched)} 张, "
+            f"耗时(ms) {', '.join(f'{stage}={seconds * 1000:.1f}' for stage, seconds in timings.items())}"
+        )
         
-        if not known_faces:
+        if not result['success']:
             return jsonify({
                 'success': False,
-                'message': '没有有效的人脸数据'
-            }), 404
+                'message': result['message']
+            }), 400
         
-        # 临时更新人脸服务的已知人脸
-        original_known_face_encodings = face_service.known_face_encodings.copy()
-        original_known_face_names = face_service.known_face_names.copy()
+        faces_info = result['faces']
+        if not faces_info:
+            return jsonify({
+                'success': False,
+                'message': '未检测到人脸'
+            }), 400
         
-        # 更新人脸服务的已知人脸数据
-        face_service.known_face_encodings = []
-        face_service.known_face_names = []
+        # 查找识别成功的用户
+        recognized_user = None
+        matched_faces = matched
         
-        for username, embedding in known_faces.items():
-            face_service.known_face_encodings.append(embedding)
-            face_service.known_face_names.append(username)
+        #-----------------------------------------------#
+        #   优先使用底库中缓存的用户信息, 无需查库
+        #-----------------------------------------------#
+        recognized_face = None
+        for face_info in matched_faces:
+            recognized_user = gallery.get_profile(face_info.get('user_id'))
+            if recognized_user:
+                recognized_face = face_info
+                break
         
-        try:
-            # 进行人脸识别
-            print(f"开始人脸识别，已知人脸数量: {len(known_faces)}")
-            result = face_service.recognize_face(image)
-            print(f"人脸识别完成，结果: {result}")
-            
-            if not result['success']:
-                return jsonify({
-                    'success': False,
-                    'message': result['message']
-                }), 400
-            
-            faces_info = result['faces']
-            if not faces_info:
-                return jsonify({
-                    'success': False,
-                    'message': '未检测到人脸'
-                }), 400
+        #-----------------------------------------------#
+        #   未缓存的条目批量查询并回填到底库:
+        #   有数字用户ID的按主键 (WHERE id IN ...) 查询,
+        #   只有 Java 注册的 face_id (或旧数据的 username) 的按人脸标识查询
+        #-----------------------------------------------#
+        if recognized_user is None and matched_faces:
+            users_by_id = db_manager.get_users_by_ids(
+                [face_info['user_id'] for face_info in matched_faces if face_info.get('user_id') is not None]
+            )
+            unbound = [face_info['name'] for face_info in matched_faces if face_info.get('user_id') is None]
+            users_by_name = db_manager.get_users_by_face_names(unbound) if unbound else {}
+            for face_info in matched_faces:
+                if face_info.get('user_id') is not None:
+                    recognized_user = users_by_id.get(face_info['user_id'])
+                else:
+                    recognized_user = users_by_name.get(face_info['name'])
+                if recognized_user:
+                    face_gallery.bind_profile(face_info['name'], recognized_user)
+                    recognized_face = face_info
+                    break
+
+        if recognized_user:
+            logger.info(f"找到匹配用户: {recognized_user['username']} (ID: {recognized_user['id']})")
             
-            # 查找识别成功的用户
-            recognized_user = None
-            for face_info in faces_info:
-                print(f"检测到人脸: {face_info.get('name', 'Unknown')}, 置信度: {face_info.get('confidence', 0)}")
-                if face_info['name'] != 'Unknown':
-                    name = face_info['name']
-                    # 优先假设这是一个 face_id (UUID)
-                    # 尝试通过 face_id 在 user_face 表中查找真实的本地 ID
-                    with db_manager.get_connection() as conn:
-                        cursor = conn.cursor(pymysql.cursors.DictCursor)
-                        # 查找关联的 user_id
-                        cursor.execute("SELECT user_id FROM user_face WHERE face_id = %s", (name,))
-                        mapping = cursor.fetchone()
-                        
-                        if mapping:
-                            # 找到了关联，通过 user_id 获取完整信息
-                            recognized_user = db_manager.get_user_by_id(mapping['user_id'])
-                        else:
-                            # 如果没找到关联，回退到按用户名查找（兼容旧数据）
-                            recognized_user = db_manager.get_user_by_username(name)
-                    
-                    if recognized_user:
-                        print(f"找到匹配用户: {recognized_user['username']} (ID: {recognized_user['id']})")
-                        break
+            # 可靠但与已有模板有差异的登录照, 在后台补充为新模板
+            distance = recognized_face['distance']
+            if (MAX_FACE_TEMPLATES > 1 and LOGIN_TEMPLATE_MIN_DISTANCE <= distance <= LOGIN_TEMPLATE_MAX_DISTANCE
+                    and claim_template_slot(recognized_user['id'])):
+                template_executor.submit(
+                    add_login_template, recognized_face['name'], recognized_user['id'],
+                    recognized_face['encoding'], recognized_user
+                )
+
+        if recognized_user:
+            # 生成令牌
+            token = generate_token(recognized_user)
             
-            if recognized_user:
-                # 生成令牌
-                token = generate_token(recognized_user)
-                
-                return jsonify({
-                    'success': True,
-                    'message': f'人脸识别登录成功，欢迎 {recognized_user.get("nickname") or recognized_user["username"]}',
-                    'token': token,
-                    'userInfo': {
-                        'id': recognized_user['id'],
-                        'username': recognized_user['username'],
-                        'phone': recognized_user.get('phone'),
-                        'nickname': recognized_user.get('nickname'),
-                        'avatar': recognized_user.get('avatar'),
-                        'role': recognized_user.get('role', 10),
-                        'balance': float(recognized_user.get('balance', 0)),
-                        'face_enabled': bool(recognized_user['face_enabled'])
-                    },
-                    'recognition_confidence': faces_info[0]['confidence']
-                })
-            else:
-                return jsonify({
-                    'success': False,
-                    'message': '人脸识别失败，未找到匹配用户'
-                }), 401
-                
-        finally:
-            # 恢复原始人脸数据
-            face_service.known_face_encodings = original_known_face_encodings
-            face_service.known_face_names = original_known_face_names
+            return jsonify({
+                'success': True,
+                'message': f'人脸识别登录成功，欢迎 {recognized_user.get("nickname") or recognized_user["username"]}',
+                'token': token,
+                'userInfo': {
+                    'id': recognized_user['id'],
+                    'username': recognized_user['username'],
+                    'phone': recognized_user.get('phone'),
+                    'nickname': recognized_user.get('nickname'),
+                    'avatar': recognized_user.get('avatar'),
+                    'role': recognized_user.get('role', 10),
+                    'balance': float(recognized_user.get('balance', 0)),
+                    'face_enabled': bool(recognized_user['face_enabled'])
+                },
+                'recognition_confidence': faces_info[0]['confidence']
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'message': '人脸识别失败，未找到匹配用户'
+            }), 401
             
     except Exception as e:
-        print(f"人脸登录异常: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"人脸登录异常: {str(e)}")
         return jsonify({
             'success': False,
             'message': f'人脸登录失败: {str(e)}'
         }), 500
 
+@app.route('/api/face/search', methods=['POST'])
+def face_search():
+    """
+    批量 top-k 人脸检索 (管理员, 用于后台查重/风控)
+    JSON: {"images": [base64...], "embeddings": [[128维]...], "k": 5, "max_distance": 0.8, "all_faces": false}
+    或 multipart/form-data: 多个 image 文件, k / max_distance / all_faces 为表单字段
+    """
+    _, error = authenticate(admin=True)
+    if error:
+        return error
+    try:
+        data = request.get_json(silent=True)
+        if data is None:
+            data = request.form
+            images = request.files.getlist('image')
+            embeddings = []
+        else:
+            images = data.get('images') or []
+            embeddings = data.get('embeddings') or []
+
+        try:
+            k = int(data.get('k', 5))
+            max_distance = data.get('max_distance')
+            max_distance = float(max_distance) if max_distance not in (None, '') else None
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': 'k / max_distance 格式错误'
+            }), 400
+        all_faces = str(data.get('all_faces', '')).lower() in ('1', 'true')
+
+        if not isinstance(images, list) or not isinstance(embeddings, list):
+            return jsonify({
+                'success': False,
+                'message': 'images / embeddings 应为数组'
+            }), 400
+        if not images and not embeddings:
+            return jsonify({
+                'success': False,
+                'message': '缺少 images 或 embeddings'
+            }), 400
+        if len(images) + len(embeddings) > SEARCH_MAX_QUERIES or not 1 <= k <= SEARCH_MAX_K:
+            return jsonify({
+                'success': False,
+                'message': f'单次最多 {SEARCH_MAX_QUERIES} 个查询, k 的范围为 1~{SEARCH_MAX_K}'
+            }), 400
+
+        start = time.perf_counter()
+        result = face_service.search_faces(
+            images=images, embeddings=embeddings, gallery=face_gallery,
+            k=k, max_distance=max_distance, all_faces=all_faces
+        )
+        elapsed = time.perf_counter() - start
+
+        #-----------------------------------------------#
+        #   未绑定用户ID的候选 (Java 注册的 face_id) 一次批量查询补全
+        #-----------------------------------------------#
+        unresolved = {
+            candidate['name'] for item in result['results'] for candidate in item['candidates']
+            if candidate['user_id'] is None
+        }
+        if unresolved:
+            users = db_manager.get_users_by_face_names(list(unresolved))
+            for item in result['results']:
+                for candidate in item['candidates']:
+                    user = users.get(candidate['name'])
+                    if candidate['user_id'] is None and user:
+                        candidate['user_id'] = user['id']
+
+        logger.info(
+            f"批量人脸检索: 查询 {len(result['results'])} 个, 失败 {len(result['errors'])} 个, "
+            f"k={k}, 耗时 {elapsed * 1000:.1f}ms"
+        )
+        return jsonify(result)
+
+    except Exception as e:
+        logger.exception(f"批量人脸检索异常: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'人脸检索失败: {str(e)}'
+        }), 500
+
 @app.route('/api/user/face/disable', methods=['POST'])
 def disable_user_face():
     """禁用用户人脸识别"""
@@ -549,6 +918,7 @@ def disable_user_face():
         success = db_manager.disable_user_face(data['user_id'])
         
         if success:
+            face_gallery.remove(data['user_id'])
             return jsonify({
                 'success': True,
                 'message': '人脸识别已禁用'
@@ -584,6 +954,8 @@ def delete_user_face():
         
         # 2. 调用逻辑层删除文件和内存数据
         face_service.delete_face(user['username'])
+        face_gallery.remove(user_id)
+        face_gallery.remove(user['username'])
         
         return jsonify({
             'success': True,
@@ -683,13 +1055,18 @@ if __name__ == '__main__':
     
     if db_manager.test_connection():
         print("✅ 数据库连接成功")
-        face_users = db_manager.get_all_face_users()
-        print(f"👥 当前启用人脸识别的用户: {len(face_users)}")
+        print(f"👥 当前启用人脸识别的用户: {len(face_gallery)}")
+        print("🔥 模型预热中...")
+        warm_up()
         
         print("\n🌐 JoyRent人脸识别API接口:")
         print("  健康检查: GET /api/health")
+        print("  深度检查: GET /api/health/deep")
+        print("  就绪检查: GET /api/ready")
+        print("  监控指标: GET /metrics")
         print("  人脸注册(JSON): POST /api/user/face/register")
         print("  人脸注册(文件): POST /api/user/face/register/upload")
+        print("  批量人脸注册: POST /api/user/face/register/bulk")
         print("  人脸登录: POST /api/user/face/login")
         print("  禁用人脸: POST /api/user/face/disable")
         print("  人脸用户列表: GET /api/users/face")
@@ -0,0 +1,286 @@
+"""
+人脸识别流水线基准测试
+分阶段统计一次人脸登录的耗时: 解码 / Pnet / Rnet / Onet / 对齐 / facenet编码 / 底库检索,
+覆盖不同分辨率、人脸数量和底库规模, 输出 p50/p95/p99 延迟、吞吐量和峰值内存 (JSON)。
+每个后端在独立的子进程中运行, 峰值内存互不影响。
+
+合成图片: 把样本图片 (默认 face_images / face_dataset) 缩放后贴到噪声背景上,
+每张图片包含指定数量的人脸; 没有样本图片时只有噪声背景 (只能测到 Pnet)。
+
+用法:
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --backends keras onnx --resolutions 640x480 1920x1080 --faces 1 4
+    python benchmark_pipeline.py --images face_images --profile login --output pipeline.json
+    python benchmark_pipeline.py --gallery-sizes 10000 1000000 --indexes exact int8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_DIRS = [os.path.join(BASE_DIR, 'face_images'), os.path.join(BASE_DIR, 'face_dataset')]
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+STAGES = ['decode', 'pnet', 'rnet', 'onet', 'align', 'embed', 'total']
+
+
+def summarize(samples):
+    """秒 -> 毫秒的 p50/p95/p99/平均值"""
+    if not samples:
+        return None
+    samples = np.asarray(samples) * 1000
+    return {
+        'count': int(len(samples)),
+        'p50': round(float(np.percentile(samples, 50)), 3),
+        'p95': round(float(np.percentile(samples, 95)), 3),
+        'p99': round(float(np.percentile(samples, 99)), 3),
+        'mean': round(float(np.mean(samples)), 3),
+    }
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存 (Linux 上 ru_maxrss 单位为KB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+#-----------------------------------------------#
+#   测试图片
+#-----------------------------------------------#
+def load_samples(directories):
+    samples = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                img = cv2.imread(os.path.join(directory, name))
+                if img is not None:
+                    samples.append(img)
+    return samples
+
+
+def synthetic_image(width, height, faces, samples, rng):
+    """噪声背景上平铺 faces 张样本图片, 样本按格子大小等比缩放"""
+    img = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 3)
+    if not samples or faces <= 0:
+        return img
+    cols = int(np.ceil(np.sqrt(faces)))
+    rows = int(np.ceil(faces / cols))
+    cell_w, cell_h = width // cols, height // rows
+    for i in range(faces):
+        sample = samples[int(rng.integers(len(samples)))]
+        scale = min(cell_w / sample.shape[1], cell_h / sample.shape[0]) * 0.9
+        resized = cv2.resize(sample, (max(1, int(sample.shape[1] * scale)), max(1, int(sample.shape[0] * scale))))
+        y = (i // cols) * cell_h + (cell_h - resized.shape[0]) // 2
+        x = (i % cols) * cell_w + (cell_w - resized.shape[1]) // 2
+        img[y:y + resized.shape[0], x:x + resized.shape[1]] = resized
+    return img
+
+
+def encode_jpeg(img, quality=90):
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+#-----------------------------------------------#
+#   单个配置的测试
+#-----------------------------------------------#
+def bench_pipeline(service, jpegs, profile, repeat):
+    """
+    对每张图片跑完整的 解码->检测->对齐->编码 流程
+    Returns:
+        (各阶段统计, 每秒处理的图片数, 平均人脸数, 得到的特征)
+    """
+    from image_decode import decode_image
+    from utils import utils
+
+    samples = {stage: [] for stage in STAGES}
+    detected, embeddings = [], []
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        for data in jpegs:
+            timings = {}
+            start = time.perf_counter()
+            img = decode_image(data)
+            step = utils.record_stage(timings, 'decode', start)
+            faces = service._detect_and_align(img, profile=profile, timings=timings)
+            step = time.perf_counter()
+            if faces:
+                encodings = utils.calc_128_vec_batch(
+                    service.facenet_model, [face for _, face in faces], service.embedding_batch_size
+                )
+                embeddings.extend(encodings)
+                utils.record_stage(timings, 'embed', step)
+            timings['total'] = time.perf_counter() - start
+            for stage, seconds in timings.items():
+                samples[stage].append(seconds)
+            detected.append(len(faces))
+    elapsed = time.perf_counter() - begin
+
+    stages = {stage: summarize(values) for stage, values in samples.items() if values}
+    throughput = round(len(detected) / elapsed, 2) if elapsed > 0 else None
+    return stages, throughput, float(np.mean(detected)) if detected else 0.0, embeddings
+
+
+def bench_matching(embeddings, gallery_sizes, index_types, repeat):
+    """在合成底库上检索真实的特征, 统计单次检索延迟和批量吞吐"""
+    from benchmark_gallery_index import make_gallery
+    from face_gallery import FaceGallery
+
+    if not embeddings:
+        embeddings = list(make_gallery(32, seed=7))
+    queries = np.asarray(embeddings, dtype=np.float32)
+
+    results = []
+    for size in gallery_sizes:
+        vectors = make_gallery(size)
+        for index_type in index_types:
+            gallery = FaceGallery(index_type=index_type)
+            gallery.apply_changes([], [
+                {'id': i, 'username': str(i), 'face_embedding': vector} for i, vector in enumerate(vectors)
+            ])
+            snapshot = gallery.snapshot()
+            latencies = []
+            for _ in range(repeat):
+                for query in queries:
+                    start = time.perf_counter()
+                    snapshot.match(query)
+                    latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            snapshot.search(queries, 1)
+            batch_seconds = time.perf_counter() - start
+            results.append({
+                'gallery_size': size,
+                'index': index_type,
+                'search': summarize(latencies),
+                'batch_qps': round(len(queries) / batch_seconds, 1) if batch_seconds > 0 else None,
+                'memory': gallery.memory_usage(),
+            })
+            print(f"   🔍 {index_type} @ {size}: p50 {results[-1]['search']['p50']}ms")
+    return results
+
+
+def run_backend(config):
+    """在子进程中运行一个后端的全部测试"""
+    sys.path.insert(0, BASE_DIR)
+    from face_recognition_service import FaceRecognitionService
+
+    rss_start = peak_rss_mb()
+    service = FaceRecognitionService(
+        micro_batch_wait_ms=config['micro_batch_wait_ms'], load_database=False,
+        backend=config['backend'], quantized=config['quantized']
+    )
+    service.warm_up()
+    rss_loaded = peak_rss_mb()
+
+    rng = np.random.default_rng(0)
+    samples = load_samples(config['sample_dirs'])
+    groups = []
+    for width, height in config['resolutions']:
+        for faces in config['faces']:
+            images = [synthetic_image(width, height, faces, samples, rng) for _ in range(config['images'])]
+            groups.append((f"{width}x{height}", faces, [encode_jpeg(img) for img in images]))
+    if config['images_dir']:
+        jpegs = []
+        for name in sorted(os.listdir(config['images_dir'])):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(config['images_dir'], name), 'rb') as f:
+                    jpegs.append(f.read())
+        groups.append(('samples', None, jpegs))
+
+    pipeline, embeddings = [], []
+    for resolution, faces, jpegs in groups:
+        if not jpegs:
+            continue
+        stages, throughput, detected, encodings = bench_pipeline(service, jpegs, config['profile'], config['repeat'])
+        embeddings.extend(encodings)
+        pipeline.append({
+            'resolution': resolution,
+            'faces': faces,
+            'images': len(jpegs),
+            'detected_faces_mean': round(detected, 2),
+            'stages_ms': stages,
+            'throughput_ips': throughput,
+        })
+        print(f"   ⏱️  {resolution} x{faces}: total p50 {stages['total']['p50']}ms, {throughput} 张/秒")
+
+    matching = bench_matching(embeddings[:64], config['gallery_sizes'], config['indexes'], config['repeat'])
+    return {
+        'backend': config['backend'],
+        'quantized': config['quantized'],
+        'profile': config['profile'],
+        'micro_batch_wait_ms': config['micro_batch_wait_ms'],
+        'pipeline': pipeline,
+        'matching': matching,
+        'rss_mb': {'before_models': rss_start, 'after_models': rss_loaded, 'peak': peak_rss_mb()},
+    }
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="人脸识别流水线基准测试")
+    parser.add_argument('--backends', nargs='+', default=['keras'], help="推理后端: keras / onnx / onnx-int8")
+    parser.add_argument('--resolutions', nargs='+', default=['640x480', '1280x720', '1920x1080', '4000x3000'],
+                        help="合成图片的分辨率")
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 3], help="每张合成图片中的人脸数")
+    parser.add_argument('--images', type=int, default=5, help="每个 分辨率x人脸数 组合的图片数")
+    parser.add_argument('--images-dir', help="另外测试该目录中的真实图片 (原始分辨率)")
+    parser.add_argument('--samples', nargs='+', default=SAMPLE_DIRS, help="合成图片使用的样本图片目录")
+    parser.add_argument('--profile', default='default', help="检测配置: default / login")
+    parser.add_argument('--micro-batch-wait-ms', type=float, help="开启跨请求微批推理的等待窗口")
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000, 100000], help="底库规模")
+    parser.add_argument('--indexes', nargs='+', default=['exact'], help="底库检索索引类型")
+    parser.add_argument('--repeat', type=int, default=3, help="每张图片重复的次数")
+    parser.add_argument('--output', help="结果输出的JSON文件")
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for backend in args.backends:
+        config = {
+            'backend': 'onnx' if backend.startswith('onnx') else backend,
+            'quantized': backend == 'onnx-int8',
+            'resolutions': [parse_resolution(value) for value in args.resolutions],
+            'faces': args.faces,
+            'images': args.images,
+            'images_dir': args.images_dir,
+            'sample_dirs': args.samples,
+            'profile': args.profile,
+            'micro_batch_wait_ms': args.micro_batch_wait_ms,
+            'gallery_sizes': args.gallery_sizes,
+            'indexes': args.indexes,
+            'repeat': args.repeat,
+        }
+        print(f"🚀 {backend} ...")
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_backend, (config,)))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"✅ 结果已写入 {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+"""
+批量人脸注册 / 模型升级后重新编码
+
+用法:
+    python bulk_enroll.py enroll members.zip                     # ZIP 或目录, 图片名为 <user_id>.jpg 或 <user_id>_xxx.jpg
+    python bulk_enroll.py enroll photos/ --report report.csv     # 目录中有 manifest.csv (file,user_id) 时按清单对应
+    python bulk_enroll.py reencode                               # 用当前模型重新编码 face_images 中的全部人脸
+    python bulk_enroll.py reencode --restart                     # 忽略断点, 从头开始
+
+图片在进程池中编码 (子进程数见 --workers), 每批先查重 (与底库中其他账号、同批其他用户的人脸比对,
+见 enrollment_guard, --duplicate-policy / --duplicate-distance), 特征按批在一个事务中写入 user_face,
+每张图片的处理结果写入 CSV 报告。重新编码每完成一批就更新断点文件,
+中断后再次运行会跳过已完成的人脸; 模型权重变化后断点自动失效。
+运行中的人脸节点通过变更日志同步新特征 (见 setup_face_change_log.py)。
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from contextlib import nullcontext
+from datetime import datetime
+
+import enrollment_guard
+
+FACE_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_images')
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+MANIFEST_NAME = 'manifest.csv'
+CHECKPOINT_VERSION = 1
+
+# 单个压缩包的限制, 防止解压炸弹
+MAX_ARCHIVE_FILES = 20000
+MAX_ARCHIVE_BYTES = 2 << 30
+
+# face_images 中的文件名: <face_id / username / user_id>_<YYYYmmdd>_<HHMMSS>.jpg
+_IMAGE_NAME = re.compile(r'^(.+)_(\d{8})_(\d{6})$')
+
+STATUS_MESSAGES = {
+    'enrolled': '注册成功',
+    'reencoded': '重新编码成功',
+    'invalid_user_id': '无法从文件名或清单中得到数字用户ID',
+    'missing_file': '清单中的图片不存在',
+    'unknown_user': '用户不存在或人脸记录已删除',
+    'duplicate': '同一用户有多张图片, 使用最后一张',
+    'no_face': '图片无法读取或未检测到人脸',
+    'face_conflict': '人脸与其他账号重复, 未注册',
+    'enrolled_conflict': '注册成功, 人脸与其他账号重复',
+    'db_error': '写入数据库失败',
+}
+
+
+def _result(file, user_id, status, message=None):
+    return {'file': file, 'user_id': user_id, 'status': status, 'message': message or STATUS_MESSAGES[status]}
+
+
+#-----------------------------------------------#
+#   输入: 目录 / ZIP
+#-----------------------------------------------#
+def extract_archive(source, target_dir):
+    """
+    解压 ZIP (路径或文件对象) 中的图片和清单
+    图片按序号重命名后写入 target_dir, 不使用压缩包中的路径 (避免 zip slip)
+    Returns:
+        (files, manifest_path): files 为 [(压缩包内的路径, 解压后的路径)]
+    """
+    files, manifest_path, total = [], None, 0
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = info.filename
+            ext = os.path.splitext(name)[1].lower()
+            is_manifest = os.path.basename(name) == MANIFEST_NAME
+            if not is_manifest and ext not in IMAGE_EXTENSIONS:
+                continue
+            total += info.file_size
+            if len(files) >= MAX_ARCHIVE_FILES or total > MAX_ARCHIVE_BYTES:
+                raise ValueError(f"压缩包过大 (最多 {MAX_ARCHIVE_FILES} 张图片, {MAX_ARCHIVE_BYTES >> 20}MB)")
+            path = os.path.join(target_dir, MANIFEST_NAME if is_manifest else f"{len(files):06d}{ext}")
+            with archive.open(info) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            if is_manifest:
+                manifest_path = path
+            else:
+                files.append((name, path))
+    return files, manifest_path
+
+
+def scan_directory(directory):
+    """目录 (含子目录) 中的图片, 返回 ([(相对路径, 绝对路径)], 清单路径)"""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.startswith('.') or os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            files.append((os.path.relpath(path, directory), path))
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    return files, manifest_path if os.path.isfile(manifest_path) else None
+
+
+def _parse_user_id(value):
+    value = str(value).strip()
+    return int(value) if value.isdigit() else None
+
+
+def match_user_ids(files, manifest_path=None):
+    """
+    确定每张图片对应的用户ID
+    有清单时按清单 (file,user_id), 否则取文件名中第一个 '_' 之前的数字
+    Returns:
+        (items, results): items 为 [(file, path, user_id)], results 为无法对应的图片
+    """
+    items, results = [], []
+    if manifest_path:
+        paths = dict(files)
+        with open(manifest_path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                file = (row.get('file') or '').strip()
+                user_id = _parse_user_id(row.get('user_id', ''))
+                if user_id is None:
+                    results.append(_result(file, row.get('user_id'), 'invalid_user_id'))
+                elif file not in paths:
+                    results.append(_result(file, user_id, 'missing_file'))
+                else:
+                    items.append((file, paths[file], user_id))
+        return items, results
+
+    for file, path in files:
+        stem = os.path.splitext(os.path.basename(file))[0]
+        user_id = _parse_user_id(stem.split('_', 1)[0])
+        if user_id is None:
+            results.append(_result(file, None, 'invalid_user_id'))
+        else:
+            items.append((file, path, user_id))
+    return items, results
+
+
+#-----------------------------------------------#
+#   批量注册
+#-----------------------------------------------#
+def _save_chunk(db_manager, items, gallery):
+    """
+    一个事务写入一批特征, 并同步到内存底库
+    Returns:
+        错误信息, 成功时为 None
+    """
+    try:
+        db_manager.save_user_face_embeddings(items)
+    except Exception as e:
+        return str(e)
+    if gallery is not None:
+        user_ids = {user_id for user_id, _, _ in items}
+        face_ids = {face_id for _, face_id, _ in items if face_id}
+        gallery.apply_changes(user_ids | face_ids, db_manager.get_all_face_users(user_ids=user_ids))
+    return None
+
+
+def _pool_for(face_service, count):
+    """需要编码的图片较多时创建共用的进程池, 否则在当前进程编码"""
+    if count >= face_service.parallel_encode_min and face_service.encode_workers > 1:
+        return face_service.encode_pool()
+    return nullcontext()
+
+
+def enroll(face_service, db_manager, files, manifest_path=None, gallery=None,
+           images_dir=FACE_IMAGES_DIR, chunk_size=500,
+           duplicate_policy=enrollment_guard.DEFAULT_POLICY, duplicate_distance=enrollment_guard.DEFAULT_DISTANCE):
+    """
+    批量注册人脸
+    Args:
+        files: [(报告中显示的文件名, 图片路径)], 由 scan_directory / extract_archive 得到
+        gallery: 不为空时同步更新该内存底库, 并用于查重 (为空时只做同批内的查重)
+        images_dir: 注册成功的图片复制到该目录, 供以后重新编码
+        duplicate_policy: 查重策略 reject / warn / off (见 enrollment_guard)
+        duplicate_distance: 与其他账号的人脸距离不超过该值时视为重复
+    Returns:
+        list: 每张图片一条结果 {'file', 'user_id', 'status', 'message'}
+    """
+    items, results = match_user_ids(files, manifest_path)
+    users = db_manager.get_users_by_ids({user_id for _, _, user_id in items})
+
+    #-----------------------------------------------#
+    #   每个用户只保留最后一张图片, 其余的不再编码
+    #-----------------------------------------------#
+    latest = {}
+    for file, path, user_id in items:
+        if user_id not in users:
+            results.append(_result(file, user_id, 'unknown_user'))
+            continue
+        if user_id in latest:
+            results.append(_result(latest[user_id][0], user_id, 'duplicate'))
+        latest[user_id] = (file, path)
+    pending = [(file, path, user_id) for user_id, (file, path) in latest.items()]
+
+    os.makedirs(images_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    with _pool_for(face_service, len(pending)) as pool:
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            encodings = face_service.encode_images([path for _, path, _ in chunk], pool=pool)
+
+            encoded = [(item, encoding) for item, encoding in zip(chunk, encodings) if encoding is not None]
+            results.extend(_result(file, user_id, 'no_face') for (file, _, user_id), encoding
+                           in zip(chunk, encodings) if encoding is None)
+
+            #-----------------------------------------------#
+            #   整批查重: 底库一次批量检索 + 同批内两两比对
+            #-----------------------------------------------#
+            conflicts = [[] for _ in encoded]
+            if encoded and duplicate_policy != 'off':
+                conflicts = enrollment_guard.find_conflicts(
+                    gallery, [enc for _, enc in encoded], [user_id for (_, _, user_id), _ in encoded],
+                    duplicate_distance, db_manager=db_manager, within_batch=True
+                )
+            if duplicate_policy == 'reject':
+                rejected = enrollment_guard.rejected_items(conflicts)
+                results.extend(
+                    _result(file, user_id, 'face_conflict', f"人脸与其他账号重复: {enrollment_guard.describe(found)}")
+                    for i, (((file, _, user_id), _), found) in enumerate(zip(encoded, conflicts)) if i in rejected
+                )
+                encoded = [item for i, item in enumerate(encoded) if i not in rejected]
+                conflicts = [[] for _ in encoded]
+
+            error = None
+            if encoded:
+                error = _save_chunk(db_manager, [(user_id, None, enc) for (_, _, user_id), enc in encoded], gallery)
+            for ((file, path, user_id), _), found in zip(encoded, conflicts):
+                if error:
+                    results.append(_result(file, user_id, 'db_error', f"写入数据库失败: {error}"))
+                    continue
+                ext = os.path.splitext(path)[1].lower()
+                shutil.copyfile(path, os.path.join(images_dir, f"{user_id}_{timestamp}{ext}"))
+                if found:
+                    results.append(_result(file, user_id, 'enrolled_conflict',
+                                           f"注册成功, 人脸与其他账号重复: {enrollment_guard.describe(found)}"))
+                else:
+                    results.append(_result(file, user_id, 'enrolled'))
+            print(f"📦 已处理 {min(start + chunk_size, len(pending))}/{len(pending)} 个用户")
+    return results
+
+
+def enroll_archive(face_service, db_manager, source, **kwargs):
+    """解压 ZIP 到临时目录后批量注册, 参数同 enroll"""
+    with tempfile.TemporaryDirectory(prefix='face_bulk_') as tmp:
+        files, manifest_path = extract_archive(source, tmp)
+        return enroll(face_service, db_manager, files, manifest_path, **kwargs)
+
+
+def summarize(results):
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return summary
+
+
+def write_report(results, path):
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'user_id', 'status', 'message'])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+#-----------------------------------------------#
+#   模型升级后重新编码
+#-----------------------------------------------#
+def latest_images(images_dir):
+    """face_images 中每个人脸标识最新的一张图片: {key: 文件名}"""
+    latest = {}
+    for name in sorted(os.listdir(images_dir)):
+        stem, ext = os.path.splitext(name)
+        match = _IMAGE_NAME.match(stem)
+        if not match or ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        key = match.group(1)
+        if key not in latest or stem > os.path.splitext(latest[key])[0]:
+            latest[key] = name
+    return latest
+
+
+def load_checkpoint(path, fingerprint):
+    """读取断点, 文件不存在或模型权重已变化时返回空断点"""
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('version') == CHECKPOINT_VERSION and checkpoint.get('fingerprint') == fingerprint:
+            return checkpoint
+        print("ℹ️  模型权重已变化, 忽略旧的断点")
+    return {'version': CHECKPOINT_VERSION, 'fingerprint': fingerprint, 'done': {}}
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def resolve_keys(db_manager, keys):
+    """
+    人脸标识 -> (user_id, face_id)
+    依次按 face_id、用户名、数字用户ID 匹配, face_id 为空时按 user_id 写入
+    """
+    resolved = {}
+    for key, user in db_manager.get_users_by_face_names(keys).items():
+        face_id = user.get('face_id') if user.get('face_id') == key else None
+        if face_id or user.get('face_enabled'):
+            resolved[key] = (user['id'], face_id)
+    numeric = [key for key in keys if key not in resolved and key.isdigit()]
+    users = db_manager.get_users_by_ids(numeric)
+    for key in numeric:
+        if int(key) in users:
+            resolved[key] = (int(key), None)
+    return resolved
+
+
+def reencode(face_service, db_manager, images_dir=FACE_IMAGES_DIR, checkpoint_path=None,
+             gallery=None, chunk_size=500, restart=False):
+    """
+    用当前模型重新编码 images_dir 中每个人脸的最新图片并写回数据库
+    每完成一批更新一次断点, 中断后再次调用从断点继续
+    Returns:
+        list: 本次处理的每个人脸一条结果
+    """
+    checkpoint_path = checkpoint_path or os.path.join(images_dir, '.reencode_checkpoint.json')
+    fingerprint = face_service.weights_fingerprint()
+    checkpoint = load_checkpoint(checkpoint_path, fingerprint) if not restart else \
+        {'version': CHECKPOINT_VERSION, 'fingerprint': fingerprint, 'done': {}}
+
+    images = latest_images(images_dir)
+    todo = [key for key in sorted(images) if key not in checkpoint['done']]
+    print(f"🔁 共 {len(images)} 个人脸, 已完成 {len(images) - len(todo)}, 待处理 {len(todo)}")
+
+    results = []
+    with _pool_for(face_service, len(todo)) as pool:
+        for start in range(0, len(todo), chunk_size):
+            keys = todo[start:start + chunk_size]
+            resolved = resolve_keys(db_manager, keys)
+            for key in keys:
+                if key not in resolved:
+                    results.append(_result(images[key], key, 'unknown_user'))
+                    checkpoint['done'][key] = 'unknown_user'
+
+            keys = [key for key in keys if key in resolved]
+            encodings = face_service.encode_images([os.path.join(images_dir, images[key]) for key in keys], pool=pool)
+            items, saved_keys = [], []
+            for key, encoding in zip(keys, encodings):
+                if encoding is None:
+                    results.append(_result(images[key], key, 'no_face'))
+                    checkpoint['done'][key] = 'no_face'
+                    continue
+                user_id, face_id = resolved[key]
+                items.append((user_id, face_id, encoding))
+                saved_keys.append(key)
+
+            error = _save_chunk(db_manager, items, gallery)
+            if error:
+                # 写库失败的批次不记入断点, 下次运行时重试
+                results.extend(_result(images[key], key, 'db_error', f"写入数据库失败: {error}") for key in saved_keys)
+            else:
+                for key in saved_keys:
+                    results.append(_result(images[key], key, 'reencoded'))
+                    checkpoint['done'][key] = 'reencoded'
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"📦 已处理 {min(start + chunk_size, len(todo))}/{len(todo)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量人脸注册 / 模型升级后重新编码")
+    parser.add_argument('--workers', type=int, help="编码进程数, 默认 min(4, CPU核数)")
+    parser.add_argument('--chunk-size', type=int, default=500, help="每批写入数据库的条数")
+    parser.add_argument('--report', default='bulk_enroll_report.csv', help="结果报告 (CSV)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enroll_parser = subparsers.add_parser('enroll', help="从 ZIP 或目录批量注册")
+    enroll_parser.add_argument('source', help="ZIP 文件或图片目录")
+    enroll_parser.add_argument('--duplicate-policy', choices=enrollment_guard.POLICIES,
+                               default=enrollment_guard.DEFAULT_POLICY, help="与其他账号人脸重复时的处理")
+    enroll_parser.add_argument('--duplicate-distance', type=float, default=enrollment_guard.DEFAULT_DISTANCE,
+                               help="人脸距离不超过该值时视为重复")
+
+    reencode_parser = subparsers.add_parser('reencode', help="用当前模型重新编码已注册的人脸图片")
+    reencode_parser.add_argument('--images', default=FACE_IMAGES_DIR, help="人脸图片目录")
+    reencode_parser.add_argument('--checkpoint', help="断点文件, 默认为图片目录下的 .reencode_checkpoint.json")
+    reencode_parser.add_argument('--restart', action='store_true', help="忽略断点, 从头开始")
+    args = parser.parse_args()
+
+    from database_config import db_manager
+    from face_recognition_service import FaceRecognitionService
+
+    if not db_manager.test_connection():
+        print("❌ 数据库连接失败，请检查配置")
+        return
+
+    face_service = FaceRecognitionService(
+        load_database=False, encode_workers=args.workers,
+        backend=os.environ.get('FACE_BACKEND', 'keras'),
+        quantized=os.environ.get('FACE_FACENET_INT8') == '1'
+    )
+    if args.command == 'enroll':
+        # 查重需要完整的底库, 导入过程中按批更新
+        gallery = None
+        if args.duplicate_policy != 'off':
+            from face_gallery import FaceGallery
+            gallery = FaceGallery()
+            gallery.load_from_db(db_manager, strict=True)
+        options = {
+            'gallery': gallery,
+            'chunk_size': args.chunk_size,
+            'duplicate_policy': args.duplicate_policy,
+            'duplicate_distance': args.duplicate_distance,
+        }
+        if os.path.isdir(args.source):
+            files, manifest_path = scan_directory(args.source)
+            results = enroll(face_service, db_manager, files, manifest_path, **options)
+        else:
+            results = enroll_archive(face_service, db_manager, args.source, **options)
+    else:
+        results = reencode(face_service, db_manager, args.images, args.checkpoint,
+                           chunk_size=args.chunk_size, restart=args.restart)
+
+    write_report(results, args.report)
+    print(f"✅ 完成: {json.dumps(summarize(results), ensure_ascii=False)}, 报告已写入 {args.report}")
+
+
+if __name__ == '__main__':
+    main()
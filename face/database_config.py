@@ -1,9 +1,17 @@
 import pymysql
+import os
 import json
+import threading
+import time
+import weakref
 import numpy as np
 from contextlib import contextmanager
 import logging
 
+from embedding_codec import (encode_embedding, decode_embedding, parse_embedding_text, EmbeddingFormatError,
+                             encode_templates, decode_templates)
+from metrics import observe_stage
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,33 +26,208 @@ class DatabaseConfig:
         self.database = 'joy_rent'
         self.charset = 'utf8mb4'
 
+        # 连接池配置
+        self.pool_max_size = 10              # 最大连接数
+        self.pool_wait_timeout = 5           # 连接耗尽时的最长等待时间(秒)
+        self.pool_idle_timeout = 300         # 空闲超过该时间的连接被回收(秒)
+        self.pool_max_lifetime = 3600        # 连接的最长存活时间(秒)
+        self.pool_health_check_interval = 30 # 空闲超过该时间的连接借出前先 ping(秒)
+
+# 所有存活的连接池, fork 后在子进程中统一丢弃继承来的连接
+_pools = weakref.WeakSet()
+
+class ConnectionPool:
+    """
+    线程安全的有界连接池
+    借出时优先复用空闲连接, 超过空闲时间或最长存活时间的连接直接关闭,
+    空闲较久的连接借出前先 ping 一次做健康检查
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._cond = threading.Condition()
+        self._idle = []        # [(connection, created_at, last_used)]
+        self._created_at = {}  # id(connection) -> created_at
+        self._size = 0
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'borrowed': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+        }
+        _pools.add(self)
+
+    def _after_fork(self):
+        """
+        fork 出的子进程不能与父进程共用 socket,
+        直接丢弃继承来的空闲连接 (不调用 close, 避免断开父进程的连接)
+        """
+        self._cond = threading.Condition()
+        self._idle = []
+        self._created_at = {}
+        self._size = 0
+
+    def _connect(self):
+        return pymysql.connect(
+            host=self.config.host,
+            port=self.config.port,
+            user=self.config.user,
+            password=self.config.password,
+            database=self.config.database,
+            charset=self.config.charset,
+            autocommit=True
+        )
+
+    def _close(self, connection):
+        self._created_at.pop(id(connection), None)
+        self._size -= 1
+        self._stats['closed'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def borrow(self):
+        """借出一个连接, 连接池耗尽时最多等待 pool_wait_timeout 秒"""
+        deadline = None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    connection, created_at, last_used = self._idle.pop()
+                    if (now - last_used > self.config.pool_idle_timeout
+                            or now - created_at > self.config.pool_max_lifetime):
+                        self._close(connection)
+                        continue
+                    if now - last_used > self.config.pool_health_check_interval:
+                        try:
+                            connection.ping(reconnect=False)
+                        except Exception:
+                            self._close(connection)
+                            continue
+                    self._stats['borrowed'] += 1
+                    return connection
+
+                if self._size < self.config.pool_max_size:
+                    self._size += 1
+                    break
+
+                #-----------------------------------------------#
+                #   连接池已满, 等待其他线程归还
+                #-----------------------------------------------#
+                if deadline is None:
+                    deadline = now + self.config.pool_wait_timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise TimeoutError(f"等待数据库连接超时 ({self.config.pool_wait_timeout}s)")
+                start = time.monotonic()
+                self._cond.wait(remaining)
+                self._stats['wait_seconds'] += time.monotonic() - start
+
+        # 在锁外建立新连接, 避免握手阻塞其他线程
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created_at[id(connection)] = time.monotonic()
+            self._stats['created'] += 1
+            self._stats['borrowed'] += 1
+        return connection
+
+    def release(self, connection, broken=False):
+        """归还连接; broken 为 True 时直接关闭"""
+        with self._cond:
+            now = time.monotonic()
+            created_at = self._created_at.get(id(connection), now)
+            if broken or not connection.open or now - created_at > self.config.pool_max_lifetime:
+                self._close(connection)
+            else:
+                self._idle.append((connection, created_at, now))
+            self._cond.notify()
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._cond:
+            while self._idle:
+                connection, _, _ = self._idle.pop()
+                self._close(connection)
+
+    def stats(self):
+        """连接池指标"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.config.pool_max_size
+            stats['wait_seconds'] = round(stats['wait_seconds'], 4)
+            return stats
+
+#-----------------------------------------------#
+#   模块级只注册一次 at-fork 回调 (回调无法注销,
+#   按实例注册会让每个连接池永远不被回收)
+#-----------------------------------------------#
+def _pools_after_fork():
+    for pool in list(_pools):
+        pool._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_pools_after_fork)
+
 class DatabaseManager:
     """数据库管理类"""
     
+    # 二进制人脸特征列 (由 migrate_face_encoding.py 创建)
+    BINARY_EMBEDDING_COLUMN = 'face_embedding_bin'
+    # 文本列被单独改写时清空二进制列的触发器 (由 migrate_face_encoding.py 创建)
+    BINARY_INVALIDATION_TRIGGER = 'trg_user_face_invalidate_bin'
+    # 同一用户的其他人脸模板 (float16 多模板格式, 由 migrate_face_encoding.py 创建)
+    TEMPLATES_COLUMN = 'face_templates_bin'
+    # 人脸数据变更日志表 (由 setup_face_change_log.py 创建, 触发器写入)
+    CHANGE_LOG_TABLE = 'face_change_log'
+
     def __init__(self, config=None):
         self.config = config or DatabaseConfig()
+        self.pool = ConnectionPool(self.config)
+        self._has_binary_column = None
+        self._has_templates_column = None
+        self._has_change_log = None
         
     @contextmanager
     def get_connection(self):
-        """获取数据库连接的上下文管理器"""
+        """从连接池借出数据库连接的上下文管理器, 退出时归还 (借出到归还的耗时记入 db 阶段指标)"""
         connection = None
+        broken = False
+        start = time.perf_counter()
         try:
-            connection = pymysql.connect(
-                host=self.config.host,
-                port=self.config.port,
-                user=self.config.user,
-                password=self.config.password,
-                database=self.config.database,
-                charset=self.config.charset,
-                autocommit=True
-            )
+            connection = self.pool.borrow()
             yield connection
         except Exception as e:
             logger.error(f"数据库连接错误: {e}")
+            # 连接层面的错误说明连接已不可用, 不再放回连接池
+            broken = isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+            if connection and not broken:
+                try:
+                    connection.rollback()
+                except Exception:
+                    broken = True
             raise
         finally:
             if connection:
-                connection.close()
+                self.pool.release(connection, broken=broken)
+            observe_stage('db', time.perf_counter() - start)
+
+    def pool_stats(self):
+        """连接池指标 (连接数/空闲数/等待次数等)"""
+        return self.pool.stats()
     
     def test_connection(self):
         """测试数据库连接"""
@@ -59,6 +242,57 @@ class DatabaseManager:
             logger.error(f"数据库连接测试失败: {e}")
             return False
     
+    def has_binary_embedding_column(self, refresh=False):
+        """检查 user_face 表是否已有二进制特征列 (结果会缓存)"""
+        if self._has_binary_column is None or refresh:
+            try:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    sql = """
+                    SELECT COUNT(*) FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'user_face' AND COLUMN_NAME = %s
+                    """
+                    cursor.execute(sql, (self.config.database, self.BINARY_EMBEDDING_COLUMN))
+                    self._has_binary_column = cursor.fetchone()[0] > 0
+            except Exception as e:
+                logger.error(f"检查二进制特征列失败: {e}")
+                return False
+        return self._has_binary_column
+
+    def has_templates_column(self, refresh=False):
+        """检查 user_face 表是否已有多模板列 (结果会缓存)"""
+        if self._has_templates_column is None or refresh:
+            try:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    sql = """
+                    SELECT COUNT(*) FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'user_face' AND COLUMN_NAME = %s
+                    """
+                    cursor.execute(sql, (self.config.database, self.TEMPLATES_COLUMN))
+                    self._has_templates_column = cursor.fetchone()[0] > 0
+            except Exception as e:
+                logger.error(f"检查多模板列失败: {e}")
+                return False
+        return self._has_templates_column
+
+    def has_change_log(self, refresh=False):
+        """检查人脸变更日志表是否存在 (结果会缓存)"""
+        if self._has_change_log is None or refresh:
+            try:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    sql = """
+                    SELECT COUNT(*) FROM information_schema.TABLES
+                    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+                    """
+                    cursor.execute(sql, (self.config.database, self.CHANGE_LOG_TABLE))
+                    self._has_change_log = cursor.fetchone()[0] > 0
+            except Exception as e:
+                logger.error(f"检查人脸变更日志表失败: {e}")
+                return False
+        return self._has_change_log
+
     def get_user_by_phone(self, phone):
         """根据手机号获取用户信息"""
         try:
@@ -112,7 +346,7 @@ class DatabaseManager:
             with self.get_connection() as conn:
                 cursor = conn.cursor(pymysql.cursors.DictCursor)
                 sql = """
-                SELECT u.*, 
+                SELECT u.*, uf.face_id,
                        CASE WHEN uf.user_id IS NOT NULL THEN 1 ELSE 0 END as face_enabled
                 FROM users u 
                 LEFT JOIN user_face uf ON u.id = uf.user_id
@@ -128,12 +362,16 @@ class DatabaseManager:
     def save_user_face_embedding(self, user_id, face_embedding, img_url=None):
         """保存用户人脸特征向量 (支持 face_id 模式)"""
         try:
-            # 将numpy数组转换为JSON字符串
+            # 将numpy数组转换为JSON字符串 (Java 端读取的仍是文本格式)
             if isinstance(face_embedding, np.ndarray):
                 face_embedding_json = json.dumps(face_embedding.tolist())
             else:
                 face_embedding_json = json.dumps(face_embedding)
             
+            # 已迁移的库同时写入二进制特征
+            use_binary = self.has_binary_embedding_column()
+            face_embedding_bin = encode_embedding(face_embedding) if use_binary else None
+
             # 判断 user_id 是否为真实的数字 ID
             is_numeric_id = isinstance(user_id, int) or (isinstance(user_id, str) and user_id.isdigit())
 
@@ -147,11 +385,19 @@ class DatabaseManager:
                     existing_record = cursor.fetchone()
                     
                     if existing_record:
-                        sql = "UPDATE user_face SET face_encoding = %s WHERE user_id = %s"
-                        cursor.execute(sql, (face_embedding_json, user_id))
+                        if use_binary:
+                            sql = f"UPDATE user_face SET face_encoding = %s, {self.BINARY_EMBEDDING_COLUMN} = %s WHERE user_id = %s"
+                            cursor.execute(sql, (face_embedding_json, face_embedding_bin, user_id))
+                        else:
+                            sql = "UPDATE user_face SET face_encoding = %s WHERE user_id = %s"
+                            cursor.execute(sql, (face_embedding_json, user_id))
                     else:
-                        sql = "INSERT INTO user_face (user_id, face_encoding) VALUES (%s, %s)"
-                        cursor.execute(sql, (user_id, face_embedding_json))
+                        if use_binary:
+                            sql = f"INSERT INTO user_face (user_id, face_encoding, {self.BINARY_EMBEDDING_COLUMN}) VALUES (%s, %s, %s)"
+                            cursor.execute(sql, (user_id, face_embedding_json, face_embedding_bin))
+                        else:
+                            sql = "INSERT INTO user_face (user_id, face_encoding) VALUES (%s, %s)"
+                            cursor.execute(sql, (user_id, face_embedding_json))
                 else:
                     # UUID (face_id) 模式逻辑
                     # 这种情况下，Java 会负责在 user_face 表中维护关联关系
@@ -165,20 +411,190 @@ class DatabaseManager:
             logger.error(f"保存人脸特征失败: {e}")
             return False
     
-    def get_all_face_users(self):
-        """获取所有启用人脸识别的用户 (优先读取 face_id 作为标识)"""
+    def get_users_by_ids(self, user_ids):
+        """
+        批量根据数字用户ID获取用户信息, 只查询一次
+        Returns:
+            dict: user_id -> 用户信息 (含 face_enabled)
+        """
+        user_ids = sorted({int(user_id) for user_id in user_ids})
+        if not user_ids:
+            return {}
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor(pymysql.cursors.DictCursor)
-                # 修改查询语句，读取 face_id 和 face_encoding
-                # 如果 face_id 为空，回退使用 username (为了兼容旧数据)
                 sql = """
-                SELECT u.id, u.username, u.phone, u.nickname, uf.face_encoding, uf.face_id
+                SELECT u.*,
+                       CASE WHEN uf.user_id IS NOT NULL THEN 1 ELSE 0 END as face_enabled
                 FROM users u
-                INNER JOIN user_face uf ON u.id = uf.user_id
-                WHERE uf.face_encoding IS NOT NULL AND u.status = 1
+                LEFT JOIN user_face uf ON u.id = uf.user_id
+                WHERE u.id IN %s
                 """
-                cursor.execute(sql)
+                cursor.execute(sql, (user_ids,))
+                return {user['id']: user for user in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"批量查询用户失败: {e}")
+            return {}
+
+    def save_user_face_embeddings(self, items):
+        """
+        批量保存人脸特征, 所有写入在同一个事务中完成 (批量注册/重新编码使用)
+        Args:
+            items: [(user_id, face_id, embedding)]
+                   face_id 不为空时按 face_id 更新已有记录 (Java 创建的关联),
+                   否则按 user_id 更新, 不存在时插入
+        Returns:
+            int: 写入的条数, 失败时抛出异常
+        """
+        if not items:
+            return 0
+        use_binary = self.has_binary_embedding_column()
+        column = f", {self.BINARY_EMBEDDING_COLUMN} = %s" if use_binary else ""
+
+        def values(embedding):
+            text = json.dumps(np.asarray(embedding, dtype=np.float32).tolist())
+            return (text, encode_embedding(embedding)) if use_binary else (text,)
+
+        by_face_id = [values(emb) + (face_id,) for _, face_id, emb in items if face_id]
+        by_user = {int(user_id): emb for user_id, face_id, emb in items if not face_id}
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            conn.begin()
+            existing = set()
+            if by_user:
+                cursor.execute("SELECT user_id FROM user_face WHERE user_id IN %s", (list(by_user),))
+                existing = {row[0] for row in cursor.fetchall()}
+            if by_face_id:
+                cursor.executemany(
+                    f"UPDATE user_face SET face_encoding = %s{column} WHERE face_id = %s", by_face_id
+                )
+            updates = [values(emb) + (user_id,) for user_id, emb in by_user.items() if user_id in existing]
+            if updates:
+                cursor.executemany(
+                    f"UPDATE user_face SET face_encoding = %s{column} WHERE user_id = %s", updates
+                )
+            inserts = [(user_id,) + values(emb) for user_id, emb in by_user.items() if user_id not in existing]
+            if inserts:
+                columns = f", {self.BINARY_EMBEDDING_COLUMN}" if use_binary else ""
+                placeholders = ", %s" if use_binary else ""
+                cursor.executemany(
+                    f"INSERT INTO user_face (user_id, face_encoding{columns}) VALUES (%s, %s{placeholders})", inserts
+                )
+            conn.commit()
+        return len(by_face_id) + len(by_user)
+
+    def save_face_templates(self, user_id, templates, face_id=None):
+        """
+        覆盖保存用户的其他人脸模板 (不含 face_encoding 中的主模板), templates 为空时清空
+        face_id 不为空时按 face_id 定位记录, 否则按 user_id
+        """
+        if not self.has_templates_column():
+            return False
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                where = "face_id = %s" if face_id else "user_id = %s"
+                cursor.execute(
+                    f"UPDATE user_face SET {self.TEMPLATES_COLUMN} = %s WHERE {where}",
+                    (encode_templates(templates) if len(templates) else None, face_id or user_id)
+                )
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"保存人脸模板失败: {e}")
+            return False
+
+    def add_face_template(self, name, user_id, embedding, max_templates, min_distance=None):
+        """
+        为人脸记录追加一个模板, 超过 max_templates (含主模板) 时丢弃最早的模板
+        name 为底库中的人脸标识: face_id, 或旧数据 (face_id 为空) 的用户名
+        min_distance 不为空时, 与已有某个模板的距离小于该值的特征视为重复, 不追加
+        Returns:
+            该记录的全部模板 [K, 128] (第一行为主模板), 记录不存在、特征重复或失败时返回 None
+        """
+        if not self.has_templates_column() or max_templates < 2:
+            return None
+        use_binary = self.has_binary_embedding_column()
+        binary_column = f", {self.BINARY_EMBEDDING_COLUMN}" if use_binary else ""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+                conn.begin()
+                cursor.execute(
+                    f"""
+                    SELECT user_id, face_id, face_encoding{binary_column}, {self.TEMPLATES_COLUMN} AS templates
+                    FROM user_face
+                    WHERE face_id = %s OR (face_id IS NULL AND user_id = %s)
+                    LIMIT 1 FOR UPDATE
+                    """,
+                    (name, user_id)
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    conn.rollback()
+                    return None
+                if use_binary and row.get(self.BINARY_EMBEDDING_COLUMN):
+                    primary = decode_embedding(row[self.BINARY_EMBEDDING_COLUMN])
+                else:
+                    primary, _ = parse_embedding_text(row['face_encoding'])
+                extras = decode_templates(row['templates']) if row['templates'] else np.empty((0, len(primary)), np.float32)
+                embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+                if min_distance is not None:
+                    existing = np.vstack([np.asarray(primary, dtype=np.float32).reshape(1, -1), extras])
+                    if np.min(np.linalg.norm(existing - embedding, axis=1)) < min_distance:
+                        conn.rollback()
+                        return None
+                extras = np.vstack([extras, embedding])[-(max_templates - 1):]
+
+                where = "face_id = %s" if row['face_id'] else "user_id = %s AND face_id IS NULL"
+                cursor.execute(
+                    f"UPDATE user_face SET {self.TEMPLATES_COLUMN} = %s WHERE {where}",
+                    (encode_templates(extras), row['face_id'] or row['user_id'])
+                )
+                conn.commit()
+                return np.vstack([np.asarray(primary, dtype=np.float32).reshape(1, -1), extras])
+        except Exception as e:
+            logger.error(f"追加人脸模板失败: {e}")
+            return None
+
+    def get_all_face_users(self, user_ids=None, strict=False):
+        """
+        获取所有启用人脸识别的用户 (优先读取 face_id 作为标识)
+        user_ids 不为空时只查询这些用户 (增量同步底库时使用)
+        strict 为 True 时查询失败直接抛出异常, 而不是返回空列表
+        """
+        if user_ids is not None:
+            user_ids = [int(user_id) for user_id in user_ids]
+            if not user_ids:
+                return []
+        user_filter = "AND u.id IN %s" if user_ids is not None else ""
+        params = (user_ids,) if user_ids is not None else None
+        try:
+            use_binary = self.has_binary_embedding_column()
+            templates_column = f", uf.{self.TEMPLATES_COLUMN} AS face_templates_bin" if self.has_templates_column() else ""
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+                # 修改查询语句，读取 face_id 和 face_encoding
+                # 如果 face_id 为空，回退使用 username (为了兼容旧数据)
+                if use_binary:
+                    sql = f"""
+                    SELECT u.id, u.username, u.username AS account_username, u.phone, u.nickname,
+                           u.avatar, u.role, u.balance, u.created_at, uf.face_encoding, uf.face_id,
+                           uf.{self.BINARY_EMBEDDING_COLUMN} AS face_embedding_bin{templates_column}
+                    FROM users u
+                    INNER JOIN user_face uf ON u.id = uf.user_id
+                    WHERE (uf.face_encoding IS NOT NULL OR uf.{self.BINARY_EMBEDDING_COLUMN} IS NOT NULL)
+                      AND u.status = 1 {user_filter}
+                    """
+                else:
+                    sql = f"""
+                    SELECT u.id, u.username, u.username AS account_username, u.phone, u.nickname,
+                           u.avatar, u.role, u.balance, u.created_at, uf.face_encoding, uf.face_id{templates_column}
+                    FROM users u
+                    INNER JOIN user_face uf ON u.id = uf.user_id
+                    WHERE uf.face_encoding IS NOT NULL AND u.status = 1 {user_filter}
+                    """
+                cursor.execute(sql, params)
                 users = cursor.fetchall()
                 
                 # 将标识符注入到 username 字段中，供识别服务使用
@@ -186,47 +602,113 @@ class DatabaseManager:
                     if user.get('face_id'):
                         user['username'] = user['face_id']
                 
-                # 将JSON字符串转换回numpy数组
+                # 解码人脸特征: 优先使用二进制列 (零拷贝)，否则回退到JSON文本
                 for user in users:
+                    user['face_templates'] = None
+                    if user.get('face_templates_bin'):
+                        try:
+                            user['face_templates'] = decode_templates(user['face_templates_bin'])
+                        except EmbeddingFormatError as e:
+                            logger.warning(f"用户 {user['username']} 的人脸模板数据损坏: {e}")
+
+                    user['face_embedding'] = None
+                    if user.get('face_embedding_bin'):
+                        try:
+                            user['face_embedding'] = decode_embedding(user['face_embedding_bin'])
+                            continue
+                        except EmbeddingFormatError as e:
+                            logger.warning(f"用户 {user['username']} 的二进制人脸数据损坏: {e}")
+
                     if user['face_encoding']:
                         try:
-                            face_data = json.loads(user['face_encoding'])
-                            user['face_embedding'] = np.array(face_data)
-                        except Exception as e:
+                            user['face_embedding'], repaired = parse_embedding_text(user['face_encoding'])
+                            if repaired:
+                                logger.info(f"已自动修复用户 {user['username']} 的人脸数据 (建议运行 migrate_face_encoding.py)")
+                        except EmbeddingFormatError as e:
                             logger.warning(f"用户 {user['username']} 的人脸数据格式错误: {e}")
                             logger.warning(f"错误数据片段: {str(user['face_encoding'])[:200]}")
-                            
-                            # 尝试修复数据
-                            try:
-                                # 情况1: 标准JSON但有额外数据 (如重复追加)
-                                if "Extra data" in str(e) and user['face_encoding'].strip().startswith('['):
-                                    end_idx = user['face_encoding'].find(']')
-                                    if end_idx != -1:
-                                        fixed_json = user['face_encoding'][:end_idx+1]
-                                        face_data = json.loads(fixed_json)
-                                        if isinstance(face_data, list) and len(face_data) > 100:
-                                            user['face_embedding'] = np.array(face_data)
-                                            logger.info(f"已自动修复用户 {user['username']} 的人脸数据 (截断修复)")
-                                            continue
-                                
-                                # 情况2: 纯逗号分隔的字符串 (无方括号)
-                                if ',' in user['face_encoding'] and not user['face_encoding'].strip().startswith('['):
-                                    # 尝试按逗号分割并转换为浮点数
-                                    face_data = [float(x.strip()) for x in user['face_encoding'].split(',') if x.strip()]
-                                    if len(face_data) > 100:
-                                        user['face_embedding'] = np.array(face_data)
-                                        logger.info(f"已自动修复用户 {user['username']} 的人脸数据 (CSV格式)")
-                                        continue
-                            except Exception as fix_error:
-                                logger.warning(f"尝试修复数据失败: {fix_error}")
-                                
-                            user['face_embedding'] = None
                 
                 return users
         except Exception as e:
             logger.error(f"获取人脸用户失败: {e}")
+            if strict:
+                raise
             return []
     
+    def count_face_users(self):
+        """启用人脸识别的记录数 (只计数, 不读取特征), 用于深度健康检查"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            sql = """
+            SELECT COUNT(*) FROM users u
+            INNER JOIN user_face uf ON u.id = uf.user_id
+            WHERE u.status = 1
+            """
+            cursor.execute(sql)
+            return int(cursor.fetchone()[0])
+
+    def get_face_changes(self, after_id, limit=1000):
+        """
+        读取变更日志中 id 大于 after_id 的记录 (按 id 升序)
+        Returns:
+            list: [{'id', 'user_id', 'face_id', 'op'}], 表不存在或查询失败时返回 None
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+                sql = f"""
+                SELECT id, user_id, face_id, op FROM {self.CHANGE_LOG_TABLE}
+                WHERE id > %s ORDER BY id LIMIT %s
+                """
+                cursor.execute(sql, (after_id, limit))
+                return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"读取人脸变更日志失败: {e}")
+            return None
+
+    def get_max_change_id(self):
+        """变更日志当前的最大 id (空表为0), 查询失败时返回 None"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT IFNULL(MAX(id), 0) FROM {self.CHANGE_LOG_TABLE}")
+                return int(cursor.fetchone()[0])
+        except Exception as e:
+            logger.error(f"读取人脸变更日志水位失败: {e}")
+            return None
+
+    def get_users_by_face_names(self, names):
+        """
+        批量根据人脸标识 (face_id 或旧数据中的 username) 获取用户信息, 只查询一次
+        Returns:
+            dict: 人脸标识 -> 用户信息
+        """
+        names = [str(name) for name in names]
+        if not names:
+            return {}
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+                sql = """
+                SELECT u.*, uf.face_id,
+                       CASE WHEN uf.user_id IS NOT NULL THEN 1 ELSE 0 END as face_enabled
+                FROM users u
+                LEFT JOIN user_face uf ON u.id = uf.user_id
+                WHERE uf.face_id IN %s OR u.username IN %s
+                """
+                cursor.execute(sql, (names, names))
+                users = {}
+                for user in cursor.fetchall():
+                    # face_id 优先于 username (与原先的查找顺序一致)
+                    if user.get('face_id') in names:
+                        users[user['face_id']] = user
+                    if user['username'] in names:
+                        users.setdefault(user['username'], user)
+                return users
+        except Exception as e:
+            logger.error(f"批量查询用户失败: {e}")
+            return {}
+
     def disable_user_face(self, user_id):
         """禁用用户人脸识别(删除人脸数据)"""
         try:
@@ -0,0 +1,124 @@
+import json
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#-------------------------------------------------------#
+#   人脸特征二进制格式 (小端)
+#   [0]     版本号  uint8
+#   [1]     保留    uint8
+#   [2:4]   维度    uint16
+#   [4:8]   CRC32   uint32 (对特征数据部分计算)
+#   [8:]    特征    float32 * 维度
+#   8 字节头部保证特征数据按 4 字节对齐, 可直接 np.frombuffer
+#
+#   多模板格式 (版本2): 同一个人的多张人脸特征, float16 存储
+#   [0]     版本号  uint8 (=2)
+#   [1]     模板数  uint8
+#   [2:4]   维度    uint16
+#   [4:8]   CRC32   uint32
+#   [8:]    特征    float16 * 模板数 * 维度
+#-------------------------------------------------------#
+EMBEDDING_FORMAT_VERSION = 1
+TEMPLATES_FORMAT_VERSION = 2
+MAX_TEMPLATES = 255
+HEADER = struct.Struct('<BBHI')
+HEADER_SIZE = HEADER.size
+
+
+class EmbeddingFormatError(ValueError):
+    """人脸特征数据格式错误"""
+
+
+def encode_embedding(embedding):
+    """将人脸特征编码为二进制 (float32 小端 + 版本号 + 校验和)"""
+    payload = np.ascontiguousarray(np.asarray(embedding, dtype='<f4').reshape(-1)).tobytes()
+    dim = len(payload) // 4
+    header = HEADER.pack(EMBEDDING_FORMAT_VERSION, 0, dim, zlib.crc32(payload) & 0xffffffff)
+    return header + payload
+
+
+def decode_embedding(blob, verify=True):
+    """
+    解码二进制人脸特征
+    返回直接引用 blob 内存的只读 float32 数组, 不发生拷贝
+    """
+    if blob is None or len(blob) < HEADER_SIZE:
+        raise EmbeddingFormatError("人脸特征数据长度不足")
+    version, _, dim, checksum = HEADER.unpack_from(blob, 0)
+    if version != EMBEDDING_FORMAT_VERSION:
+        raise EmbeddingFormatError(f"不支持的人脸特征版本: {version}")
+    if len(blob) != HEADER_SIZE + dim * 4:
+        raise EmbeddingFormatError(f"人脸特征长度与维度不符: {len(blob)} != {HEADER_SIZE + dim * 4}")
+    if verify and zlib.crc32(memoryview(blob)[HEADER_SIZE:]) & 0xffffffff != checksum:
+        raise EmbeddingFormatError("人脸特征校验和不匹配")
+    return np.frombuffer(blob, dtype='<f4', count=dim, offset=HEADER_SIZE)
+
+
+def encode_templates(templates):
+    """将多个人脸特征 [K, dim] 编码为 float16 二进制, K 为0时返回 None"""
+    templates = np.asarray(templates, dtype='<f4')
+    if templates.size == 0:
+        return None
+    templates = templates.reshape(len(templates), -1)
+    if len(templates) > MAX_TEMPLATES:
+        raise EmbeddingFormatError(f"模板数量超过上限: {len(templates)} > {MAX_TEMPLATES}")
+    payload = np.ascontiguousarray(templates.astype('<f2')).tobytes()
+    header = HEADER.pack(TEMPLATES_FORMAT_VERSION, len(templates), templates.shape[1],
+                         zlib.crc32(payload) & 0xffffffff)
+    return header + payload
+
+
+def decode_templates(blob, verify=True):
+    """解码多模板二进制, 返回 float32 数组 [K, dim]"""
+    if blob is None or len(blob) < HEADER_SIZE:
+        raise EmbeddingFormatError("人脸模板数据长度不足")
+    version, count, dim, checksum = HEADER.unpack_from(blob, 0)
+    if version != TEMPLATES_FORMAT_VERSION:
+        raise EmbeddingFormatError(f"不支持的人脸模板版本: {version}")
+    if len(blob) != HEADER_SIZE + count * dim * 2:
+        raise EmbeddingFormatError(f"人脸模板长度与维度不符: {len(blob)} != {HEADER_SIZE + count * dim * 2}")
+    if verify and zlib.crc32(memoryview(blob)[HEADER_SIZE:]) & 0xffffffff != checksum:
+        raise EmbeddingFormatError("人脸模板校验和不匹配")
+    templates = np.frombuffer(blob, dtype='<f2', count=count * dim, offset=HEADER_SIZE)
+    return templates.astype(np.float32).reshape(count, dim)
+
+
+def parse_embedding_text(text, min_dim=100):
+    """
+    解析文本格式 (JSON数组) 的人脸特征
+    兼容两种历史遗留的错误格式:
+        1. 标准JSON但有额外数据 (如重复追加)
+        2. 纯逗号分隔的字符串 (无方括号)
+    Returns:
+        (embedding, repaired): 解析结果和是否经过修复; 无法解析时抛出 EmbeddingFormatError
+    """
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode('utf-8')
+    try:
+        return np.array(json.loads(text), dtype=np.float64), False
+    except Exception as e:
+        stripped = text.strip()
+
+        # 情况1: 标准JSON但有额外数据
+        if "Extra data" in str(e) and stripped.startswith('['):
+            end_idx = stripped.find(']')
+            if end_idx != -1:
+                face_data = json.loads(stripped[:end_idx + 1])
+                if isinstance(face_data, list) and len(face_data) > min_dim:
+                    return np.array(face_data, dtype=np.float64), True
+
+        # 情况2: 纯逗号分隔的字符串
+        if ',' in stripped and not stripped.startswith('['):
+            try:
+                face_data = [float(x.strip()) for x in stripped.split(',') if x.strip()]
+            except ValueError as fix_error:
+                raise EmbeddingFormatError(f"无法解析的人脸特征: {fix_error}")
+            if len(face_data) > min_dim:
+                return np.array(face_data, dtype=np.float64), True
+
+        raise EmbeddingFormatError(f"无法解析的人脸特征: {e}")
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 128
+CACHE_VERSION = 1
+
+#-------------------------------------------------------#
+#   face_dataset 人脸特征的持久化缓存
+#   <name>.npy  : float32 特征矩阵 [N, 128], 加载时内存映射
+#   <name>.json : 元数据, 图片路径 -> (mtime, size, 行号)
+#   模型权重的哈希 (含预处理版本) 写入元数据, 权重或人脸对齐方式变化时整体失效
+#-------------------------------------------------------#
+
+
+def weights_fingerprint(paths, chunk_size=1 << 20, salt=None):
+    """计算模型权重文件的内容哈希, salt 为预处理版本等影响特征的其他标识"""
+    digest = hashlib.sha1()
+    if salt is not None:
+        digest.update(str(salt).encode('utf-8'))
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8'))
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EncodingCache:
+    """
+    以 (文件名, mtime, 文件大小) 为键缓存每张图片的人脸特征
+    未检测到人脸的图片同样记录 (行号为 -1), 避免每次启动重复检测
+    """
+
+    def __init__(self, directory, fingerprint, name='.encoding_cache'):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.matrix_path = os.path.join(directory, name + '.npy')
+        self.meta_path = os.path.join(directory, name + '.json')
+        self._entries = {}   # 文件名 -> {'mtime', 'size', 'row'}
+        self._matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """读取缓存, 权重哈希或版本不一致时视为空缓存"""
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.matrix_path)):
+            return False
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != CACHE_VERSION or meta.get('fingerprint') != self.fingerprint:
+                logger.info("模型权重或缓存版本已变化, 人脸特征缓存失效")
+                return False
+            matrix = np.load(self.matrix_path, mmap_mode='r')
+            # 行数不一致说明上次写入中断, 整体重建
+            if matrix.ndim != 2 or matrix.shape != (meta.get('rows'), EMBEDDING_DIM):
+                return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"人脸特征缓存读取失败, 将重新编码: {e}")
+            return False
+        self._entries = meta.get('entries', {})
+        self._matrix = matrix
+        return True
+
+    def partition(self, files):
+        """
+        将图片分为命中缓存和需要重新编码两部分
+        Args:
+            files: [(文件名, mtime, size)]
+        Returns:
+            hits:   {文件名: 行号}
+            misses: [文件名]
+        """
+        hits, misses = {}, []
+        for filename, mtime, size in files:
+            entry = self._entries.get(filename)
+            if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+                hits[filename] = entry['row']
+            else:
+                misses.append(filename)
+        return hits, misses
+
+    def rebuild(self, files, hits, encodings):
+        """
+        用命中的旧特征和新编码的特征重写缓存, 并重新内存映射
+        Args:
+            files:     [(文件名, mtime, size)], 当前目录中的全部图片
+            hits:      partition 返回的 {文件名: 行号}
+            encodings: {文件名: 128维特征 或 None (未检测到人脸)}
+        """
+        entries, rows = {}, []
+        for filename, mtime, size in files:
+            if filename in hits:
+                old_row = hits[filename]
+                vector = self._matrix[old_row] if old_row >= 0 else None
+            else:
+                vector = encodings.get(filename)
+            row = -1
+            if vector is not None:
+                row = len(rows)
+                rows.append(np.asarray(vector, dtype=np.float32).reshape(EMBEDDING_DIM))
+            entries[filename] = {'mtime': mtime, 'size': size, 'row': row}
+
+        matrix = np.stack(rows) if rows else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        #-----------------------------------------------#
+        #   先释放旧的内存映射, 再用临时文件原子替换
+        #-----------------------------------------------#
+        self._matrix = None
+        self._save(matrix, entries)
+        self._entries = entries
+        self._matrix = np.load(self.matrix_path, mmap_mode='r')
+
+    def vectors(self, rows):
+        """按行号取出特征 (内存映射上的视图)"""
+        return [self._matrix[row] for row in rows]
+
+    def _save(self, matrix, entries):
+        tmp_matrix = self.matrix_path + '.tmp'
+        tmp_meta = self.meta_path + '.tmp'
+        with open(tmp_matrix, 'wb') as f:
+            np.save(f, matrix)
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': CACHE_VERSION,
+                'fingerprint': self.fingerprint,
+                'rows': len(matrix),
+                'entries': entries,
+            }, f)
+        os.replace(tmp_matrix, self.matrix_path)
+        os.replace(tmp_meta, self.meta_path)
@@ -0,0 +1,133 @@
+import numpy as np
+
+import utils.utils as utils
+from face_gallery import _to_user_id
+
+#-------------------------------------------------------#
+#   注册查重
+#   保存人脸特征前, 在内存底库中查找距离不超过 max_distance 的其他账号的人脸,
+#   同一张脸注册到多个账号时 (刷单/冒用) 在注册时就能发现, 无需定期 O(N^2) 全量比对
+#   策略:
+#       reject  有冲突时拒绝注册, 返回冲突列表
+#       warn    照常注册, 在结果中附带冲突列表
+#       off     不检查
+#-------------------------------------------------------#
+POLICIES = ('reject', 'warn', 'off')
+DEFAULT_POLICY = 'reject'
+# 同一人的不同照片距离一般在 0.6 以内, 登录的匹配阈值为 0.8
+DEFAULT_DISTANCE = 0.6
+DEFAULT_NEIGHBORS = 5
+
+
+def resolve_owner(user_id, account_id=None, db_manager=None):
+    """
+    注册请求对应的数字账号ID, 查重时排除该账号已有的人脸
+    Java 端注册时 user_id 为本次新生成的 faceId (UUID), 数字账号ID 在 account_id 中;
+    都不是数字时按 faceId 查 user_face (同一 faceId 重新注册), 仍无法确定时返回 None
+    """
+    for value in (user_id, account_id):
+        owner = _to_user_id(value)
+        if owner >= 0:
+            return owner
+    if db_manager is not None and user_id is not None:
+        user = db_manager.get_users_by_face_names([user_id]).get(str(user_id))
+        if user:
+            return _to_user_id(user['id'])
+    return None
+
+
+def find_conflicts(gallery, encodings, user_ids, max_distance=DEFAULT_DISTANCE, k=DEFAULT_NEIGHBORS,
+                   db_manager=None, within_batch=False):
+    """
+    批量查找与其他账号重复的人脸, 整批查询一次检索
+    Args:
+        gallery: 人脸底库 (FaceGallery / GallerySnapshot), 为空时只做批内比对
+        encodings: 待注册的特征 [N, 128]
+        user_ids: 与 encodings 一一对应的注册用户ID, 该用户自己的人脸不算冲突
+        db_manager: 不为空时, 底库中没有用户ID的条目 (Java 注册的 face_id) 批量查库补全
+        within_batch: 为True时同一批中不同用户的人脸也互相比对 (批量导入)
+    Returns:
+        list: 与 encodings 一一对应, 每项为按距离升序的冲突列表
+              [{'user_id', 'name', 'distance', 'source'}], source 为 gallery / batch,
+              batch 冲突另有 index (同批中另一张人脸的下标); 每项最多 k 个 gallery 冲突
+    """
+    queries = np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1)
+    owners = [_to_user_id(user_id) for user_id in user_ids]
+    conflicts = [[] for _ in owners]
+    if len(queries) == 0:
+        return conflicts
+
+    snapshot = gallery.snapshot() if gallery is not None else None
+    if snapshot is not None and len(snapshot) > 0:
+        #-----------------------------------------------#
+        #   本人已有的条目 (重新注册时) 会占用近邻名额,
+        #   按其条目数多取, 过滤掉后仍有 k 个其他账号的候选
+        #-----------------------------------------------#
+        own = max(len(snapshot.user_entries.get(owner, ())) for owner in owners)
+        unresolved = []
+        for i, hits in enumerate(snapshot.search(queries, k + own)):
+            for name, user_id, distance in hits:
+                if distance > max_distance or (user_id is not None and user_id == owners[i]):
+                    continue
+                conflicts[i].append({'user_id': user_id, 'name': name, 'distance': float(distance), 'source': 'gallery'})
+                if user_id is None:
+                    unresolved.append(name)
+        if unresolved and db_manager is not None:
+            users = db_manager.get_users_by_face_names(unresolved)
+            for i, items in enumerate(conflicts):
+                for item in items:
+                    user = users.get(item['name'])
+                    if item['user_id'] is None and user:
+                        item['user_id'] = user['id']
+                conflicts[i] = [item for item in items if item['user_id'] != owners[i]]
+        conflicts = [items[:k] for items in conflicts]
+
+    if within_batch and len(queries) > 1:
+        distances, indices = utils.face_top_k(queries, queries, min(k + 1, len(queries)))
+        for i, (row_dist, row_ids) in enumerate(zip(distances.tolist(), indices.tolist())):
+            for distance, j in zip(row_dist, row_ids):
+                if j < 0 or j == i or distance > max_distance or owners[j] == owners[i]:
+                    continue
+                conflicts[i].append({
+                    'user_id': owners[j], 'name': None, 'distance': float(distance), 'source': 'batch', 'index': j
+                })
+
+    for items in conflicts:
+        items.sort(key=lambda item: item['distance'])
+    return conflicts
+
+
+def rejected_items(conflicts):
+    """
+    reject 策略下需要拒绝的下标: 与底库冲突的全部拒绝;
+    同批内的一对冲突只拒绝靠后的一张, 且只在靠前的那张未被拒绝时才拒绝
+    """
+    rejected = set()
+    for i, items in enumerate(conflicts):
+        for item in items:
+            if item['source'] != 'batch' or (item['index'] < i and item['index'] not in rejected):
+                rejected.add(i)
+                break
+    return rejected
+
+
+def merge_conflicts(conflict_lists):
+    """合并多张照片的冲突, 每个账号只保留距离最小的一条"""
+    merged = {}
+    for items in conflict_lists:
+        for item in items:
+            key = item['user_id'] if item['user_id'] is not None else item['name']
+            if key not in merged or item['distance'] < merged[key]['distance']:
+                merged[key] = item
+    return sorted(merged.values(), key=lambda item: item['distance'])
+
+
+def describe(conflicts, limit=3):
+    """冲突的简短描述, 用于日志和批量注册报告"""
+    text = ', '.join(
+        f"用户 {item['user_id'] if item['user_id'] is not None else item['name']} (距离 {item['distance']:.3f})"
+        for item in conflicts[:limit]
+    )
+    if len(conflicts) > limit:
+        text += f" 等 {len(conflicts)} 个"
+    return text
@@ -0,0 +1,135 @@
+"""
+将 keras 模型 (Pnet / Rnet / Onet / facenet) 导出为 ONNX, 供 onnxruntime 后端使用
+导出后对比 keras 与 onnxruntime 在相同输入上的输出, 超出容差时返回非0退出码
+
+用法:
+    pip install tf2onnx onnxruntime
+    python export_onnx.py                 # 导出全部模型并做数值对比
+    python export_onnx.py --quantize      # 另外导出 int8 动态量化的 facenet
+    python export_onnx.py --check-only    # 只做数值对比
+
+启用: FACE_BACKEND=onnx python api_server_db.py  (量化模型再加 FACE_FACENET_INT8=1)
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from onnx_backend import OnnxModel, model_path
+from utils import utils
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_data')
+OPSET = 13
+
+#-----------------------------------------------#
+#   各网络的输入形状, None 为动态维度
+#-----------------------------------------------#
+INPUT_SHAPES = {
+    'pnet': (None, None, None, 3),
+    'rnet': (None, 24, 24, 3),
+    'onet': (None, 48, 48, 3),
+    'facenet': (None, 160, 160, 3),
+}
+
+
+def load_keras_models():
+    from net.inception import InceptionResNetV1
+    from net.mtcnn import create_Onet, create_Pnet, create_Rnet
+
+    facenet = InceptionResNetV1()
+    facenet.load_weights(os.path.join(MODEL_DIR, 'facenet_keras.h5'))
+    return {
+        'pnet': create_Pnet(os.path.join(MODEL_DIR, 'pnet.h5')),
+        'rnet': create_Rnet(os.path.join(MODEL_DIR, 'rnet.h5')),
+        'onet': create_Onet(os.path.join(MODEL_DIR, 'onet.h5')),
+        'facenet': facenet,
+    }
+
+
+def export(models):
+    import tensorflow as tf
+    import tf2onnx
+
+    for key, model in models.items():
+        path = model_path(MODEL_DIR, key)
+        spec = [tf.TensorSpec(INPUT_SHAPES[key], tf.float32, name='input')]
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=OPSET, output_path=path)
+        print(f"✅ 已导出 {key} -> {path}")
+
+
+def quantize_facenet():
+    """facenet 的卷积和全连接权重做 int8 动态量化, 激活值在推理时动态量化"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    src = model_path(MODEL_DIR, 'facenet')
+    dst = model_path(MODEL_DIR, 'facenet_int8')
+    quantize_dynamic(src, dst, op_types_to_quantize=['Conv', 'MatMul'], weight_type=QuantType.QInt8)
+    print(f"✅ 已导出 int8 facenet -> {dst} ({os.path.getsize(src) >> 20}MB -> {os.path.getsize(dst) >> 20}MB)")
+
+
+def sample_inputs(seed=0):
+    """与线上一致的输入: mtcnn 为 (x-127.5)/127.5, facenet 为标准化后的人脸"""
+    rng = np.random.default_rng(seed)
+
+    def images(shape):
+        return rng.integers(0, 256, size=shape).astype(np.float32)
+
+    return {
+        'pnet': (images((1, 240, 320, 3)) - 127.5) / 127.5,
+        'rnet': (images((16, 24, 24, 3)) - 127.5) / 127.5,
+        'onet': (images((8, 48, 48, 3)) - 127.5) / 127.5,
+        'facenet': utils.pre_process(images((8, 160, 160, 3))),
+    }
+
+
+def check_parity(models, atol=1e-4, quantized_min_cosine=0.99):
+    """
+    数值对比
+        float32 模型: 各输出的最大绝对误差不超过 atol
+        int8 facenet: 归一化后的特征与 keras 的余弦相似度不低于 quantized_min_cosine
+    """
+    inputs = sample_inputs()
+    passed = True
+    for key, model in models.items():
+        expected = model.predict(inputs[key], verbose=0)
+        actual = OnnxModel(model_path(MODEL_DIR, key)).predict(inputs[key])
+        if not isinstance(expected, list):
+            expected, actual = [expected], [actual]
+        max_diff = max(float(np.max(np.abs(e - a))) for e, a in zip(expected, actual))
+        ok = max_diff <= atol
+        passed &= ok
+        print(f"{'✅' if ok else '❌'} {key}: 最大绝对误差 {max_diff:.2e} (容差 {atol:.0e})")
+
+    int8_path = model_path(MODEL_DIR, 'facenet_int8')
+    if os.path.exists(int8_path):
+        expected = utils.l2_normalize(models['facenet'].predict(inputs['facenet'], verbose=0))
+        actual = utils.l2_normalize(OnnxModel(int8_path).predict(inputs['facenet']))
+        min_cosine = float(np.min(np.sum(expected * actual, axis=1)))
+        ok = min_cosine >= quantized_min_cosine
+        passed &= ok
+        print(f"{'✅' if ok else '❌'} facenet_int8: 最小余弦相似度 {min_cosine:.4f} (下限 {quantized_min_cosine})")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出 ONNX 模型并与 keras 做数值对比")
+    parser.add_argument('--quantize', action='store_true', help="额外导出 int8 动态量化的 facenet")
+    parser.add_argument('--check-only', action='store_true', help="只做数值对比, 不重新导出")
+    parser.add_argument('--atol', type=float, default=1e-4, help="float32 模型的最大绝对误差")
+    args = parser.parse_args()
+
+    models = load_keras_models()
+    if not args.check_only:
+        export(models)
+        if args.quantize:
+            quantize_facenet()
+
+    if not check_parity(models, atol=args.atol):
+        print("❌ ONNX 与 keras 输出不一致")
+        sys.exit(1)
+    print("✅ 数值对比通过")
+
+
+if __name__ == '__main__':
+    main()
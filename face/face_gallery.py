@@ -0,0 +1,615 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from gallery_index import LayeredIndex, create_index
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 128
+
+#-----------------------------------------------#
+#   登录接口返回所需的用户字段,
+#   加载底库时一并缓存, 匹配成功后无需再查库
+#-----------------------------------------------#
+PROFILE_FIELDS = ('id', 'username', 'phone', 'nickname', 'avatar', 'role', 'balance', 'created_at')
+
+
+class GallerySnapshot:
+    """
+    某一版本的人脸底库, 发布后不再修改
+    请求线程拿到快照的引用后即可无锁检索, 不受并发的注册/删除影响
+    """
+
+    def __init__(self, version, index, entries, name_to_entry, profiles, next_id, templates=None, prefilter=16,
+                 user_entries=None):
+        self.version = version
+        self.published_at = time.time()
+        self.index = index if isinstance(index, LayeredIndex) else LayeredIndex(index)
+        self.entries = _layered(entries)              # 条目ID -> (name, user_id)
+        self.name_to_entry = _layered(name_to_entry)  # name -> 条目ID
+        self.profiles = _layered(profiles)            # user_id -> 用户信息快照
+        self.next_id = next_id
+        self.templates = _layered(templates)          # 条目ID -> 多模板矩阵 [K, 128] (只保存 K >= 2 的条目)
+        self.prefilter = prefilter                    # 有多模板条目时, 中心向量粗筛的候选数
+        # user_id -> 条目ID 元组 (只保存有数字ID的条目), 按用户删除时无需遍历全部条目
+        self.user_entries = _layered(user_entries if user_entries is not None else _group_by_user(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pending_changes(self):
+        """尚未合并进基础索引/基础字典的改动数"""
+        return max(
+            self.index.pending_changes(), self.entries.pending_changes(), self.name_to_entry.pending_changes(),
+            self.profiles.pending_changes(), self.templates.pending_changes(), self.user_entries.pending_changes()
+        )
+
+    def snapshot(self):
+        return self
+
+    def search(self, face_encodings, k=1):
+        """
+        批量查询距离最近的 k 个人脸
+        索引中每个人只有一个向量 (多模板时为中心向量); 存在多模板条目时分两步:
+            1. 在索引中取中心向量最近的 max(k, prefilter) 个候选
+            2. 多模板候选的距离改为到其各个模板的最小距离, 重新排序后取前 k 个
+        中心向量没有进入第 1 步的候选时 (有 max(k, prefilter) 个其他人的中心向量比它更近), 该条目会漏检;
+        登录补充的模板与已有模板的距离不超过 0.55, 中心向量与各模板都较近, 实际很少发生
+        Returns:
+            list: 每个查询一个列表, 元素为 (name, user_id, distance)
+        """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        templates = self.templates
+        distances, entry_ids = self.index.search(queries, max(k, self.prefilter) if templates else k)
+
+        results = []
+        for query, row_dist, row_ids in zip(queries, distances, entry_ids):
+            hits = []
+            for distance, entry_id in zip(row_dist.tolist(), row_ids.tolist()):
+                if entry_id < 0 or entry_id not in self.entries:
+                    continue
+                if entry_id in templates:
+                    distance = float(np.sqrt(np.min(np.sum((templates[entry_id] - query) ** 2, axis=1))))
+                name, user_id = self.entries[entry_id]
+                hits.append((name, user_id if user_id >= 0 else None, distance))
+            if templates:
+                hits.sort(key=lambda hit: hit[2])
+                del hits[k:]
+            results.append(hits)
+        return results
+
+    def match(self, face_encoding, tolerance=0.8):
+        """
+        在底库中查找距离最近的人脸
+        Returns:
+            (name, user_id, distance); 未匹配时 name 为 None
+        """
+        hits = self.search(face_encoding, k=1)[0]
+        if not hits:
+            return None, None, None
+        name, user_id, distance = hits[0]
+        if distance > tolerance:
+            return None, None, distance
+        return name, user_id, distance
+
+    def get_profile(self, user_id):
+        """返回用户信息快照的副本, 没有缓存时返回 None"""
+        profile = self.profiles.get(_to_user_id(user_id))
+        return dict(profile) if profile is not None else None
+
+    def template_count(self, name):
+        """name 对应条目的模板数, 不存在时返回 0"""
+        entry_id = self.name_to_entry.get(name)
+        if entry_id is None:
+            return 0
+        templates = self.templates.get(entry_id)
+        return 1 if templates is None else len(templates)
+
+
+class FaceGallery:
+    """
+    常驻内存的人脸底库
+    特征向量保存在可插拔的检索索引中 (见 gallery_index, 默认为连续 float32 矩阵的暴力检索),
+    每条特征对应一个内部条目ID, 条目ID -> (name, user_id) 的元数据保存在字典中,
+    另外按 user_id 缓存一份用户信息快照, 用于登录时直接生成 token。
+    服务启动时从数据库加载一次, 之后由注册/禁用/删除接口增量维护,
+    其他节点 (如 Java 后端) 的变更由 gallery_sync 轮询变更日志后批量应用。
+
+    多模板: 同一个人可以有多张人脸特征 (多角度注册/登录时补充), 索引中只放
+    归一化的中心向量, 检索时先按中心向量粗筛 centroid_candidates 个候选,
+    再与候选的全部模板精确比对 (见 GallerySnapshot.search)。
+
+    读写分离 (写时复制):
+        读: snapshot() 返回当前版本的 GallerySnapshot, 无需加锁
+        写: 在写锁内生成当前版本的副本 (_Draft), 修改副本后整体替换, 版本号加一
+    副本不复制整个索引和字典: 各版本共享只读的基础索引/基础字典, 只复制尚未合并的增量
+    (见 LayeredIndex / _LayeredDict), 单条写入的代价与底库规模无关。
+    增量超过 compact_threshold 条时由写入方合并, 否则由 gallery_sync 的后台线程
+    在增量存在超过 compact_interval 秒后调用 compact() 合并。
+    """
+
+    def __init__(self, index_type='exact', centroid_candidates=16, compact_threshold=1024, compact_interval=60.0,
+                 **index_options):
+        self._write_lock = threading.Lock()
+        # 合并会向新旧版本共用的 float32 存储 (VectorStore) 追加数据, 所有合并都在这把锁内串行执行;
+        # 加锁顺序只能是 写锁 -> 合并锁, 后台合并不会在持有合并锁时等待写锁
+        self._compact_lock = threading.Lock()
+        self.index_type = index_type
+        self.centroid_candidates = centroid_candidates
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+        self._index_options = index_options
+        self._snapshot = GallerySnapshot(0, self._new_index(), {}, {}, {}, 0, prefilter=centroid_candidates)
+        self._dirty_since = None    # 最早一次未合并写入的时间 (monotonic)
+        self.last_full_load = None
+        self.last_compaction = None
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def snapshot(self):
+        """当前版本的底库快照, 一次请求内应只获取一次"""
+        return self._snapshot
+
+    def _new_index(self):
+        return create_index(self.index_type, EMBEDDING_DIM, **self._index_options)
+
+    def _publish(self, draft):
+        """发布新版本 (调用方需持有写锁), 引用赋值对读线程是原子的; 增量过多时先合并"""
+        if draft.pending_changes() >= self.compact_threshold:
+            with self._compact_lock:
+                draft.compact()
+        self._snapshot = draft.freeze(self._snapshot.version + 1, self.centroid_candidates)
+        if draft.pending_changes() == 0:
+            self._dirty_since = None
+        elif self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+
+    #-----------------------------------------------#
+    #   从数据库整体加载
+    #-----------------------------------------------#
+    def load_from_db(self, db_manager, strict=False):
+        """
+        从数据库全量加载人脸底库, 返回加载的条数
+        strict 为 True 时查询失败抛出异常并保留当前版本 (不会发布空底库)
+        """
+        names, user_ids, template_list, profiles = _parse_rows(db_manager.get_all_face_users(strict=strict))
+
+        index = self._new_index()
+        entry_ids = np.arange(len(names), dtype=np.int64)
+        if len(names) > 0:
+            index.add(entry_ids, np.stack([_centroid(t) for t in template_list]))
+
+        entries = {i: (name, user_id) for i, name, user_id in zip(entry_ids.tolist(), names, user_ids)}
+        name_to_entry = {name: i for i, name in zip(entry_ids.tolist(), names)}
+        templates = {i: t for i, t in zip(entry_ids.tolist(), template_list) if len(t) > 1}
+        with self._write_lock:
+            self._snapshot = GallerySnapshot(
+                self._snapshot.version + 1, index, entries, name_to_entry, profiles, len(names),
+                templates, self.centroid_candidates
+            )
+            self._dirty_since = None
+            self.last_full_load = self._snapshot.published_at
+
+        logger.info(f"人脸底库加载完成, 共 {len(names)} 条 (索引类型: {self.index_type})")
+        return len(names)
+
+    #-----------------------------------------------#
+    #   增量维护
+    #-----------------------------------------------#
+    def upsert(self, name, embedding, user_id=None, profile=None):
+        """
+        新增或覆盖一条人脸特征 (按 name 去重), profile 为可选的用户信息快照
+        embedding 为单个特征 [128], 或同一个人的多个模板 [K, 128] (第一行为主模板)
+        """
+        templates = np.asarray(embedding, dtype=np.float32)
+        templates = templates if templates.ndim == 2 else templates.reshape(1, -1)
+        if templates.shape[1] != EMBEDDING_DIM or len(templates) == 0:
+            raise ValueError(f"人脸特征维度应为{EMBEDDING_DIM}, 实际为{templates.shape[1]}")
+        profile = _make_profile(profile) if profile is not None else None
+
+        with self._write_lock:
+            draft = _Draft(self._snapshot)
+            old_entry = draft.name_to_entry.get(name)
+            if old_entry is not None:
+                draft.drop([old_entry], forget_profiles=False)
+            draft.add([name], [_to_user_id(user_id)], [templates])
+            if profile is not None:
+                draft.profiles[profile['id']] = profile
+            self._publish(draft)
+
+    def remove(self, key):
+        """
+        删除与 key 匹配的所有条目
+        key 可以是数字用户ID, 也可以是 face_id / username
+        返回删除的条数
+        """
+        user_id = _to_user_id(key)
+        with self._write_lock:
+            current = self._snapshot
+            entry_ids = set(current.user_entries.get(user_id, ())) if user_id >= 0 else set()
+            if str(key) in current.name_to_entry:
+                entry_ids.add(current.name_to_entry[str(key)])
+            if not entry_ids:
+                return 0
+
+            draft = _Draft(current)
+            draft.drop(sorted(entry_ids))
+            self._publish(draft)
+            return len(entry_ids)
+
+    def apply_changes(self, keys, rows):
+        """
+        批量应用一组增量变更, 只发布一次新版本
+        Args:
+            keys: 需要先删除的条目, 元素为数字用户ID 或 face_id / username (与 remove 相同)
+            rows: get_all_face_users 格式的查询结果, 删除后重新加入
+        Returns:
+            (删除的条数, 加入的条数)
+        """
+        names, user_ids, template_list, new_profiles = _parse_rows(rows)
+        remove_names = {str(key) for key in keys} | set(names)
+        remove_user_ids = {_to_user_id(key) for key in keys} - {-1}
+
+        with self._write_lock:
+            current = self._snapshot
+            stale = {current.name_to_entry[name] for name in remove_names if name in current.name_to_entry}
+            for user_id in remove_user_ids:
+                stale.update(current.user_entries.get(user_id, ()))
+            if not stale and not names:
+                return 0, 0
+
+            draft = _Draft(current)
+            draft.drop(sorted(stale))
+            if names:
+                draft.add(names, user_ids, template_list)
+                draft.profiles.update(new_profiles)
+            self._publish(draft)
+            return len(stale), len(names)
+
+    def compact(self, force=False):
+        """
+        把累积的增量合并进新的基础索引/基础字典 (O(N)), 返回是否执行了合并
+        默认只合并存在超过 compact_interval 秒的增量; 合并在写锁外 (合并锁内) 进行,
+        期间有新的写入时放弃本次结果, 留到下次再合并
+        """
+        snapshot = self._snapshot
+        if self._dirty_since is None or snapshot.pending_changes() == 0:
+            return False
+        if not force and time.monotonic() - self._dirty_since < self.compact_interval:
+            return False
+
+        draft = _Draft(snapshot)
+        with self._compact_lock:
+            if self._snapshot is not snapshot:
+                return False
+            draft.compact()
+        with self._write_lock:
+            if self._snapshot is not snapshot:
+                return False
+            self._publish(draft)
+            self.last_compaction = self._snapshot.published_at
+        return True
+
+    #-----------------------------------------------#
+    #   用户信息快照
+    #-----------------------------------------------#
+    def get_profile(self, user_id):
+        """返回用户信息快照的副本, 没有缓存时返回 None"""
+        return self._snapshot.get_profile(user_id)
+
+    def bind_profile(self, name, user):
+        """
+        为条目补充用户信息 (如通过 Java 注册的 face_id 条目),
+        之后同一张人脸登录不再查库; 特征不变
+        """
+        profile = _make_profile(user)
+        if profile is None:
+            return
+        with self._write_lock:
+            draft = _Draft(self._snapshot)
+            entry_id = draft.name_to_entry.get(name)
+            if entry_id is None:
+                return
+            draft.rebind(entry_id, profile['id'])
+            draft.profiles[profile['id']] = profile
+            self._publish(draft)
+
+    def stats(self):
+        """
+        底库元数据 (条数/版本/最近刷新时间/索引类型), 只读内存, 供健康检查使用
+        时间为 unix 时间戳
+        """
+        snapshot = self._snapshot
+        return {
+            'entries': len(snapshot),
+            'profiles': len(snapshot.profiles),
+            'version': snapshot.version,
+            'index_type': self.index_type,
+            'multi_template_entries': len(snapshot.templates),
+            'pending_changes': snapshot.pending_changes(),
+            'last_refresh': snapshot.published_at,
+            'last_full_load': self.last_full_load,
+            'last_compaction': self.last_compaction,
+        }
+
+    def memory_usage(self):
+        """
+        当前版本检索索引的内存占用
+        resident_bytes 为常驻内存 (含多模板矩阵 template_bytes), 压缩索引另有 rerank_store_bytes (精排用的 float32 原始特征,
+        默认为内存映射文件; in_memory 模式下已计入 resident_bytes)
+        """
+        snapshot = self._snapshot
+        usage = {'index_type': self.index_type, 'entries': len(snapshot)}
+        usage.update(snapshot.index.memory_usage())
+        usage['template_bytes'] = sum(t.nbytes for t in snapshot.templates.values())
+        usage['resident_bytes'] += usage['template_bytes']
+        usage['bytes_per_entry'] = round(usage['resident_bytes'] / len(snapshot), 1) if len(snapshot) else None
+        return usage
+
+    #-----------------------------------------------#
+    #   比对 (使用当前版本)
+    #-----------------------------------------------#
+    def search(self, face_encodings, k=1):
+        return self._snapshot.search(face_encodings, k)
+
+    def match(self, face_encoding, tolerance=0.8):
+        return self._snapshot.match(face_encoding, tolerance)
+
+
+class _Draft:
+    """
+    写锁内对当前版本的可修改副本
+    索引和各字典只复制尚未合并的增量, 生成副本的代价与底库规模无关
+    """
+
+    def __init__(self, snapshot):
+        self.index = snapshot.index.copy()
+        self.entries = snapshot.entries.copy()
+        self.name_to_entry = snapshot.name_to_entry.copy()
+        self.profiles = snapshot.profiles.copy()
+        self.templates = snapshot.templates.copy()
+        self.user_entries = snapshot.user_entries.copy()
+        self.next_id = snapshot.next_id
+
+    def pending_changes(self):
+        return max(
+            self.index.pending_changes(), self.entries.pending_changes(), self.name_to_entry.pending_changes(),
+            self.profiles.pending_changes(), self.templates.pending_changes(), self.user_entries.pending_changes()
+        )
+
+    def add(self, names, user_ids, template_list):
+        """新增条目, 条目ID 从 next_id 起连续分配"""
+        entry_ids = np.arange(self.next_id, self.next_id + len(names), dtype=np.int64)
+        self.index.add(entry_ids, np.stack([_centroid(t) for t in template_list]))
+        for entry_id, name, user_id, templates in zip(entry_ids.tolist(), names, user_ids, template_list):
+            self.entries[entry_id] = (name, user_id)
+            self.name_to_entry[name] = entry_id
+            if len(templates) > 1:
+                self.templates[entry_id] = templates
+            self._link(user_id, entry_id)
+        self.next_id += len(names)
+
+    def drop(self, entry_ids, forget_profiles=True):
+        """删除条目; forget_profiles 为 True 时一并删除其用户信息快照"""
+        self.index.remove(entry_ids)
+        for entry_id in entry_ids:
+            name, user_id = self.entries.pop(entry_id)
+            self.name_to_entry.pop(name, None)
+            self.templates.pop(entry_id, None)
+            self._unlink(user_id, entry_id)
+            if forget_profiles:
+                self.profiles.pop(user_id, None)
+
+    def rebind(self, entry_id, user_id):
+        """修改条目对应的用户ID"""
+        name, old_user_id = self.entries[entry_id]
+        if old_user_id == user_id:
+            return
+        self.entries[entry_id] = (name, user_id)
+        self._unlink(old_user_id, entry_id)
+        self._link(user_id, entry_id)
+
+    def compact(self):
+        """把增量合并进新的基础索引/基础字典 (O(N))"""
+        self.index = self.index.compacted()
+        self.entries = self.entries.flatten()
+        self.name_to_entry = self.name_to_entry.flatten()
+        self.profiles = self.profiles.flatten()
+        self.templates = self.templates.flatten()
+        self.user_entries = self.user_entries.flatten()
+
+    def freeze(self, version, prefilter):
+        return GallerySnapshot(
+            version, self.index, self.entries, self.name_to_entry, self.profiles, self.next_id,
+            self.templates, prefilter, self.user_entries
+        )
+
+    def _link(self, user_id, entry_id):
+        if user_id >= 0:
+            self.user_entries[user_id] = self.user_entries.get(user_id, ()) + (entry_id,)
+
+    def _unlink(self, user_id, entry_id):
+        if user_id < 0:
+            return
+        remaining = tuple(i for i in self.user_entries.get(user_id, ()) if i != entry_id)
+        if remaining:
+            self.user_entries[user_id] = remaining
+        else:
+            self.user_entries.pop(user_id, None)
+
+
+class _LayeredDict:
+    """
+    写时复制用的字典: 共享只读的 base 字典 + 少量改动 (overlay 为新增/覆盖的键, removed 为 base 中已删除的键)
+    copy() 只复制改动部分; 发布后的版本不再修改, flatten() 把改动合并为新的 base
+    """
+
+    __slots__ = ('_base', '_overlay', '_removed', '_size')
+
+    def __init__(self, base=None, overlay=None, removed=None, size=None):
+        self._base = base if base is not None else {}
+        self._overlay = overlay if overlay is not None else {}
+        self._removed = removed if removed is not None else set()
+        self._size = len(self._base) if size is None else size
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return key in self._overlay or (key not in self._removed and key in self._base)
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._removed:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        if not self._overlay and not self._removed:
+            return self._base.items()
+        return self._merged_items()
+
+    def values(self):
+        return (value for _, value in self.items())
+
+    def pending_changes(self):
+        return len(self._overlay) + len(self._removed)
+
+    def copy(self):
+        return _LayeredDict(self._base, dict(self._overlay), set(self._removed), self._size)
+
+    def flatten(self):
+        return _LayeredDict(dict(self.items()))
+
+    #-----------------------------------------------#
+    #   以下修改只用于尚未发布的副本
+    #-----------------------------------------------#
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._size += 1
+        self._overlay[key] = value
+        self._removed.discard(key)
+
+    def pop(self, key, *default):
+        if key in self._overlay:
+            value = self._overlay.pop(key)
+        elif key not in self._removed and key in self._base:
+            value = self._base[key]
+        elif default:
+            return default[0]
+        else:
+            raise KeyError(key)
+        if key in self._base:
+            self._removed.add(key)
+        self._size -= 1
+        return value
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def _merged_items(self):
+        for key, value in self._base.items():
+            if key not in self._removed and key not in self._overlay:
+                yield key, value
+        yield from self._overlay.items()
+
+
+def _layered(mapping):
+    """普通字典 (或 None) 包装为 _LayeredDict, 字典本身作为 base 不再复制"""
+    if isinstance(mapping, _LayeredDict):
+        return mapping
+    return _LayeredDict(mapping if mapping is not None else {})
+
+
+def _group_by_user(entries):
+    """条目ID -> (name, user_id) 转换为 user_id -> 条目ID 元组"""
+    by_user = {}
+    for entry_id, (_, user_id) in entries.items():
+        if user_id >= 0:
+            by_user[user_id] = by_user.get(user_id, ()) + (entry_id,)
+    return by_user
+
+
+def _parse_rows(rows):
+    """
+    从 get_all_face_users 的查询结果中取出有效的特征
+    同一 name 出现多次时保留最后一条; 主特征与 face_templates 中的其他模板合并为 [K, 128]
+    Returns:
+        (names, user_ids, templates, profiles)
+    """
+    by_name = {}
+    profiles = {}
+    for row in rows:
+        if row.get('face_embedding') is None:
+            continue
+        embedding = np.asarray(row['face_embedding'], dtype=np.float32).reshape(-1)
+        if embedding.shape[0] != EMBEDDING_DIM:
+            logger.warning(f"用户 {row['username']} 的人脸特征维度错误: {embedding.shape[0]}")
+            continue
+        templates = embedding[None, :]
+        extra = row.get('face_templates')
+        if extra is not None and len(extra):
+            extra = np.asarray(extra, dtype=np.float32)
+            if extra.ndim == 2 and extra.shape[1] == EMBEDDING_DIM:
+                templates = np.vstack([templates, extra])
+            else:
+                logger.warning(f"用户 {row['username']} 的人脸模板维度错误: {extra.shape}")
+        by_name[row['username']] = (_to_user_id(row.get('id')), templates)
+        profile = _make_profile(row)
+        if profile is not None:
+            profiles[profile['id']] = profile
+
+    names = list(by_name)
+    user_ids = [by_name[name][0] for name in names]
+    templates = [by_name[name][1] for name in names]
+    return names, user_ids, templates, profiles
+
+
+def _centroid(templates):
+    """多模板的中心向量: 各模板归一化后求平均再归一化; 单个模板原样返回"""
+    if len(templates) == 1:
+        return templates[0]
+    normalized = templates / np.maximum(np.linalg.norm(templates, axis=1, keepdims=True), 1e-10)
+    centroid = normalized.mean(axis=0)
+    return (centroid / max(float(np.linalg.norm(centroid)), 1e-10)).astype(np.float32)
+
+
+def _make_profile(row):
+    """从查询结果中提取用户信息快照, 缺少数字ID时返回 None"""
+    user_id = _to_user_id(row.get('id'))
+    if user_id < 0:
+        return None
+    profile = {field: row.get(field) for field in PROFILE_FIELDS}
+    profile['id'] = user_id
+    # get_all_face_users 会把 username 替换为 face_id, 真实用户名在 account_username 中
+    profile['username'] = row.get('account_username', row.get('username'))
+    profile['face_enabled'] = 1
+    return profile
+
+
+def _to_user_id(value):
+    """将用户ID统一转换为整数, 非数字 (如 UUID) 时返回 -1"""
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return -1
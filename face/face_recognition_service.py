@@ -1,34 +1,62 @@
 import os
 import cv2
 import numpy as np
-import base64
-from io import BytesIO
-from PIL import Image
+import sys
+import time
+import types
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import utils.utils as utils
-from net.inception import InceptionResNetV1
 from net.mtcnn import mtcnn
+from inference_scheduler import BatchedModel
+from encoding_cache import EncodingCache, weights_fingerprint
+from image_decode import decode_image, ImageDecodeError
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_data')
+WEIGHT_FILES = {
+    'keras': ['facenet_keras.h5', 'pnet.h5', 'rnet.h5', 'onet.h5'],
+    'onnx': ['facenet.onnx', 'pnet.onnx', 'rnet.onnx', 'onet.onnx'],
+    'onnx_int8': ['facenet_int8.onnx', 'pnet.onnx', 'rnet.onnx', 'onet.onnx'],
+}
+
+
+#-----------------------------------------------#
+#   进程池子进程中的模型, 每个子进程初始化一次
+#-----------------------------------------------#
+_worker_service = None
+
+
+def _init_encode_worker(backend, quantized):
+    global _worker_service
+    _worker_service = FaceRecognitionService(load_database=False, backend=backend, quantized=quantized)
+
+
+def _encode_in_worker(paths):
+    return _worker_service.encode_image_files(paths)
 
 
 class FaceRecognitionService:
-    def __init__(self):
-        """初始化人脸识别服务"""
-        #-------------------------#
-        #   创建mtcnn的模型
-        #   用于检测人脸
-        #-------------------------#
-        self.mtcnn_model = mtcnn()
+    def __init__(self, micro_batch_wait_ms=None, load_database=True, encode_workers=None,
+                 backend='keras', quantized=False, load_models=True):
+        """
+        初始化人脸识别服务
+        Args:
+            micro_batch_wait_ms: 不为None时开启跨请求微批推理,
+                                 并发请求的Rnet/Onet/facenet输入在该等待窗口内合并成一批
+            load_database: 是否在启动时加载 face_dataset
+            encode_workers: 重新编码 face_dataset / 批量注册时使用的进程数, None为自动
+            backend: 推理后端, 'keras' 或 'onnx' (需先运行 export_onnx.py)
+            quantized: onnx 后端下 facenet 是否使用 int8 动态量化模型
+            load_models: 为False时只初始化配置, 模型 (以及 face_dataset) 在首次调用 load_models() 时加载,
+                         用于预加载的多进程部署: tensorflow 不能安全地 fork, 只在子进程中加载
+        """
+        self.backend = backend
+        self.quantized = quantized
+        self.micro_batch_wait_ms = micro_batch_wait_ms
+        self.mtcnn_model = None
+        self.facenet_model = None
         self.threshold = [0.5, 0.6, 0.8]
-               
-        #-----------------------------------#
-        #   载入facenet
-        #   将检测到的人脸转化为128维的向量
-        #-----------------------------------#
-        self.facenet_model = InceptionResNetV1()
-        # 获取当前脚本文件的目录，构建模型文件的绝对路径
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        model_path = os.path.join(current_dir, 'model_data', 'facenet_keras.h5')
-        self.facenet_model.load_weights(model_path)
 
         #-----------------------------------------------#
         #   对数据库中的人脸进行编码
@@ -38,6 +66,28 @@ class FaceRecognitionService:
         self.known_face_encodings = []
         self.known_face_names = []
         
+        # FaceNet 单次前向传播的最大人脸数量
+        self.embedding_batch_size = 32
+
+        #-----------------------------------------------#
+        #   检测配置
+        #   min_face_size: 最小人脸尺寸(像素), 去掉更精细的金字塔层级
+        #   top_k: 只有 面积 x 得分 最高的 top_k 个Pnet候选框进入Rnet/Onet
+        #   login: 自拍式的登录图片只关心一张较大的正脸
+        #-----------------------------------------------#
+        self.detection_profiles = {
+            'default': {'min_face_size': None, 'top_k': None},
+            'login': {'min_face_size': 80, 'top_k': 8},
+        }
+
+        #-----------------------------------------------#
+        #   face_dataset 的特征缓存
+        #   需要重新编码的图片超过 parallel_encode_min 张时
+        #   使用进程池 (每个子进程各自加载一份模型)
+        #-----------------------------------------------#
+        self.encode_workers = encode_workers or min(4, os.cpu_count() or 1)
+        self.parallel_encode_min = 64
+
         # 置信度计算参数
         self.confidence_config = {
             'method': 'piecewise_linear',  # 置信度计算方法
@@ -45,10 +95,66 @@ class FaceRecognitionService:
             'quality_boost': True,        # 是否启用质量提升
         }
         
-        self.load_face_database()
+        self._database_pending = load_database
+        if load_models:
+            self.load_models()
+
+    def load_models(self):
+        """加载 mtcnn 和 facenet (已加载时直接返回), 构造时要求加载 face_dataset 的一并加载"""
+        if self.facenet_model is not None:
+            return
+        #-------------------------#
+        #   创建mtcnn的模型
+        #   用于检测人脸
+        #-------------------------#
+        mtcnn_model = mtcnn(backend=self.backend)
+
+        #-----------------------------------#
+        #   载入facenet
+        #   将检测到的人脸转化为128维的向量
+        #-----------------------------------#
+        if self.backend == 'onnx':
+            from onnx_backend import OnnxModel, model_path
+            facenet_model = OnnxModel(model_path(MODEL_DIR, 'facenet_int8' if self.quantized else 'facenet'))
+        else:
+            from net.inception import InceptionResNetV1
+            facenet_model = InceptionResNetV1()
+            facenet_model.load_weights(os.path.join(MODEL_DIR, 'facenet_keras.h5'))
+
+        #-----------------------------------------------#
+        #   跨请求微批推理
+        #   多线程服务下并发的登录请求共享同一次前向传播
+        #-----------------------------------------------#
+        wait_ms = self.micro_batch_wait_ms
+        if wait_ms is not None:
+            mtcnn_model.Rnet = BatchedModel(mtcnn_model.Rnet, max_batch=256, max_wait_ms=wait_ms, name='rnet')
+            mtcnn_model.Onet = BatchedModel(mtcnn_model.Onet, max_batch=64, max_wait_ms=wait_ms, name='onet')
+            facenet_model = BatchedModel(facenet_model, max_batch=32, max_wait_ms=wait_ms, name='facenet')
+
+        self.mtcnn_model = mtcnn_model
+        self.facenet_model = facenet_model
+        if self._database_pending:
+            self._database_pending = False
+            self.load_face_database()
+
+    def warm_up(self):
+        """
+        预热: 让 Pnet/Rnet/Onet/facenet 各跑一次前向传播,
+        提前完成 predict 函数的构建, 避免第一个请求的延迟尖峰
+        """
+        self.load_models()
+        rng = np.random.RandomState(0)
+        img = rng.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+        self.mtcnn_model.detectFace(img, self.threshold)
+        self.mtcnn_model.Rnet.predict(np.zeros((1, 24, 24, 3), dtype=np.float32))
+        self.mtcnn_model.Onet.predict(np.zeros((1, 48, 48, 3), dtype=np.float32))
+        utils.calc_128_vec_batch(self.facenet_model, [np.zeros((160, 160, 3), dtype=np.uint8)], self.embedding_batch_size)
 
     def load_face_database(self):
-        """加载人脸数据库"""
+        """
+        加载人脸数据库
+        已编码的图片从缓存中读取 (内存映射), 只对新增或修改过的图片重新编码
+        """
         self.known_face_encodings = []
         self.known_face_names = []
         
@@ -59,83 +165,218 @@ class FaceRecognitionService:
         if not os.path.exists(face_dataset_dir):
             os.makedirs(face_dataset_dir)
             return
-            
-        face_list = os.listdir(face_dataset_dir)
-        for face in face_list:
-            name = face.split(".")[0]
+
+        files = []
+        for face in sorted(os.listdir(face_dataset_dir)):
             img_path = os.path.join(face_dataset_dir, face)
+            if face.startswith('.') or not os.path.isfile(img_path):
+                continue
+            stat = os.stat(img_path)
+            files.append((face, stat.st_mtime_ns, stat.st_size))
+
+        cache = EncodingCache(face_dataset_dir, self.weights_fingerprint())
+        cache.load()
+        hits, misses = cache.partition(files)
+
+        #-----------------------------------------------#
+        #   只对缓存未命中的图片检测并编码
+        #-----------------------------------------------#
+        encodings = {}
+        if misses:
+            print(f"人脸特征缓存命中 {len(hits)} 张, 需要重新编码 {len(misses)} 张")
+            paths = [os.path.join(face_dataset_dir, face) for face in misses]
+            encodings = dict(zip(misses, self.encode_images(paths)))
+
+        if misses or len(hits) != len(cache):
+            cache.rebuild(files, hits, encodings)
+            hits, _ = cache.partition(files)
+
+        names, rows = [], []
+        for face, _, _ in files:
+            row = hits.get(face, -1)
+            if row >= 0:
+                names.append(face.split(".")[0])
+                rows.append(row)
+        self.known_face_encodings = cache.vectors(rows)
+        self.known_face_names = names
+
+    def _weight_files(self):
+        """当前后端使用的模型文件, 特征缓存以其哈希作为版本"""
+        if self.backend == 'onnx':
+            return WEIGHT_FILES['onnx_int8' if self.quantized else 'onnx']
+        return WEIGHT_FILES['keras']
+
+    def weights_fingerprint(self):
+        """当前模型权重与人脸对齐版本的哈希, 更换模型或对齐算法后特征需要重新编码"""
+        return weights_fingerprint([os.path.join(MODEL_DIR, name) for name in self._weight_files()],
+                                   salt=f'alignment-{utils.ALIGNMENT_VERSION}')
+
+    def encode_images(self, paths, pool=None):
+        """
+        批量编码图片文件, 数量达到 parallel_encode_min 时使用进程池
+        Args:
+            pool: encode_pool() 创建的进程池, 分批处理时传入以复用子进程中已加载的模型
+        Returns:
+            list: 与 paths 一一对应的128维特征, 读取失败或未检测到人脸时为 None
+        """
+        if pool is not None or (len(paths) >= self.parallel_encode_min and self.encode_workers > 1):
+            return self._encode_images_parallel(paths, pool)
+        return self.encode_image_files(paths)
+
+    def encode_pool(self, workers=None):
+        """
+        创建编码进程池
+        tensorflow 不能安全地 fork, 子进程使用 spawn 启动并各自加载模型
+        """
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=workers or self.encode_workers, mp_context=context,
+                                   initializer=_init_encode_worker, initargs=(self.backend, self.quantized))
+
+    def encode_image_files(self, paths):
+        """
+        对图片文件逐一检测人脸并批量编码
+        Returns:
+            list: 与 paths 一一对应的128维特征, 读取失败或未检测到人脸时为 None
+        """
+        results = [None] * len(paths)
+
+        #-----------------------------------------------#
+        #   先检测并对齐所有图片中的人脸，
+        #   攒够一批后再统一送入facenet编码
+        #-----------------------------------------------#
+        pending_index = []
+        pending_faces = []
+
+        def flush():
+            encodings = utils.calc_128_vec_batch(self.facenet_model, pending_faces, self.embedding_batch_size)
+            for i, encoding in zip(pending_index, encodings):
+                results[i] = encoding
+            pending_index.clear()
+            pending_faces.clear()
+
+        for i, img_path in enumerate(paths):
             img = cv2.imread(img_path)
             if img is None:
                 continue
             
-            encoding = self._encode_face(img)
-            if encoding is not None:
-                self.known_face_encodings.append(encoding)
-                self.known_face_names.append(name)
+            aligned = self._detect_and_align(img, max_faces=1)
+            if len(aligned) == 0:
+                continue
+            pending_index.append(i)
+            pending_faces.append(aligned[0][1])
+            if len(pending_faces) >= self.embedding_batch_size:
+                flush()
 
-    def _encode_face(self, img):
-        """对单张人脸图片进行编码"""
+        if pending_faces:
+            flush()
+        return results
+
+    def _encode_images_parallel(self, paths, pool=None):
+        """多进程编码图片, pool 为空时临时创建进程池"""
+        workers = min(self.encode_workers, len(paths))
+        chunk_size = max(self.embedding_batch_size, -(-len(paths) // (max(workers, 1) * 4)))
+        chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+        if pool is None:
+            with self.encode_pool(workers) as executor:
+                return self._submit_encode(executor, chunks)
+        return self._submit_encode(pool, chunks)
+
+    def _submit_encode(self, executor, chunks):
+        #-----------------------------------------------#
+        #   spawn 子进程默认会重新执行主脚本,
+        #   api_server_db 在导入时就会加载模型和底库,
+        #   启动子进程期间暂时隐藏主模块避免重复初始化
+        #-----------------------------------------------#
+        main_module = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            futures = [executor.submit(_encode_in_worker, chunk) for chunk in chunks]
+        finally:
+            sys.modules['__main__'] = main_module
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def _detect_and_align(self, img, max_faces=None, profile='default', timings=None):
+        """
+        检测图片中的人脸并对齐
+        Args:
+            img: BGR图片
+            max_faces: 最多返回的人脸数量, None表示全部
+            profile: detection_profiles 中的检测配置
+            timings: 不为空的字典时记录各阶段耗时(秒): pnet / rnet / onet / align
+        Returns:
+            list: [(rectangle, aligned_face)], aligned_face 为 160x160x3 的RGB图像
+        """
         img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         
         #---------------------#
         #   检测人脸
         #---------------------#
-        rectangles = self.mtcnn_model.detectFace(img_rgb, self.threshold)
+        rectangles = self.mtcnn_model.detectFace(img_rgb, self.threshold, timings=timings,
+                                                 **self.detection_profiles[profile])
         if len(rectangles) == 0:
-            return None
+            return []
+        start = time.perf_counter()
             
         #---------------------#
         #   转化成正方形
         #---------------------#
         rectangles = utils.rect2square(np.array(rectangles))
-        rectangle = rectangles[0]
+        if max_faces is not None:
+            rectangles = rectangles[:max_faces]
         
-        # 修正边界框，确保在图片范围内
+        #---------------------#
+        #   修正边界框，确保在图片范围内，并去掉无效的框
+        #---------------------#
         height, width = img_rgb.shape[:2]
-        x1 = max(0, int(rectangle[0]))
-        y1 = max(0, int(rectangle[1]))
-        x2 = min(width-1, int(rectangle[2]))
-        y2 = min(height-1, int(rectangle[3]))
-        
-        # 检查边界框是否有效
-        if x1 >= x2 or y1 >= y2:
-            return None
+        boxes = rectangles[:, :4].astype(np.int64)
+        boxes[:, :2] = np.maximum(boxes[:, :2], 0)
+        boxes[:, 2] = np.minimum(boxes[:, 2], width - 1)
+        boxes[:, 3] = np.minimum(boxes[:, 3], height - 1)
+        valid = (boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+        if not valid.any():
+            return []
+        rectangles = rectangles[valid]
         
-        # 重新计算landmark相对位置
-        landmark = np.reshape(rectangle[5:15], (5, 2)) - np.array([x1, y1])
-        crop_img = img_rgb[y1:y2, x1:x2]
-        
-        if crop_img.size == 0:
+        #-----------------------------------------------#
+        #   利用人脸关键点进行人脸对齐
+        #   裁剪、旋转、缩放合成一次 warpAffine, 直接得到 160x160
+        #-----------------------------------------------#
+        landmarks = rectangles[:, 5:15].reshape(-1, 5, 2)
+        aligned, _ = utils.align_faces(img_rgb, boxes[valid], landmarks, 160)
+        utils.record_stage(timings, 'align', start)
+        return list(zip(rectangles, aligned))
+
+    def _encode_face(self, img):
+        """对单张人脸图片进行编码"""
+        faces = self._detect_and_align(img, max_faces=1)
+        if len(faces) == 0:
             return None
-            
-        crop_img, _ = utils.Alignment_1(crop_img, landmark)
-        crop_img = np.expand_dims(cv2.resize(crop_img, (160, 160)), 0)
         
         #--------------------------------------------------------------------#
         #   将检测到的人脸传入到facenet的模型中，实现128维特征向量的提取
         #--------------------------------------------------------------------#
-        face_encoding = utils.calc_128_vec(self.facenet_model, crop_img)
+        face_encoding = utils.calc_128_vec(self.facenet_model, np.expand_dims(faces[0][1], 0))
         return face_encoding
 
     def register_face(self, image_data, name):
         """
         注册新人脸
         Args:
-            image_data: 图片数据 (numpy array 或 base64字符串)
+            image_data: 图片数据 (numpy array / base64字符串 / 原始字节)
             name: 人脸名称
         Returns:
             dict: 注册结果
         """
         try:
             # 处理输入图片
-            if isinstance(image_data, str):
-                # base64字符串
-                image_data = base64.b64decode(image_data)
-                image = Image.open(BytesIO(image_data))
-                img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            else:
-                # numpy array
+            if isinstance(image_data, np.ndarray):
                 img = image_data
+            else:
+                # base64字符串 / 原始字节
+                img = decode_image(image_data)
             
             # 编码人脸
             encoding = self._encode_face(img)
@@ -157,101 +398,231 @@ class FaceRecognitionService:
         except Exception as e:
             return {"success": False, "message": f"注册失败: {str(e)}"}
 
-    def recognize_face(self, image_data):
+    def recognize_face(self, image_data, gallery=None, profile='default', stop_on_match=False, timings=None,
+                       include_encodings=False):
         """
         识别人脸
         Args:
-            image_data: 图片数据 (numpy array 或 base64字符串)
+            image_data: 图片数据 (numpy array / base64字符串 / 原始字节)
+            gallery: 常驻内存的人脸底库 (FaceGallery 或 GallerySnapshot), 为空时使用 known_face_encodings
+            profile: detection_profiles 中的检测配置
+            stop_on_match: 为True时先只编码最大的人脸, 匹配成功即返回,
+                           否则再批量编码其余人脸
+            timings: 不为空的字典时记录各阶段耗时(秒):
+                     decode / pnet / rnet / onet / align / embed / search
+            include_encodings: 为True时每个人脸附带 128 维特征 (encoding, numpy数组),
+                               用于登录成功后补充人脸模板
         Returns:
             dict: 识别结果
         """
+        # 整张图片的所有人脸都在同一个底库版本上比对
+        if gallery is not None:
+            gallery = gallery.snapshot()
         try:
             # 处理输入图片
-            if isinstance(image_data, str):
-                # base64字符串
-                image_data = base64.b64decode(image_data)
-                image = Image.open(BytesIO(image_data))
-                img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            else:
-                # numpy array
+            if isinstance(image_data, np.ndarray):
                 img = image_data
-            
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            else:
+                # base64字符串 / 原始字节
+                start = time.perf_counter()
+                img = decode_image(image_data)
+                utils.record_stage(timings, 'decode', start)
             
             #--------------------------------#
-            #   检测人脸
+            #   检测并对齐人脸
             #--------------------------------#
-            rectangles = self.mtcnn_model.detectFace(img_rgb, self.threshold)
+            aligned = self._detect_and_align(img, profile=profile, timings=timings)
             
-            if len(rectangles) == 0:
+            if len(aligned) == 0:
                 return {"success": False, "message": "未检测到人脸", "faces": []}
             
-            # 转化成正方形
-            rectangles = utils.rect2square(np.array(rectangles))
-            
             #-----------------------------------------------#
-            #   对检测到的人脸进行编码
+            #   将人脸堆叠成一批，一次前向传播完成编码
+            #   stop_on_match 时按面积从大到小, 最大的人脸单独一批
             #-----------------------------------------------#
-            face_encodings = []
-            for rectangle in rectangles:
-                #---------------#
-                #   截取图像
-                #---------------#
-                landmark = np.reshape(rectangle[5:15], (5, 2)) - np.array([int(rectangle[0]), int(rectangle[1])])
-                crop_img = img_rgb[int(rectangle[1]):int(rectangle[3]), int(rectangle[0]):int(rectangle[2])]
-                
-                #-----------------------------------------------#
-                #   利用人脸关键点进行人脸对齐
-                #-----------------------------------------------#
-                crop_img, _ = utils.Alignment_1(crop_img, landmark)
-                crop_img = np.expand_dims(cv2.resize(crop_img, (160, 160)), 0)
-                
-                face_encoding = utils.calc_128_vec(self.facenet_model, crop_img)
-                face_encodings.append(face_encoding)
+            order = list(range(len(aligned)))
+            batches = [order]
+            if stop_on_match:
+                areas = [(r[2] - r[0]) * (r[3] - r[1]) for r, _ in aligned]
+                order.sort(key=lambda i: -areas[i])
+                batches = [order[:1], order[1:]]
             
-            # 识别每个人脸
             faces = []
-            for i, face_encoding in enumerate(face_encodings):
-                #-------------------------------------------------------#
-                #   取出一张脸并与数据库中所有的人脸进行对比，计算得分
-                #-------------------------------------------------------#
-                matches = utils.compare_faces(self.known_face_encodings, face_encoding, tolerance=0.8)
-                name = "Unknown"
-                confidence = 0.0
-                
-                if len(self.known_face_encodings) > 0:
-                    #-------------------------------------------------------#
-                    #   找出距离最近的人脸
-                    #-------------------------------------------------------#
-                    face_distances = utils.face_distance(self.known_face_encodings, face_encoding)
-                    #-------------------------------------------------------#
-                    #   取出这个最近人脸的评分
-                    #-------------------------------------------------------#
-                    best_match_index = np.argmin(face_distances)
-                    if matches[best_match_index]:
-                        name = self.known_face_names[best_match_index]
-                        # 优化后的置信度计算 (距离越小，置信度越高)
-                        confidence = self._calculate_optimized_confidence(face_distances[best_match_index])
+            for batch in batches:
+                if not batch:
+                    continue
+                start = time.perf_counter()
+                face_encodings = utils.calc_128_vec_batch(
+                    self.facenet_model, [aligned[i][1] for i in batch], self.embedding_batch_size
+                )
+                utils.record_stage(timings, 'embed', start)
                 
-                # 获取人脸位置
-                rectangle = rectangles[i]
-                face_info = {
-                    "name": name,
-                    "confidence": float(confidence),
-                    "bbox": {
-                        "x1": int(rectangle[0]),
-                        "y1": int(rectangle[1]),
-                        "x2": int(rectangle[2]),
-                        "y2": int(rectangle[3])
+                # 识别每个人脸
+                for i, face_encoding in zip(batch, face_encodings):
+                    start = time.perf_counter()
+                    name, user_id, confidence, distance = self._match_encoding(face_encoding, gallery)
+                    utils.record_stage(timings, 'search', start)
+
+                    # 获取人脸位置
+                    rectangle = aligned[i][0]
+                    face_info = {
+                        "name": name,
+                        "user_id": user_id,
+                        "confidence": float(confidence),
+                        "distance": float(distance) if distance is not None else None,
+                        "bbox": {
+                            "x1": int(rectangle[0]),
+                            "y1": int(rectangle[1]),
+                            "x2": int(rectangle[2]),
+                            "y2": int(rectangle[3])
+                        }
                     }
-                }
-                faces.append(face_info)
+                    if include_encodings:
+                        face_info["encoding"] = face_encoding
+                    faces.append(face_info)
+                    if stop_on_match and name != "Unknown":
+                        break
+                if stop_on_match and faces[-1]["name"] != "Unknown":
+                    break
             
             return {"success": True, "message": f"检测到{len(faces)}个人脸", "faces": faces}
             
         except Exception as e:
             return {"success": False, "message": f"识别失败: {str(e)}", "faces": []}
     
+    def search_faces(self, images=(), embeddings=(), gallery=None, k=5, max_distance=None,
+                     profile='default', all_faces=False):
+        """
+        批量 top-k 人脸检索 (后台查重/风控使用)
+        图片中检测到的人脸与直接给定的特征合成一批查询: 所有人脸一次批量编码,
+        整批查询在底库中一次矩阵乘法 + argpartition 完成检索
+        Args:
+            images: 图片列表 (numpy array / base64字符串 / 原始字节)
+            embeddings: 128维特征列表
+            gallery: 常驻内存的人脸底库, 为空时使用 known_face_encodings
+            k: 每个查询返回的候选数
+            max_distance: 不为空时只返回距离不超过该值的候选
+            all_faces: 为True时图片中的每张人脸都作为查询, 否则只取面积最大的人脸
+        Returns:
+            dict: results 每个查询一项, 含 source (来源图片/特征的下标) 和按距离升序的 candidates;
+                  errors 为无法处理的输入
+        """
+        if gallery is not None:
+            gallery = gallery.snapshot()
+        sources, aligned, errors = [], [], []
+        for i, image_data in enumerate(images):
+            try:
+                img = image_data if isinstance(image_data, np.ndarray) else decode_image(image_data)
+            except ImageDecodeError as e:
+                errors.append({"type": "image", "index": i, "message": str(e)})
+                continue
+            faces = self._detect_and_align(img, profile=profile)
+            if not faces:
+                errors.append({"type": "image", "index": i, "message": "未检测到人脸"})
+                continue
+            if not all_faces:
+                faces = [max(faces, key=lambda face: (face[0][2] - face[0][0]) * (face[0][3] - face[0][1]))]
+            for rectangle, face in faces:
+                sources.append({
+                    "type": "image",
+                    "index": i,
+                    "bbox": {
+                        "x1": int(rectangle[0]),
+                        "y1": int(rectangle[1]),
+                        "x2": int(rectangle[2]),
+                        "y2": int(rectangle[3])
+                    }
+                })
+                aligned.append(face)
+
+        queries = []
+        if aligned:
+            queries.extend(utils.calc_128_vec_batch(self.facenet_model, aligned, self.embedding_batch_size))
+        for j, embedding in enumerate(embeddings):
+            try:
+                vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            except (TypeError, ValueError):
+                vector = None
+            if vector is None or vector.shape[0] != 128 or not np.all(np.isfinite(vector)):
+                errors.append({"type": "embedding", "index": j, "message": "特征应为128维数值数组"})
+                continue
+            sources.append({"type": "embedding", "index": j})
+            queries.append(vector)
+
+        results = []
+        if queries:
+            for source, hits in zip(sources, self._search_encodings(np.stack(queries), gallery, k)):
+                results.append({
+                    "source": source,
+                    "candidates": [
+                        {
+                            "name": name,
+                            "user_id": user_id,
+                            "distance": float(distance),
+                            "confidence": float(self._calculate_optimized_confidence(distance))
+                        }
+                        for name, user_id, distance in hits
+                        if max_distance is None or distance <= max_distance
+                    ]
+                })
+        return {"success": True, "message": f"共 {len(results)} 个查询", "results": results, "errors": errors}
+
+    def _search_encodings(self, queries, gallery, k):
+        """
+        整批特征的 top-k 检索
+        Returns:
+            list: 每个查询一个列表, 元素为 (name, user_id, distance)
+        """
+        if gallery is not None:
+            return gallery.search(queries, k)
+        distances, indices = utils.face_top_k(self.known_face_encodings, queries, k)
+        return [
+            [(self.known_face_names[i], None, float(d)) for d, i in zip(row_dist, row_ids) if i >= 0]
+            for row_dist, row_ids in zip(distances.tolist(), indices.tolist())
+        ]
+
+    def _match_encoding(self, face_encoding, gallery):
+        """
+        将一个人脸特征与底库比对
+        Returns:
+            (name, user_id, confidence, distance), 未匹配时 name 为 "Unknown", distance 为 None
+        """
+        name = "Unknown"
+        user_id = None
+        confidence = 0.0
+        match_distance = None
+
+        if gallery is not None:
+            #-------------------------------------------------------#
+            #   在常驻底库中做一次矩阵-向量乘法完成比对
+            #-------------------------------------------------------#
+            match_name, match_user_id, distance = gallery.match(face_encoding, tolerance=0.8)
+            if match_name is not None:
+                name = match_name
+                user_id = match_user_id
+                confidence = self._calculate_optimized_confidence(distance)
+                match_distance = distance
+        elif len(self.known_face_encodings) > 0:
+            #-------------------------------------------------------#
+            #   取出一张脸并与数据库中所有的人脸进行对比，计算得分
+            #-------------------------------------------------------#
+            matches = utils.compare_faces(self.known_face_encodings, face_encoding, tolerance=0.8)
+            #-------------------------------------------------------#
+            #   找出距离最近的人脸
+            #-------------------------------------------------------#
+            face_distances = utils.face_distance(self.known_face_encodings, face_encoding)
+            #-------------------------------------------------------#
+            #   取出这个最近人脸的评分
+            #-------------------------------------------------------#
+            best_match_index = np.argmin(face_distances)
+            if matches[best_match_index]:
+                name = self.known_face_names[best_match_index]
+                # 优化后的置信度计算 (距离越小，置信度越高)
+                confidence = self._calculate_optimized_confidence(face_distances[best_match_index])
+                match_distance = float(face_distances[best_match_index])
+
+        return name, user_id, confidence, match_distance
+
     def _calculate_optimized_confidence(self, distance):
         """
         优化的置信度计算方法
@@ -0,0 +1,748 @@
+import logging
+import os
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#-------------------------------------------------------#
+#   人脸底库检索索引
+#   所有后端提供相同的接口:
+#       add(ids, vectors)      新增向量, ids 为外部的整数标识
+#       remove(ids)            删除向量, 返回删除的条数
+#       search(queries, k)     返回 (distances, ids), 形状均为 [Q, k]
+#                              distances 为欧式距离, 不足 k 个时 ids 用 -1 填充
+#       copy()                 深拷贝, 底库合并增量时使用
+#       memory_usage()         内存占用 (字节)
+#   search 只读, 可多线程并发调用; add/remove 需由调用方串行化
+#   底库的写时复制由 LayeredIndex 完成: 共享的基础索引 + 少量增量, 单条写入无需复制整个索引
+#   exact   : 连续 float32 矩阵暴力检索, 结果精确
+#   float16 : float16 矩阵粗排 + float32 原始特征精排, 内存约为 exact 的一半,
+#             只节省内存, 检索比 exact 慢 (numpy 的 float16 转换没有向量化)
+#   int8    : 逐向量缩放的 int8 矩阵粗排 + float32 精排, 内存约为 exact 的四分之一
+#   hnsw    : faiss HNSW 图索引, 适合十万级以上的底库
+#   ivfpq   : faiss IVF-PQ 倒排+乘积量化, 适合百万级底库, 内存占用最小
+#-------------------------------------------------------#
+
+
+def _as_matrix(vectors, dim):
+    vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+    return vectors.reshape(-1, dim)
+
+
+def _empty_result(num_queries, k):
+    return np.full((num_queries, k), np.inf, dtype=np.float32), np.full((num_queries, k), -1, dtype=np.int64)
+
+
+class ExactIndex:
+    """暴力检索索引: 一块连续的 float32 矩阵, 一次矩阵乘法完成检索"""
+
+    def __init__(self, dim=128, capacity=64):
+        self.dim = dim
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._sq_norms = np.zeros(capacity, dtype=np.float32)
+        self._ids = np.full(capacity, -1, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, entry_id):
+        return entry_id in self._rows
+
+    @property
+    def vectors(self):
+        """当前有效的特征矩阵 [N, dim]"""
+        return self._vectors[:self._size]
+
+    @property
+    def ids(self):
+        """与矩阵行对应的外部标识"""
+        return self._ids[:self._size]
+
+    def memory_usage(self):
+        return {'resident_bytes': int(self._vectors.nbytes + self._sq_norms.nbytes + self._ids.nbytes)}
+
+    def copy(self):
+        other = ExactIndex.__new__(ExactIndex)
+        other.dim = self.dim
+        other._vectors = self._vectors.copy()
+        other._sq_norms = self._sq_norms.copy()
+        other._ids = self._ids.copy()
+        other._rows = dict(self._rows)
+        other._size = self._size
+        return other
+
+    def add(self, ids, vectors):
+        vectors = _as_matrix(vectors, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self._reserve(self._size + len(ids))
+        rows = np.arange(self._size, self._size + len(ids))
+        self._vectors[rows] = vectors
+        self._sq_norms[rows] = np.einsum('ij,ij->i', vectors, vectors)
+        self._ids[rows] = ids
+        self._rows.update(zip(ids.tolist(), rows.tolist()))
+        self._size += len(ids)
+
+    def remove(self, ids):
+        #-----------------------------------------------#
+        #   用最后一行覆盖被删除的行, 保持矩阵连续
+        #-----------------------------------------------#
+        removed = 0
+        for entry_id in np.asarray(ids, dtype=np.int64).reshape(-1).tolist():
+            row = self._rows.pop(entry_id, None)
+            if row is None:
+                continue
+            last = self._size - 1
+            if row != last:
+                self._vectors[row] = self._vectors[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._ids[row] = self._ids[last]
+                self._rows[int(self._ids[row])] = row
+            self._ids[last] = -1
+            self._size = last
+            removed += 1
+        return removed
+
+    def search(self, queries, k=1):
+        queries = _as_matrix(queries, self.dim)
+        if self._size == 0 or k <= 0:
+            return _empty_result(len(queries), max(k, 0))
+
+        #-------------------------------------------------------#
+        #   ||g - q||^2 = ||g||^2 + ||q||^2 - 2 g·q
+        #   整批查询只需一次矩阵乘法
+        #-------------------------------------------------------#
+        sq_dist = (self._sq_norms[None, :self._size]
+                   + np.einsum('ij,ij->i', queries, queries)[:, None]
+                   - 2.0 * (queries @ self._vectors[:self._size].T))
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+
+        kk = min(k, self._size)
+        if kk < self._size:
+            top = np.argpartition(sq_dist, kk - 1, axis=1)[:, :kk]
+        else:
+            top = np.broadcast_to(np.arange(self._size), (len(queries), self._size))
+        top_dist = np.take_along_axis(sq_dist, top, axis=1)
+        order = np.argsort(top_dist, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        distances, ids = _empty_result(len(queries), k)
+        distances[:, :kk] = np.sqrt(np.take_along_axis(top_dist, order, axis=1))
+        ids[:, :kk] = self._ids[top]
+        return distances, ids
+
+    def _reserve(self, size):
+        capacity = self._vectors.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        ids = np.full(capacity, -1, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        self._vectors, self._sq_norms, self._ids = vectors, sq_norms, ids
+
+
+#-------------------------------------------------------#
+#   压缩索引使用的 float32 原始特征存储
+#   只追加不覆盖: 删除/覆盖只是不再引用旧的槽位, 因此写时复制时
+#   新旧版本的索引可以共用同一个存储, 无需复制原始特征;
+#   废弃的槽位在底库全量重新加载 (新建索引) 时回收。
+#   默认按块存放在临时文件的内存映射中, 常驻内存的只有压缩后的矩阵,
+#   精排时只读取候选的几十行
+#-------------------------------------------------------#
+_open_stores = weakref.WeakSet()
+
+
+class VectorStore:
+    """
+    只追加的 float32 特征存储, 按块分配, 可放在内存或磁盘临时文件中
+    索引的多个副本共用同一个存储, append 加锁, 并发追加时各自分到不重叠的槽位
+    """
+
+    def __init__(self, dim=128, chunk_rows=65536, in_memory=False, directory=None):
+        self.dim = dim
+        self.chunk_rows = chunk_rows
+        self.in_memory = in_memory
+        self.directory = directory
+        self._chunks = []   # [(数组, 文件对象或None)]
+        self._size = 0
+        self._lock = threading.Lock()
+        _open_stores.add(self)
+
+    def __len__(self):
+        return self._size
+
+    def _new_chunk(self):
+        shape = (self.chunk_rows, self.dim)
+        if self.in_memory:
+            return np.zeros(shape, dtype=np.float32), None
+        # 临时文件关闭后自动删除, 不会在磁盘上残留
+        file = tempfile.TemporaryFile(prefix='face_gallery_', dir=self.directory)
+        return np.memmap(file, dtype=np.float32, mode='w+', shape=shape), file
+
+    def append(self, vectors):
+        """追加特征, 返回分配的槽位"""
+        vectors = _as_matrix(vectors, self.dim)
+        with self._lock:
+            slots = np.arange(self._size, self._size + len(vectors), dtype=np.int64)
+            written = 0
+            while written < len(vectors):
+                chunk_index, offset = divmod(self._size, self.chunk_rows)
+                if chunk_index == len(self._chunks):
+                    self._chunks.append(self._new_chunk())
+                count = min(len(vectors) - written, self.chunk_rows - offset)
+                self._chunks[chunk_index][0][offset:offset + count] = vectors[written:written + count]
+                written += count
+                self._size += count
+        return slots
+
+    def take(self, slots):
+        """按槽位取出特征 [len(slots), dim]"""
+        slots = np.asarray(slots, dtype=np.int64).reshape(-1)
+        result = np.empty((len(slots), self.dim), dtype=np.float32)
+        chunk_indexes, offsets = np.divmod(slots, self.chunk_rows)
+        for chunk_index in np.unique(chunk_indexes).tolist():
+            mask = chunk_indexes == chunk_index
+            result[mask] = self._chunks[chunk_index][0][offsets[mask]]
+        return result
+
+    def nbytes(self):
+        return len(self._chunks) * self.chunk_rows * self.dim * 4
+
+    def resident_bytes(self):
+        """常驻内存的字节数: 内存模式下为全部块, 内存映射文件由操作系统按需换入, 记为 0"""
+        return self.nbytes() if self.in_memory else 0
+
+    def _after_fork(self):
+        """
+        预加载后 fork 的子进程与父进程共用同一个临时文件,
+        子进程改为私有映射 (写时复制), 之后追加的行不会写回文件, 互不影响
+        fork 时其他线程可能正持有追加锁, 子进程换一把新锁
+        """
+        self._lock = threading.Lock()
+        for i, (array, file) in enumerate(self._chunks):
+            if file is not None:
+                self._chunks[i] = (np.memmap(file, dtype=np.float32, mode='c', shape=array.shape), file)
+
+
+def _stores_after_fork():
+    for store in list(_open_stores):
+        store._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_stores_after_fork)
+
+
+class QuantizedIndex:
+    """
+    压缩矩阵暴力检索 + float32 精排
+    粗排: 在压缩矩阵上分块计算近似距离, 每个查询保留 rerank 个候选
+    精排: 从 VectorStore 读取候选的 float32 原始特征, 计算精确距离后取 top-k
+    返回的距离与 ExactIndex 一致, 只要真正的最近邻进入了候选集, 结果就与暴力检索相同
+    """
+
+    CODE_DTYPE = None
+
+    def __init__(self, dim=128, capacity=64, rerank=32, block_rows=4096,
+                 in_memory=False, store_dir=None, chunk_rows=65536):
+        self.dim = dim
+        self.rerank = rerank
+        self.block_rows = block_rows
+        self._codes = np.zeros((capacity, dim), dtype=self.CODE_DTYPE)
+        self._scales = np.ones(capacity, dtype=np.float32)
+        self._sq_norms = np.zeros(capacity, dtype=np.float32)
+        self._ids = np.full(capacity, -1, dtype=np.int64)
+        self._slots = np.full(capacity, -1, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+        self._store = VectorStore(dim, chunk_rows=chunk_rows, in_memory=in_memory, directory=store_dir)
+
+    def __len__(self):
+        return self._size
+
+    def encode(self, vectors):
+        """float32 -> (压缩编码, 缩放系数)"""
+        raise NotImplementedError
+
+    def decode(self, rows):
+        """压缩矩阵中的若干行还原为 float32 (近似值)"""
+        return self._codes[rows].astype(np.float32) * self._scales[rows, None]
+
+    def memory_usage(self):
+        resident = (self._codes.nbytes + self._scales.nbytes + self._sq_norms.nbytes
+                    + self._ids.nbytes + self._slots.nbytes + self._store.resident_bytes())
+        usage = {'resident_bytes': int(resident), 'rerank_store_bytes': int(self._store.nbytes())}
+        usage['rerank_store'] = 'memory' if self._store.in_memory else 'mmap'
+        return usage
+
+    def copy(self):
+        #-----------------------------------------------#
+        #   只复制压缩矩阵, float32 存储只追加, 新旧版本共用
+        #-----------------------------------------------#
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other._codes = self._codes.copy()
+        other._scales = self._scales.copy()
+        other._sq_norms = self._sq_norms.copy()
+        other._ids = self._ids.copy()
+        other._slots = self._slots.copy()
+        other._rows = dict(self._rows)
+        return other
+
+    def add(self, ids, vectors):
+        vectors = _as_matrix(vectors, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self._reserve(self._size + len(ids))
+        rows = np.arange(self._size, self._size + len(ids))
+        codes, scales = self.encode(vectors)
+        self._codes[rows] = codes
+        self._scales[rows] = scales
+        approx = self.decode(rows)
+        self._sq_norms[rows] = np.einsum('ij,ij->i', approx, approx)
+        self._ids[rows] = ids
+        self._slots[rows] = self._store.append(vectors)
+        self._rows.update(zip(ids.tolist(), rows.tolist()))
+        self._size += len(ids)
+
+    def remove(self, ids):
+        removed = 0
+        for entry_id in np.asarray(ids, dtype=np.int64).reshape(-1).tolist():
+            row = self._rows.pop(entry_id, None)
+            if row is None:
+                continue
+            last = self._size - 1
+            if row != last:
+                for array in (self._codes, self._scales, self._sq_norms, self._ids, self._slots):
+                    array[row] = array[last]
+                self._rows[int(self._ids[row])] = row
+            self._ids[last] = -1
+            self._size = last
+            removed += 1
+        return removed
+
+    def _coarse_search(self, queries, fetch):
+        """
+        分块计算近似平方距离, 返回每个查询的 fetch 个候选行号 [Q, fetch]
+        每块转换到同一块可复用的 float32 缓冲区 (默认 4096 行, 2MB, 可留在 CPU 缓存中),
+        不会整块压缩矩阵同时转换成 float32
+        """
+        q_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_dist = np.empty((len(queries), 0), dtype=np.float32)
+        buffer = np.empty((min(self.block_rows, self._size), self.dim), dtype=np.float32)
+        for start in range(0, self._size, self.block_rows):
+            stop = min(start + self.block_rows, self._size)
+            block = buffer[:stop - start]
+            np.copyto(block, self._codes[start:stop])
+            dots = (queries @ block.T) * self._scales[None, start:stop]
+            sq_dist = self._sq_norms[None, start:stop] + q_norms - 2.0 * dots
+
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, stop), sq_dist.shape)], axis=1)
+            dist = np.concatenate([best_dist, sq_dist], axis=1)
+            if dist.shape[1] > fetch:
+                top = np.argpartition(dist, fetch - 1, axis=1)[:, :fetch]
+                rows = np.take_along_axis(rows, top, axis=1)
+                dist = np.take_along_axis(dist, top, axis=1)
+            best_rows, best_dist = rows, dist
+        return best_rows
+
+    def search(self, queries, k=1):
+        queries = _as_matrix(queries, self.dim)
+        if self._size == 0 or k <= 0:
+            return _empty_result(len(queries), max(k, 0))
+
+        kk = min(k, self._size)
+        fetch = min(max(k, self.rerank), self._size)
+        candidates = self._coarse_search(queries, fetch)
+
+        #-----------------------------------------------#
+        #   精排: 候选的 float32 原始特征与查询的精确距离
+        #-----------------------------------------------#
+        exact = self._store.take(self._slots[candidates.reshape(-1)]).reshape(len(queries), fetch, self.dim)
+        diff = exact - queries[:, None, :]
+        sq_dist = np.einsum('qfd,qfd->qf', diff, diff)
+        order = np.argsort(sq_dist, axis=1)[:, :kk]
+
+        distances, ids = _empty_result(len(queries), k)
+        distances[:, :kk] = np.sqrt(np.take_along_axis(sq_dist, order, axis=1))
+        ids[:, :kk] = self._ids[np.take_along_axis(candidates, order, axis=1)]
+        return distances, ids
+
+    def _reserve(self, size):
+        capacity = self._codes.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+
+        def grow(array, fill):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            return grown
+
+        self._codes = grow(self._codes, 0)
+        self._scales = grow(self._scales, 1)
+        self._sq_norms = grow(self._sq_norms, 0)
+        self._ids = grow(self._ids, -1)
+        self._slots = grow(self._slots, -1)
+
+
+class Float16Index(QuantizedIndex):
+    """
+    float16 粗排, 每条特征常驻内存约 256 字节
+    粗排时间主要花在 float16 -> float32 的转换上, 单个查询比 ExactIndex 慢数倍,
+    只适合内存受限的场景; 兼顾速度时使用 Int8Index
+    """
+
+    CODE_DTYPE = np.float16
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+
+
+class Int8Index(QuantizedIndex):
+    """逐向量缩放的 int8 粗排: x ≈ code * scale, scale = max|x| / 127, 每条特征常驻内存约 128 字节"""
+
+    CODE_DTYPE = np.int8
+
+    def encode(self, vectors):
+        scales = np.max(np.abs(vectors), axis=1) / 127.0
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales
+
+
+def _import_faiss():
+    try:
+        import faiss
+        return faiss
+    except ImportError:
+        logger.error("❌ faiss 未安装. Run: pip install faiss-cpu")
+        raise
+
+
+class HNSWIndex:
+    """
+    faiss HNSW 近似检索索引
+    HNSW 不支持物理删除, 删除的条目先做标记并在检索时过滤,
+    标记数量超过 rebuild_ratio 时整体重建
+    """
+
+    def __init__(self, dim=128, M=32, ef_construction=100, ef_search=128, rebuild_ratio=0.2):
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.rebuild_ratio = rebuild_ratio
+        self._faiss = _import_faiss()
+        self._reset()
+
+    def _reset(self):
+        self._index = self._faiss.IndexHNSWFlat(self.dim, self.M)
+        self._index.hnsw.efConstruction = self.ef_construction
+        self._index.hnsw.efSearch = self.ef_search
+        self._labels = np.empty(0, dtype=np.int64)   # faiss 内部序号 -> 外部标识, 已删除为 -1
+        self._rows = {}
+        self._deleted = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def memory_usage(self):
+        # 原始向量 + 每层约 2M 个邻居 (int32)
+        ntotal = self._index.ntotal
+        return {'resident_bytes': int(ntotal * (self.dim * 4 + self.M * 2 * 4) + self._labels.nbytes)}
+
+    def copy(self):
+        other = HNSWIndex.__new__(HNSWIndex)
+        other.__dict__.update(self.__dict__)
+        other._index = self._faiss.clone_index(self._index)
+        other._index.hnsw.efSearch = self.ef_search
+        other._labels = self._labels.copy()
+        other._rows = dict(self._rows)
+        return other
+
+    def add(self, ids, vectors):
+        vectors = _as_matrix(vectors, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        start = self._index.ntotal
+        self._index.add(vectors)
+        self._labels = np.concatenate([self._labels, ids])
+        self._rows.update(zip(ids.tolist(), range(start, start + len(ids))))
+
+    def remove(self, ids):
+        removed = 0
+        for entry_id in np.asarray(ids, dtype=np.int64).reshape(-1).tolist():
+            label = self._rows.pop(entry_id, None)
+            if label is None:
+                continue
+            self._labels[label] = -1
+            self._deleted += 1
+            removed += 1
+        if self._deleted > self.rebuild_ratio * max(self._index.ntotal, 1):
+            self._rebuild()
+        return removed
+
+    def search(self, queries, k=1):
+        queries = _as_matrix(queries, self.dim)
+        if len(self) == 0 or k <= 0:
+            return _empty_result(len(queries), max(k, 0))
+
+        #-----------------------------------------------#
+        #   有删除标记时多取一些候选再过滤
+        #-----------------------------------------------#
+        fetch = min(self._index.ntotal, k if self._deleted == 0 else max(2 * k, k + 32))
+        sq_dist, labels = self._index.search(queries, fetch)
+        ids = np.where(labels >= 0, self._labels[np.maximum(labels, 0)], -1)
+
+        distances, result_ids = _empty_result(len(queries), k)
+        for i in range(len(queries)):
+            valid = np.flatnonzero(ids[i] >= 0)[:k]
+            distances[i, :len(valid)] = np.sqrt(np.maximum(sq_dist[i, valid], 0.0))
+            result_ids[i, :len(valid)] = ids[i, valid]
+        return distances, result_ids
+
+    def _rebuild(self):
+        alive = np.flatnonzero(self._labels >= 0)
+        vectors = self._index.reconstruct_n(0, self._index.ntotal)[alive]
+        ids = self._labels[alive]
+        self._reset()
+        if len(ids) > 0:
+            self.add(ids, vectors)
+        logger.info(f"HNSW 索引已重建, 共 {len(ids)} 条")
+
+
+class IVFPQIndex:
+    """
+    faiss IVF-PQ 近似检索索引
+    需要先训练聚类中心和码本: 数据量不足 train_size 前使用暴力检索,
+    达到后自动训练并迁移到 IVF-PQ
+    PQ 的距离是近似值, 不能直接与登录阈值比较: 先取 rerank 个候选,
+    再用 VectorStore 中的 float32 原始特征计算精确距离 (与 QuantizedIndex 相同)
+    """
+
+    def __init__(self, dim=128, nlist=1024, m=16, nbits=8, nprobe=16, train_size=None, rerank=64,
+                 in_memory=False, store_dir=None, chunk_rows=65536):
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.train_size = train_size or nlist * 39
+        self._faiss = _import_faiss()
+        self._index = None
+        self._pending = ExactIndex(dim)
+        self._store = VectorStore(dim, chunk_rows=chunk_rows, in_memory=in_memory, directory=store_dir)
+        self._slots = {}    # 条目ID -> VectorStore 中的行号
+
+    def __len__(self):
+        if self._index is None:
+            return len(self._pending)
+        return self._index.ntotal
+
+    @property
+    def is_trained(self):
+        return self._index is not None
+
+    def memory_usage(self):
+        if self._index is None:
+            resident = self._pending.memory_usage()['resident_bytes']
+        else:
+            # 每条 m*nbits/8 字节的编码 + 8 字节 id, 另加聚类中心和码本; 精排特征默认在内存映射文件中
+            ntotal = self._index.ntotal
+            codebooks = self.nlist * self.dim * 4 + self.m * (1 << self.nbits) * (self.dim // self.m) * 4
+            resident = ntotal * (self.m * self.nbits // 8 + 8) + codebooks
+        return {
+            'resident_bytes': int(resident + self._store.resident_bytes()),
+            'rerank_store_bytes': int(self._store.nbytes()),
+            'rerank_store': 'memory' if self._store.in_memory else 'mmap',
+        }
+
+    def copy(self):
+        # float32 存储只追加, 新旧版本共用
+        other = IVFPQIndex.__new__(IVFPQIndex)
+        other.__dict__.update(self.__dict__)
+        other._slots = dict(self._slots)
+        if self._index is None:
+            other._pending = self._pending.copy()
+        else:
+            other._index = self._faiss.clone_index(self._index)
+            other._index.nprobe = self.nprobe
+        return other
+
+    def add(self, ids, vectors):
+        vectors = _as_matrix(vectors, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        self._slots.update(zip(ids.tolist(), self._store.append(vectors).tolist()))
+        if self._index is None:
+            self._pending.add(ids, vectors)
+            if len(self._pending) >= self.train_size:
+                self._train()
+            return
+        self._index.add_with_ids(vectors, ids)
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        for entry_id in ids.tolist():
+            self._slots.pop(entry_id, None)
+        if self._index is None:
+            return self._pending.remove(ids)
+        return int(self._index.remove_ids(ids))
+
+    def search(self, queries, k=1):
+        if self._index is None:
+            return self._pending.search(queries, k)
+        queries = _as_matrix(queries, self.dim)
+        if k <= 0 or self._index.ntotal == 0:
+            return _empty_result(len(queries), max(k, 0))
+
+        fetch = min(max(k, self.rerank), self._index.ntotal)
+        _, candidates = self._index.search(queries, fetch)
+
+        #-----------------------------------------------#
+        #   精排: 候选的 float32 原始特征与查询的精确距离
+        #-----------------------------------------------#
+        valid = candidates >= 0
+        slots = np.array([self._slots.get(entry_id, -1) for entry_id in candidates.reshape(-1).tolist()],
+                         dtype=np.int64).reshape(candidates.shape)
+        valid &= slots >= 0
+        exact = self._store.take(np.where(valid, slots, 0).reshape(-1)).reshape(len(queries), fetch, self.dim)
+        diff = exact - queries[:, None, :]
+        sq_dist = np.where(valid, np.einsum('qfd,qfd->qf', diff, diff), np.inf)
+        kk = min(k, fetch)
+        order = np.argsort(sq_dist, axis=1)[:, :kk]
+
+        distances, result_ids = _empty_result(len(queries), k)
+        top_dist = np.take_along_axis(sq_dist, order, axis=1)
+        top_ids = np.take_along_axis(candidates, order, axis=1)
+        found = np.isfinite(top_dist)
+        distances[:, :kk] = np.where(found, np.sqrt(np.where(found, top_dist, 0.0)), np.inf)
+        result_ids[:, :kk] = np.where(found, top_ids, -1)
+        return distances, result_ids
+
+    def _train(self):
+        faiss = self._faiss
+        quantizer = faiss.IndexFlatL2(self.dim)
+        index = faiss.IndexIVFPQ(quantizer, self.dim, self.nlist, self.m, self.nbits)
+        vectors = np.ascontiguousarray(self._pending.vectors)
+        index.train(vectors)
+        index.nprobe = self.nprobe
+        index.add_with_ids(vectors, np.ascontiguousarray(self._pending.ids))
+        self._quantizer = quantizer
+        self._index = index
+        self._pending = None
+        logger.info(f"IVF-PQ 索引训练完成, 共 {index.ntotal} 条")
+
+
+class LayeredIndex:
+    """
+    写时复制用的分层索引: 共享只读的基础索引 base + 新增的条目 delta (ExactIndex) + base 中已删除的条目 dead
+    copy() 只复制 delta 和 dead, 单条写入的代价与底库规模无关;
+    增量累积到一定数量后由 compacted() 合并出新的基础索引 (O(N), 由 FaceGallery 摊销/定时执行)
+    remove 的 ids 须为索引中已有的条目 (条目ID 不重复使用)
+    """
+
+    def __init__(self, base, delta=None, dead=None):
+        self.base = base
+        self.dim = base.dim
+        self.delta = delta if delta is not None else ExactIndex(self.dim)
+        self.dead = dead if dead is not None else set()
+
+    def __len__(self):
+        return len(self.base) - len(self.dead) + len(self.delta)
+
+    def pending_changes(self):
+        """尚未合并进基础索引的改动数"""
+        return len(self.delta) + len(self.dead)
+
+    def memory_usage(self):
+        usage = dict(self.base.memory_usage())
+        usage['resident_bytes'] += self.delta.memory_usage()['resident_bytes']
+        usage['delta_entries'] = len(self.delta)
+        usage['deleted_entries'] = len(self.dead)
+        return usage
+
+    def copy(self):
+        return LayeredIndex(self.base, self.delta.copy(), set(self.dead))
+
+    def compacted(self):
+        """合并增量, 返回以新基础索引为底、没有增量的 LayeredIndex (不修改当前对象)"""
+        base = self.base.copy()
+        if self.dead:
+            base.remove(np.fromiter(self.dead, dtype=np.int64, count=len(self.dead)))
+        if len(self.delta):
+            base.add(self.delta.ids, self.delta.vectors)
+        return LayeredIndex(base)
+
+    def add(self, ids, vectors):
+        self.delta.add(ids, vectors)
+
+    def remove(self, ids):
+        removed = 0
+        for entry_id in np.asarray(ids, dtype=np.int64).reshape(-1).tolist():
+            if entry_id in self.delta:
+                removed += self.delta.remove([entry_id])
+            elif entry_id not in self.dead:
+                self.dead.add(entry_id)
+                removed += 1
+        return removed
+
+    def search(self, queries, k=1):
+        queries = _as_matrix(queries, self.dim)
+        distances, ids = self._search_base(queries, k)
+        if len(self.delta) == 0 or k <= 0:
+            return distances, ids
+
+        delta_dist, delta_ids = self.delta.search(queries, k)
+        distances = np.concatenate([distances, delta_dist], axis=1)
+        ids = np.concatenate([ids, delta_ids], axis=1)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def _search_base(self, queries, k):
+        distances, ids = self.base.search(queries, k)
+        if not self.dead or k <= 0:
+            return distances, ids
+
+        #-----------------------------------------------#
+        #   结果中含已删除的条目时, 只对这些查询
+        #   多取 len(dead) 个再过滤, 保证剩下的仍有 k 个
+        #-----------------------------------------------#
+        dead = np.fromiter(self.dead, dtype=np.int64, count=len(self.dead))
+        retry = np.flatnonzero(np.isin(ids, dead).any(axis=1))
+        if len(retry) == 0:
+            return distances, ids
+        retry_dist, retry_ids = self.base.search(queries[retry], k + len(dead))
+        is_dead = np.isin(retry_ids, dead)
+        order = np.argsort(is_dead, axis=1, kind='stable')[:, :k]
+        keep = ~np.take_along_axis(is_dead, order, axis=1)
+        distances[retry] = np.where(keep, np.take_along_axis(retry_dist, order, axis=1), np.inf)
+        ids[retry] = np.where(keep, np.take_along_axis(retry_ids, order, axis=1), -1)
+        return distances, ids
+
+
+INDEX_TYPES = {
+    'exact': ExactIndex,
+    'float16': Float16Index,
+    'int8': Int8Index,
+    'hnsw': HNSWIndex,
+    'ivfpq': IVFPQIndex,
+}
+
+
+def create_index(index_type='exact', dim=128, **options):
+    """按类型创建检索索引"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，请使用: {', '.join(INDEX_TYPES)}")
+    return INDEX_TYPES[index_type](dim=dim, **options)
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#-------------------------------------------------------#
+#   人脸底库的增量同步
+#   user_face / users 上的触发器把每次变更写入 face_change_log
+#   (见 setup_face_change_log.py), 各节点后台线程按自增 id 轮询,
+#   只重新加载涉及的用户, 每次轮询的开销与变更数成正比;
+#   另外定期做一次全量对账, 兜底以下情况:
+#       - 并发事务的自增 id 提交顺序与分配顺序不一致, 水位越过了晚提交的记录
+#       - 变更日志被清理, 或变更日志表尚未创建
+#   每轮轮询后顺带把底库中积累的增量合并进基础索引 (见 FaceGallery.compact)
+#-------------------------------------------------------#
+
+
+class GallerySync:
+    """
+    按变更日志增量刷新 FaceGallery
+    watermark 为已应用的最大变更 id, 为 None 时说明变更日志不可用, 只做定期全量对账
+    """
+
+    def __init__(self, gallery, db_manager, poll_interval=2.0, reconcile_interval=600.0, batch_size=1000):
+        self.gallery = gallery
+        self.db_manager = db_manager
+        self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+
+        self.watermark = None
+        self.last_reconcile = None
+        self._lock = threading.Lock()   # 轮询与对账互斥
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            'polls': 0,
+            'changes': 0,
+            'removed': 0,
+            'added': 0,
+            'reconciles': 0,
+            'errors': 0,
+        }
+
+    #-----------------------------------------------#
+    #   全量对账
+    #-----------------------------------------------#
+    def reconcile(self):
+        """
+        全量重新加载底库, 返回加载的条数
+        先记录变更日志水位再加载, 加载期间的变更会在下次轮询时再应用一遍 (重复应用是幂等的)
+        """
+        with self._lock:
+            watermark = None
+            if self.db_manager.has_change_log(refresh=True):
+                watermark = self.db_manager.get_max_change_id()
+            count = self.gallery.load_from_db(self.db_manager, strict=True)
+            self.watermark = watermark
+            self.last_reconcile = time.monotonic()
+            self._stats['reconciles'] += 1
+            return count
+
+    #-----------------------------------------------#
+    #   增量轮询
+    #-----------------------------------------------#
+    def poll_once(self):
+        """
+        应用水位之后的全部变更, 返回应用的变更条数
+        每条变更只记录 (user_id, face_id), 应用时删除这些用户/人脸的现有条目,
+        再按 user_id 重新查询一次 (已删除或已禁用的用户查不到, 即为删除)
+        """
+        with self._lock:
+            if self.watermark is None:
+                return 0
+            applied = 0
+            while True:
+                changes = self.db_manager.get_face_changes(self.watermark, self.batch_size)
+                if changes is None:
+                    raise RuntimeError("读取人脸变更日志失败")
+                if not changes:
+                    break
+
+                user_ids = {change['user_id'] for change in changes if change.get('user_id') is not None}
+                face_ids = {change['face_id'] for change in changes if change.get('face_id')}
+                rows = self.db_manager.get_all_face_users(user_ids=user_ids, strict=True)
+                removed, added = self.gallery.apply_changes(user_ids | face_ids, rows)
+
+                self.watermark = changes[-1]['id']
+                applied += len(changes)
+                self._stats['removed'] += removed
+                self._stats['added'] += added
+                if len(changes) < self.batch_size:
+                    break
+
+            self._stats['polls'] += 1
+            self._stats['changes'] += applied
+            if applied:
+                logger.info(f"人脸底库增量同步: {applied} 条变更, 水位 {self.watermark}, 底库 {len(self.gallery)} 条")
+            return applied
+
+    def _reconcile_due(self):
+        if self.reconcile_interval is None or self.reconcile_interval <= 0:
+            return False
+        return self.last_reconcile is None or time.monotonic() - self.last_reconcile >= self.reconcile_interval
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self._reconcile_due():
+                    count = self.reconcile()
+                    logger.info(f"人脸底库全量对账完成, 共 {count} 条, 水位 {self.watermark}")
+                else:
+                    self.poll_once()
+                self.gallery.compact()
+            except Exception as e:
+                self._stats['errors'] += 1
+                logger.error(f"人脸底库同步失败: {e}")
+
+    #-----------------------------------------------#
+    #   后台线程
+    #-----------------------------------------------#
+    def start(self):
+        """
+        启动后台同步线程
+        线程不会被 fork 继承, 多进程部署时在每个子进程 fork 之后调用
+        """
+        if self.poll_interval is None or self.poll_interval <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self.watermark is None:
+            logger.warning("人脸变更日志不可用 (请运行 setup_face_change_log.py), 只做定期全量对账")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='gallery-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 5)
+            self._thread = None
+
+    def stats(self):
+        """同步状态 (水位/距上次对账的秒数/累计应用的变更数等)"""
+        stats = dict(self._stats)
+        stats['watermark'] = self.watermark
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        stats['seconds_since_reconcile'] = (
+            round(time.monotonic() - self.last_reconcile, 1) if self.last_reconcile is not None else None
+        )
+        return stats
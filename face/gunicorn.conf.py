@@ -0,0 +1,38 @@
+"""
+gunicorn 配置: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+
+bind = os.environ.get('FACE_BIND', '0.0.0.0:5000')
+
+# 主进程预加载底库后再 fork, 子进程共享底库内存;
+# 模型只在 onnx 后端时预加载, keras 后端在 post_fork 中由每个子进程各自加载 (见 wsgi.py)
+preload_app = True
+# 与 wsgi.py 中计算 tensorflow 线程数时使用的进程数保持一致
+workers = int(os.environ.get('FACE_WORKERS', os.cpu_count() or 1))
+
+# 底库为不可变快照, 每个进程可以开多个线程处理请求,
+# 并发请求的 Rnet/Onet/facenet 输入由微批调度器合并推理
+worker_class = 'gthread'
+threads = int(os.environ.get('FACE_THREADS', 4))
+
+# 预热和大图识别可能较慢
+timeout = 120
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    """子进程在开始接收请求之前加载 (keras 后端) 并预热模型"""
+    from wsgi import warm_up
+    warm_up()
+    server.log.info(f"worker {worker.pid} 模型预热完成")
+
+
+def child_exit(server, worker):
+    """多进程 Prometheus 指标: 清理已退出进程的指标文件"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    server.log.info(f"人脸识别API已启动, 工作进程数: {workers}, 每进程线程数: {threads}")
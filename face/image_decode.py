@@ -0,0 +1,114 @@
+import base64
+import binascii
+import struct
+
+import cv2
+import numpy as np
+
+#-------------------------------------------------------#
+#   图片解码
+#   统一处理原始字节 / base64 (含 data:image 前缀) / 上传文件,
+#   只读取文件头获得尺寸, 远大于检测器工作尺寸 (短边500) 的
+#   JPEG 直接用 IMREAD_REDUCED_* 在解码时按 1/2, 1/4, 1/8 缩小,
+#   EXIF 方向由 cv2.imdecode 自动校正
+#-------------------------------------------------------#
+
+DETECT_SIZE = 500
+
+REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# JPEG 中表示帧头 (包含宽高) 的标记, 排除 DHT(C4) / JPG(C8) / DAC(CC)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class ImageDecodeError(ValueError):
+    """图片数据无法解码"""
+
+
+def read_image_bytes(source):
+    """
+    取出图片的原始字节
+    source 可以是 bytes / base64字符串 / 带 read() 的文件对象 (如 Flask 的 request.files)
+    """
+    if hasattr(source, 'read'):
+        source = source.read()
+    if isinstance(source, str):
+        # 移除 data:image/...;base64, 前缀
+        if ',' in source[:100]:
+            source = source.split(',', 1)[1]
+        try:
+            source = base64.b64decode(source)
+        except (binascii.Error, ValueError) as e:
+            raise ImageDecodeError(f"base64解码错误: {e}")
+    if not isinstance(source, (bytes, bytearray, memoryview)):
+        raise ImageDecodeError(f"不支持的图片数据类型: {type(source).__name__}")
+    if len(source) == 0:
+        raise ImageDecodeError("图片数据为空")
+    return source
+
+
+def image_size(data):
+    """
+    只解析文件头获取 (宽, 高), 支持 JPEG 和 PNG, 其他格式返回 None
+    """
+    data = bytes(data[:64 * 1024]) if len(data) > 64 * 1024 else bytes(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height
+
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        # 跳过当前段 (长度字段包含自身的2字节)
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        pos += 2 + length
+    return None
+
+
+def reduction_factor(width, height, min_side=DETECT_SIZE):
+    """解码后短边不小于 min_side 的最大缩小倍数"""
+    short_side = min(width, height)
+    for factor, _ in REDUCED_FLAGS:
+        if short_side // factor >= min_side:
+            return factor
+    return 1
+
+
+def decode_image(source, min_side=DETECT_SIZE):
+    """
+    解码为 BGR 图像
+    Args:
+        source: bytes / base64字符串 / 文件对象
+        min_side: 解码后短边的最小值, 为 None 时按原始尺寸解码
+    Returns:
+        numpy.ndarray: BGR 图像
+    Raises:
+        ImageDecodeError: 数据无法解码
+    """
+    data = read_image_bytes(source)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    flag = cv2.IMREAD_COLOR
+    size = image_size(data) if min_side else None
+    if size is not None:
+        factor = reduction_factor(size[0], size[1], min_side)
+        flag = dict(REDUCED_FLAGS).get(factor, cv2.IMREAD_COLOR)
+
+    image = cv2.imdecode(buffer, flag)
+    if image is None:
+        raise ImageDecodeError("无法识别的图片格式")
+    return image
@@ -0,0 +1,133 @@
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 所有存活的调度器, fork 后在子进程中统一重建工作线程
+_schedulers = weakref.WeakSet()
+
+
+class BatchedModel:
+    """
+    跨请求的微批推理调度器
+    多个请求线程并发调用 predict 时, 后台工作线程把它们的输入
+    在 max_wait_ms 的等待窗口内合并成一批, 只做一次前向传播,
+    再按各自的行数拆分结果返回。
+
+    接口与 Keras 模型的 predict 保持一致, 可直接替换
+    mtcnn 的 Rnet/Onet 以及 facenet 模型。
+    """
+
+    def __init__(self, model, max_batch=64, max_wait_ms=5, max_queue=256, name=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name or getattr(model, 'name', 'model')
+        self.max_queue = max_queue
+        self._start()
+        _schedulers.add(self)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._worker = threading.Thread(target=self._run, name=f"batch-{self.name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, inputs, batch_size=None):
+        """
+        提交一批输入, 返回 Future (结果与 model.predict(inputs) 相同)
+        batch_size 为单次前向传播的最大行数, 合并后的批次按组内最小的 batch_size 分段推理
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError(f"batch_size 必须为正整数: {batch_size}")
+        future = Future()
+        self._queue.put((np.asarray(inputs), batch_size, future))
+        return future
+
+    def predict(self, inputs, batch_size=None, **kwargs):
+        """同步调用, 阻塞直到所在的批次推理完成"""
+        if len(inputs) == 0:
+            return self.model.predict(inputs, **kwargs)
+        return self.submit(inputs, batch_size).result()
+
+    def _collect(self):
+        """取出一个批次: 等到凑满 max_batch 行或超过 max_wait 为止"""
+        items = [self._queue.get()]
+        rows = len(items[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            rows += len(item[0])
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            #-----------------------------------------------#
+            #   输入形状不同的请求 (如不同尺寸) 不能合并,
+            #   按形状分组后分别推理
+            #-----------------------------------------------#
+            groups = {}
+            for inputs, batch_size, future in items:
+                groups.setdefault(inputs.shape[1:], []).append((inputs, batch_size, future))
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group):
+        group = [
+            (inputs, batch_size, future) for inputs, batch_size, future in group
+            if future.set_running_or_notify_cancel()
+        ]
+        if not group:
+            return
+        try:
+            batch = np.concatenate([inputs for inputs, _, _ in group], axis=0)
+            # 每次前向传播不超过组内任何调用方要求的 batch_size
+            limits = [batch_size for _, batch_size, _ in group if batch_size is not None]
+            outputs = self.model.predict(batch, batch_size=min(limits + [len(batch)]), verbose=0)
+        except Exception as e:
+            logger.error(f"{self.name} 批量推理失败: {e}")
+            for _, _, future in group:
+                future.set_exception(e)
+            return
+
+        #-----------------------------------------------#
+        #   按每个请求的行数拆分结果,
+        #   多输出模型 (如 Rnet/Onet) 的每个输出分别拆分
+        #-----------------------------------------------#
+        multi_output = isinstance(outputs, (list, tuple))
+        start = 0
+        for inputs, _, future in group:
+            end = start + len(inputs)
+            if multi_output:
+                future.set_result([output[start:end] for output in outputs])
+            else:
+                future.set_result(outputs[start:end])
+            start = end
+
+
+#-----------------------------------------------#
+#   预加载模型后再 fork 的多进程部署 (见 wsgi.py) 中,
+#   子进程不会继承工作线程, 需要重新创建;
+#   模块级只注册一次 (at-fork 回调无法注销)
+#-----------------------------------------------#
+def _schedulers_after_fork():
+    for scheduler in list(_schedulers):
+        scheduler._start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_schedulers_after_fork)
@@ -0,0 +1,162 @@
+import contextvars
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+#-------------------------------------------------------#
+#   Prometheus 指标与请求追踪
+#   指标:
+#       face_stage_seconds{stage}      各阶段耗时: decode / pnet / rnet / onet /
+#                                      align / embed / search / db
+#       face_request_seconds{endpoint} 接口总耗时
+#       face_detected_faces            每次识别检测到的人脸数
+#       face_match_total{result}       识别结果: match / no_match / no_face
+#       face_gallery_size              当前进程的底库条数
+#   prometheus_client 为可选依赖, 未安装时所有记录函数为空操作, /metrics 返回503;
+#   gunicorn 多进程部署时设置 PROMETHEUS_MULTIPROC_DIR, 由各进程的指标文件汇总
+#
+#   追踪: 每个请求一个 trace id (优先使用请求头 X-Request-ID),
+#   经 contextvars 注入到该请求线程的所有日志中, 并在响应头中返回
+#-------------------------------------------------------#
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+TRACE_HEADER = 'X-Request-ID'
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s'
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FACE_BUCKETS = (0, 1, 2, 3, 5, 10, 20)
+
+_trace_id = contextvars.ContextVar('trace_id', default='-')
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'face_stage_seconds', '人脸识别各阶段耗时(秒)', ['stage'], buckets=STAGE_BUCKETS
+    )
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'face_request_seconds', '接口总耗时(秒)', ['endpoint'], buckets=STAGE_BUCKETS
+    )
+    DETECTED_FACES = prometheus_client.Histogram(
+        'face_detected_faces', '每次识别检测到的人脸数', buckets=FACE_BUCKETS
+    )
+    MATCH_TOTAL = prometheus_client.Counter(
+        'face_match_total', '识别结果计数', ['result']
+    )
+    GALLERY_SIZE = prometheus_client.Gauge(
+        'face_gallery_size', '人脸底库条数', multiprocess_mode='liveall'
+    )
+
+
+def enabled():
+    return prometheus_client is not None
+
+
+#-----------------------------------------------#
+#   指标记录
+#-----------------------------------------------#
+def observe_stage(stage, seconds):
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_timings(timings):
+    """记录 recognize_face / detectFace 填充的阶段耗时字典"""
+    if prometheus_client is not None:
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_request(endpoint, seconds):
+    if prometheus_client is not None:
+        REQUEST_SECONDS.labels(endpoint).observe(seconds)
+
+
+def observe_recognition(faces_detected, matched):
+    if prometheus_client is not None:
+        DETECTED_FACES.observe(faces_detected)
+        MATCH_TOTAL.labels('no_face' if faces_detected == 0 else 'match' if matched else 'no_match').inc()
+
+
+def set_gallery_size(size):
+    if prometheus_client is not None:
+        GALLERY_SIZE.set(size)
+
+
+class stage_timer:
+    """with stage_timer('db'): ... 记录代码块的耗时"""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def render():
+    """
+    导出指标文本
+    Returns:
+        (body, content_type), 未安装 prometheus_client 时返回 (None, None)
+    """
+    if prometheus_client is None:
+        return None, None
+    registry = prometheus_client.REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """gunicorn 工作进程退出时清理其多进程指标文件"""
+    if prometheus_client is not None and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+#-----------------------------------------------#
+#   请求追踪
+#-----------------------------------------------#
+def start_trace(trace_id=None):
+    """为当前请求设置 trace id, 返回 (trace_id, 用于 end_trace 的 token)"""
+    trace_id = (trace_id or uuid.uuid4().hex[:16])[:64]
+    return trace_id, _trace_id.set(trace_id)
+
+
+def end_trace(token):
+    _trace_id.reset(token)
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """把当前请求的 trace id 写入日志记录的 trace_id 字段"""
+
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+
+def install_trace_logging():
+    """为根日志的所有 handler 加上 trace id (重复调用无副作用)"""
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=logging.INFO)
+    for handler in root.handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
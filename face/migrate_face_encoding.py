@@ -0,0 +1,175 @@
+"""
+user_face.face_encoding 迁移工具
+将JSON文本格式的人脸特征批量转换为二进制格式 (embedding_codec)
+
+用法:
+    python migrate_face_encoding.py                  # 创建二进制列并迁移全部数据
+    python migrate_face_encoding.py --dry-run        # 只统计, 不写库
+
+文本列 face_encoding 仍是 Java 端唯一读取的格式, 迁移后保留不动。
+迁移同时创建 BEFORE UPDATE 触发器: 只改了文本列 (如 Java 端重新注册) 而没有同时写入二进制列时,
+把二进制列置空, 读取时回退到新的文本特征, 避免过期的二进制特征继续参与比对。
+
+同时会创建多模板列 face_templates_bin (同一用户的其他人脸特征, float16, 见 embedding_codec)
+"""
+import argparse
+import json
+
+import pymysql
+
+from database_config import db_manager
+from embedding_codec import encode_embedding, parse_embedding_text, EmbeddingFormatError
+
+EMBEDDING_DIM = 128
+
+
+def ensure_binary_column(dry_run=False):
+    """确保 user_face 表存在二进制特征列"""
+    if db_manager.has_binary_embedding_column(refresh=True):
+        return True
+    if dry_run:
+        print(f"ℹ️  将创建列 user_face.{db_manager.BINARY_EMBEDDING_COLUMN}")
+        return False
+
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"ALTER TABLE user_face ADD COLUMN {db_manager.BINARY_EMBEDDING_COLUMN} VARBINARY(1024) NULL"
+        )
+    print(f"✅ 已创建列 user_face.{db_manager.BINARY_EMBEDDING_COLUMN}")
+    return db_manager.has_binary_embedding_column(refresh=True)
+
+
+def ensure_templates_column(dry_run=False):
+    """确保 user_face 表存在多模板列 (最多 MAX_TEMPLATES 个 float16 模板)"""
+    if db_manager.has_templates_column(refresh=True):
+        return True
+    if dry_run:
+        print(f"ℹ️  将创建列 user_face.{db_manager.TEMPLATES_COLUMN}")
+        return False
+
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"ALTER TABLE user_face ADD COLUMN {db_manager.TEMPLATES_COLUMN} VARBINARY(4096) NULL"
+        )
+    print(f"✅ 已创建列 user_face.{db_manager.TEMPLATES_COLUMN}")
+    return db_manager.has_templates_column(refresh=True)
+
+
+def ensure_invalidation_trigger(dry_run=False):
+    """
+    创建触发器: face_encoding 变化而二进制列未同时更新时, 清空二进制列;
+    多模板列同理 (主特征换了, 旧的其他模板也不再属于这个人)
+    """
+    trigger = db_manager.BINARY_INVALIDATION_TRIGGER
+    column = db_manager.BINARY_EMBEDDING_COLUMN
+    if dry_run:
+        print(f"ℹ️  将创建触发器 {trigger}")
+        return
+    templates = db_manager.TEMPLATES_COLUMN
+    clear_templates = f"""
+            IF NOT (NEW.face_encoding <=> OLD.face_encoding)
+               AND NEW.{templates} <=> OLD.{templates} THEN
+                SET NEW.{templates} = NULL;
+            END IF;""" if db_manager.has_templates_column() else ""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute(f"""
+        CREATE TRIGGER {trigger} BEFORE UPDATE ON user_face
+        FOR EACH ROW
+        BEGIN
+            IF NOT (NEW.face_encoding <=> OLD.face_encoding)
+               AND NEW.{column} <=> OLD.{column} THEN
+                SET NEW.{column} = NULL;
+            END IF;{clear_templates}
+        END
+        """)
+    print(f"✅ 已创建触发器 {trigger}")
+
+
+def migrate(chunk_size=500, dry_run=False):
+    """
+    分批迁移人脸特征
+    按 (user_id, face_id) 做键集分页, 每批在一个事务内写回:
+        - 正常数据: 写入二进制列
+        - 历史错误格式 (截断/CSV): 修复后同时把文本列规范化为标准JSON
+        - 无法解析的数据: 跳过并记录
+    """
+    has_column = ensure_binary_column(dry_run)
+    # 先建触发器再回填, 迁移期间 Java 端改写的行也会被置空重新迁移
+    ensure_invalidation_trigger(dry_run)
+    column = db_manager.BINARY_EMBEDDING_COLUMN
+    stats = {'total': 0, 'converted': 0, 'repaired': 0, 'failed': 0}
+    last_key = (-1, '')
+
+    while True:
+        with db_manager.get_connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+            pending = f"AND {column} IS NULL" if has_column else ""
+            sql = f"""
+            SELECT user_id, IFNULL(face_id, '') AS face_id, face_encoding
+            FROM user_face
+            WHERE face_encoding IS NOT NULL {pending}
+              AND (user_id, IFNULL(face_id, '')) > (%s, %s)
+            ORDER BY user_id, IFNULL(face_id, '')
+            LIMIT %s
+            """
+            cursor.execute(sql, (last_key[0], last_key[1], chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_key = (rows[-1]['user_id'], rows[-1]['face_id'])
+
+            updates = []
+            for row in rows:
+                stats['total'] += 1
+                try:
+                    embedding, repaired = parse_embedding_text(row['face_encoding'])
+                    if embedding.shape != (EMBEDDING_DIM,):
+                        raise EmbeddingFormatError(f"维度错误: {embedding.shape}")
+                except EmbeddingFormatError as e:
+                    stats['failed'] += 1
+                    print(f"⚠️  user_id={row['user_id']} face_id={row['face_id'] or '-'} 无法解析: {e}")
+                    continue
+
+                stats['converted'] += 1
+                if repaired:
+                    stats['repaired'] += 1
+                text = json.dumps(embedding.tolist()) if repaired else row['face_encoding']
+                updates.append((encode_embedding(embedding), text, row['user_id'], row['face_id'], row['face_encoding']))
+
+            if updates and not dry_run:
+                conn.begin()
+                cursor.executemany(
+                    f"""
+                    UPDATE user_face SET {column} = %s, face_encoding = %s
+                    WHERE user_id = %s AND IFNULL(face_id, '') = %s AND face_encoding = %s
+                    """,
+                    updates
+                )
+                conn.commit()
+
+        print(f"📦 已处理 {stats['total']} 条 (转换 {stats['converted']}, 修复 {stats['repaired']}, 失败 {stats['failed']})")
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将 user_face.face_encoding 迁移为二进制格式")
+    parser.add_argument('--chunk-size', type=int, default=500, help="每批处理的行数")
+    parser.add_argument('--dry-run', action='store_true', help="只统计, 不写入数据库")
+    args = parser.parse_args()
+
+    if not db_manager.test_connection():
+        print("❌ 数据库连接失败，请检查配置")
+        return
+
+    ensure_templates_column(args.dry_run)
+    stats = migrate(chunk_size=args.chunk_size, dry_run=args.dry_run)
+    print(f"✅ 迁移完成: {stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,7 @@
 import cv2
 import numpy as np
-import tensorflow as tf
 import os
-from keras.layers import (Activation, Conv2D, Dense, Flatten, Input, MaxPool2D,
-                          Permute, Reshape, PReLU)
-from keras.models import Model, Sequential
+import time
 
 from utils import utils
 
@@ -14,6 +11,10 @@ from utils import utils
 #   输出bbox位置和是否有人脸
 #-----------------------------#
 def create_Pnet(weight_path):
+    # keras 在创建网络时才导入, 使用 onnxruntime 后端时无需加载 tensorflow
+    from keras.layers import Conv2D, Dense, Flatten, Input, MaxPool2D, Permute, PReLU
+    from keras.models import Model
+
     inputs = Input(shape=[None, None, 3])
 
     x = Conv2D(10, (3, 3), strides=1, padding='valid', name='conv1')(inputs)
@@ -39,6 +40,10 @@ def create_Pnet(weight_path):
 #   精修框
 #-----------------------------#
 def create_Rnet(weight_path):
+    # keras 在创建网络时才导入, 使用 onnxruntime 后端时无需加载 tensorflow
+    from keras.layers import Conv2D, Dense, Flatten, Input, MaxPool2D, Permute, PReLU
+    from keras.models import Model
+
     inputs = Input(shape=[24, 24, 3])
     # 24,24,3 -> 22,22,28 -> 11,11,28
     x = Conv2D(28, (3, 3), strides=1, padding='valid', name='conv1')(inputs)
@@ -76,6 +81,10 @@ def create_Rnet(weight_path):
 #   精修框并获得五个点
 #-----------------------------#
 def create_Onet(weight_path):
+    # keras 在创建网络时才导入, 使用 onnxruntime 后端时无需加载 tensorflow
+    from keras.layers import Conv2D, Dense, Flatten, Input, MaxPool2D, Permute, PReLU
+    from keras.models import Model
+
     inputs = Input(shape = [48,48,3])
     # 48,48,3 -> 46,46,32 -> 23,23,32
     x = Conv2D(32, (3, 3), strides=1, padding='valid', name='conv1')(inputs)
@@ -116,7 +125,7 @@ def create_Onet(weight_path):
     return model
 
 class mtcnn():
-    def __init__(self):
+    def __init__(self, batched_pnet=True, backend='keras'):
         # 获取当前脚本文件的目录
         current_dir = os.path.dirname(os.path.abspath(__file__))
         # 获取项目根目录（face文件夹）
@@ -124,27 +133,112 @@ class mtcnn():
         # 构建模型文件的绝对路径
         model_dir = os.path.join(project_root, 'model_data')
         
-        self.Pnet = create_Pnet(os.path.join(model_dir, 'pnet.h5'))
-        self.Rnet = create_Rnet(os.path.join(model_dir, 'rnet.h5'))
-        self.Onet = create_Onet(os.path.join(model_dir, 'onet.h5'))
-
-    def detectFace(self, img, threshold):
-        #-----------------------------#
-        #   归一化
-        #-----------------------------#
-        copy_img = (img.copy() - 127.5) / 127.5
-        origin_h, origin_w, _ = copy_img.shape
+        #-----------------------------------------------#
+        #   backend为'onnx'时使用 export_onnx.py 导出的模型,
+        #   由 onnxruntime 推理, 接口与 keras 模型相同
+        #-----------------------------------------------#
+        if backend == 'onnx':
+            from onnx_backend import OnnxModel, model_path
+            self.Pnet = OnnxModel(model_path(model_dir, 'pnet'))
+            self.Rnet = OnnxModel(model_path(model_dir, 'rnet'))
+            self.Onet = OnnxModel(model_path(model_dir, 'onet'))
+        else:
+            self.Pnet = create_Pnet(os.path.join(model_dir, 'pnet.h5'))
+            self.Rnet = create_Rnet(os.path.join(model_dir, 'rnet.h5'))
+            self.Onet = create_Onet(os.path.join(model_dir, 'onet.h5'))
+
+        #-----------------------------------------------#
+        #   batched_pnet为True时先缩放再用float32归一化，
+        #   并把整个图像金字塔拼接到一张画布上，
+        #   只需一次Pnet前向传播
+        #   为False时使用原始的逐层预测方式
+        #-----------------------------------------------#
+        self.batched_pnet = batched_pnet
+
+    def detectFace(self, img, threshold, min_face_size=None, top_k=None, timings=None):
+        """
+        Args:
+            min_face_size: 最小人脸尺寸(像素), 不为空时不计算更精细的金字塔层级
+            top_k: 不为空时只把 面积 x 得分 最高的 top_k 个Pnet候选框送入Rnet/Onet
+            timings: 不为空的字典时记录各阶段耗时(秒): pnet (含金字塔和NMS) / rnet / onet,
+                     提前结束时只包含已执行的阶段
+        """
+        start = time.perf_counter()
+        origin_h, origin_w, _ = img.shape
         #-----------------------------#
         #   计算原始输入图像
         #   每一次缩放的比例
         #-----------------------------#
-        scales = utils.calculateScales(img)
+        scales = utils.calculateScales(img, min_face_size)
 
-        out = []
         #-----------------------------#
         #   粗略计算人脸框
         #   pnet部分
         #-----------------------------#
+        if self.batched_pnet:
+            rectangles = self._detect_pnet_batched(img, scales, threshold[0])
+            crop_source = img
+        else:
+            #-----------------------------#
+            #   归一化
+            #-----------------------------#
+            copy_img = (img.copy() - 127.5) / 127.5
+            rectangles = self._detect_pnet(copy_img, scales, threshold[0])
+            crop_source = copy_img
+
+        #-------------------------------------#
+        #   进行非极大抑制
+        #   先在金字塔的每一层内部做NMS，
+        #   再对所有层的结果做一次全局NMS
+        #-------------------------------------#
+        if len(rectangles) == 0:
+            utils.record_stage(timings, 'pnet', start)
+            return np.empty((0, 5))
+        groups = np.repeat(np.arange(len(rectangles)), [len(r) for r in rectangles])
+        rectangles = np.concatenate(rectangles, axis=0)
+        rectangles = utils.batched_NMS(rectangles, groups, 0.5)
+        rectangles = utils.NMS(rectangles, 0.7)
+        if top_k is not None:
+            rectangles = utils.top_k_rectangles(rectangles, top_k)
+        start = utils.record_stage(timings, 'pnet', start)
+
+        if len(rectangles) == 0:
+            return rectangles
+
+        #-----------------------------#
+        #   稍微精确计算人脸框
+        #   Rnet部分
+        #-----------------------------#
+        predict_24_batch = self._crop_batch(crop_source, rectangles, 24)
+        cls_prob, roi_prob = self.Rnet.predict(predict_24_batch)
+        #-------------------------------------#
+        #   解码的过程
+        #-------------------------------------#
+        rectangles = utils.filter_face_24net(cls_prob, roi_prob, rectangles, origin_w, origin_h, threshold[1])
+        start = utils.record_stage(timings, 'rnet', start)
+
+        if len(rectangles) == 0:
+            return rectangles
+
+        #-----------------------------#
+        #   计算人脸框
+        #   onet部分
+        #-----------------------------#
+        predict_batch = self._crop_batch(crop_source, rectangles, 48)
+        cls_prob, roi_prob, pts_prob = self.Onet.predict(predict_batch)
+
+        #-------------------------------------#
+        #   解码的过程
+        #-------------------------------------#
+        rectangles = utils.filter_face_48net(cls_prob, roi_prob, pts_prob, rectangles, origin_w, origin_h, threshold[2])
+        utils.record_stage(timings, 'onet', start)
+
+        return rectangles
+
+    def _detect_pnet(self, copy_img, scales, threshold):
+        """逐层预测图像金字塔 (copy_img 为归一化后的图像)，返回每一层的候选框数组"""
+        origin_h, origin_w, _ = copy_img.shape
+        out = []
         for scale in scales:
             hs = int(origin_h * scale)
             ws = int(origin_w * scale)
@@ -165,10 +259,6 @@ class mtcnn():
         #   取出每张图片的种类预测和回归预测结果
         #-------------------------------------------------#
         for i in range(len(scales)):
-            #------------------------------------------------------------------#
-            #   为了方便理解，这里和视频上看到的不太一样
-            #   因为我们在上面对图像金字塔循环的时候就把batch_size维度给去掉了
-            #------------------------------------------------------------------#
             cls_prob = out[i][0][:, :, 1]
             roi = out[i][1]
             #-------------------------------------#
@@ -179,64 +269,68 @@ class mtcnn():
             #-------------------------------------#
             #   解码的过程
             #-------------------------------------#
-            rectangle = utils.detect_face_12net(cls_prob, roi, out_side, 1 / scales[i], origin_w, origin_h, threshold[0])
-            rectangles.extend(rectangle)
-
-        #-------------------------------------#
-        #   进行非极大抑制
-        #-------------------------------------#
-        rectangles = np.array(utils.NMS(rectangles, 0.7))
-
-        if len(rectangles) == 0:
-            return rectangles
+            rectangle = utils.detect_face_12net(cls_prob, roi, out_side, 1 / scales[i], origin_w, origin_h, threshold)
+            rectangles.append(rectangle)
+        return rectangles
 
-        #-----------------------------#
-        #   稍微精确计算人脸框
-        #   Rnet部分
-        #-----------------------------#
-        predict_24_batch = []
-        for rectangle in rectangles:
-            #------------------------------------------#
-            #   利用获取到的粗略坐标，在原图上进行截取
-            #------------------------------------------#
-            crop_img = copy_img[int(rectangle[1]):int(rectangle[3]), int(rectangle[0]):int(rectangle[2])]
-            #-----------------------------------------------#
-            #   将截取到的图片进行resize，调整成24x24的大小
-            #-----------------------------------------------#
-            scale_img = cv2.resize(crop_img, (24, 24))
-            predict_24_batch.append(scale_img)
+    def _detect_pnet_batched(self, img, scales, threshold):
+        """
+        将图像金字塔拼接到一张float32画布上，一次前向完成Pnet预测 (img 为原始uint8图像)
+        返回每一层的候选框数组
+        """
+        origin_h, origin_w, _ = img.shape
+        sizes = [(int(origin_h * scale), int(origin_w * scale)) for scale in scales]
+        canvas_h, canvas_w, offsets = utils.pack_pyramid(sizes)
+
+        #-----------------------------------------------#
+        #   先在uint8上缩放，再在画布上统一归一化
+        #   避免对原图做全分辨率的float64运算
+        #-----------------------------------------------#
+        canvas = np.zeros((1, canvas_h, canvas_w, 3), dtype=np.float32)
+        for (hs, ws), (oy, ox) in zip(sizes, offsets):
+            canvas[0, oy:oy + hs, ox:ox + ws] = cv2.resize(img, (ws, hs))
+        canvas -= 127.5
+        canvas *= 1 / 127.5
+
+        cls_map, roi_map = self.Pnet.predict(canvas)
 
-        cls_prob, roi_prob = self.Rnet.predict(np.array(predict_24_batch))
-        #-------------------------------------#
-        #   解码的过程
-        #-------------------------------------#
-        rectangles = utils.filter_face_24net(cls_prob, roi_prob, rectangles, origin_w, origin_h, threshold[1])
-
-        if len(rectangles) == 0:
-            return rectangles
+        rectangles = []
+        for i, ((hs, ws), (oy, ox)) in enumerate(zip(sizes, offsets)):
+            #-------------------------------------#
+            #   Pnet输出的步长为2，
+            #   取出该层在输出特征图上对应的区域
+            #-------------------------------------#
+            out_h = (hs - 2) // 2 - 4
+            out_w = (ws - 2) // 2 - 4
+            if out_h <= 0 or out_w <= 0:
+                continue
+            y0, x0 = oy // 2, ox // 2
+            cls_prob = cls_map[0, y0:y0 + out_h, x0:x0 + out_w, 1]
+            roi = roi_map[0, y0:y0 + out_h, x0:x0 + out_w]
+            out_side = max(out_h, out_w)
+            rectangle = utils.detect_face_12net(cls_prob, roi, out_side, 1 / scales[i], origin_w, origin_h, threshold)
+            rectangles.append(rectangle)
+        return rectangles
 
-        #-----------------------------#
-        #   计算人脸框
-        #   onet部分
-        #-----------------------------#
-        predict_batch = []
+    def _crop_batch(self, src, rectangles, size):
+        """
+        按人脸框截取并缩放成 size x size 的批次
+        batched_pnet模式下 src 为uint8原图，缩放后再归一化为float32
+        """
+        batch = []
         for rectangle in rectangles:
             #------------------------------------------#
             #   利用获取到的粗略坐标，在原图上进行截取
             #------------------------------------------#
-            crop_img = copy_img[int(rectangle[1]):int(rectangle[3]), int(rectangle[0]):int(rectangle[2])]
+            crop_img = src[int(rectangle[1]):int(rectangle[3]), int(rectangle[0]):int(rectangle[2])]
             #-----------------------------------------------#
-            #   将截取到的图片进行resize，调整成48x48的大小
+            #   将截取到的图片进行resize，调整成size x size的大小
             #-----------------------------------------------#
-            scale_img = cv2.resize(crop_img, (48, 48))
-            predict_batch.append(scale_img)
-
-        cls_prob, roi_prob, pts_prob = self.Onet.predict(np.array(predict_batch))
-        
-        #-------------------------------------#
-        #   解码的过程
-        #-------------------------------------#
-        rectangles = utils.filter_face_48net(cls_prob, roi_prob, pts_prob, rectangles, origin_w, origin_h, threshold[2])
-
-        return rectangles
-
+            batch.append(cv2.resize(crop_img, (size, size)))
+
+        if not self.batched_pnet:
+            return np.array(batch)
+        batch = np.array(batch, dtype=np.float32)
+        batch -= 127.5
+        batch *= 1 / 127.5
+        return batch
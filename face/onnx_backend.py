@@ -0,0 +1,105 @@
+import logging
+import os
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#-------------------------------------------------------#
+#   onnxruntime 推理后端
+#   由 export_onnx.py 从 keras 模型导出, 提供与 keras 模型
+#   相同的 predict 接口, 可直接替换 mtcnn 的 Pnet/Rnet/Onet
+#   以及 facenet 模型 (也可以再套一层 BatchedModel)
+#-------------------------------------------------------#
+
+ONNX_FILES = {
+    'pnet': 'pnet.onnx',
+    'rnet': 'rnet.onnx',
+    'onet': 'onet.onnx',
+    'facenet': 'facenet.onnx',
+    'facenet_int8': 'facenet_int8.onnx',
+}
+
+# 所有存活的会话, fork 后在子进程中统一重建
+_models = weakref.WeakSet()
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+        return onnxruntime
+    except ImportError:
+        logger.error("❌ onnxruntime 未安装. Run: pip install onnxruntime")
+        raise
+
+
+def session_options(ort):
+    """
+    CPU 推理的会话配置: 开启全部图优化,
+    线程数可由 ORT_INTRA_OP_THREADS / ORT_INTER_OP_THREADS 指定 (见 wsgi.py)
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    intra = os.environ.get('ORT_INTRA_OP_THREADS')
+    inter = os.environ.get('ORT_INTER_OP_THREADS')
+    if intra:
+        options.intra_op_num_threads = int(intra)
+    if inter:
+        options.inter_op_num_threads = int(inter)
+    return options
+
+
+class OnnxModel:
+    """onnxruntime 会话的 keras 风格封装"""
+
+    def __init__(self, model_path, name=None):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"ONNX 模型不存在: {model_path}，请先运行 export_onnx.py")
+        self.model_path = model_path
+        self.name = name or os.path.splitext(os.path.basename(model_path))[0]
+        self._create_session()
+        _models.add(self)
+
+    def _create_session(self):
+        ort = _import_onnxruntime()
+        self.session = ort.InferenceSession(
+            self.model_path, sess_options=session_options(ort), providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def predict(self, inputs, batch_size=None, **kwargs):
+        """
+        与 keras 的 model.predict 相同: 单输出返回数组, 多输出返回列表
+        batch_size 不为空时按批次分段推理
+        """
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        if batch_size is None or len(inputs) <= batch_size:
+            outputs = self.session.run(self.output_names, {self.input_name: inputs})
+        else:
+            chunks = [
+                self.session.run(self.output_names, {self.input_name: inputs[i:i + batch_size]})
+                for i in range(0, len(inputs), batch_size)
+            ]
+            outputs = [np.concatenate(parts, axis=0) for parts in zip(*chunks)]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def model_path(model_dir, key):
+    return os.path.join(model_dir, ONNX_FILES[key])
+
+
+#-----------------------------------------------#
+#   onnxruntime 的线程池在 fork 后不可用,
+#   预加载后 fork 的子进程 (见 wsgi.py) 需重建会话;
+#   模块级只注册一次 (at-fork 回调无法注销)
+#-----------------------------------------------#
+def _models_after_fork():
+    for model in list(_models):
+        model._create_session()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_models_after_fork)
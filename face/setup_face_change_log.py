@@ -0,0 +1,141 @@
+"""
+人脸数据变更日志 (face_change_log) 安装工具
+在 user_face / users 表上创建触发器, 把每次变更记录到 face_change_log,
+各人脸识别节点按自增 id 轮询该表, 增量刷新内存中的人脸底库 (见 gallery_sync.py)。
+Java 后端直接写 user_face 的注册/删除也会被记录, 无需修改 Java 代码。
+
+用法:
+    python setup_face_change_log.py                  # 创建日志表和触发器
+    python setup_face_change_log.py --dry-run        # 只打印将执行的SQL
+    python setup_face_change_log.py --prune-days 7   # 删除7天前的变更记录
+    python setup_face_change_log.py --drop           # 删除触发器 (保留日志表)
+"""
+import argparse
+
+from database_config import db_manager
+
+TABLE = db_manager.CHANGE_LOG_TABLE
+
+CREATE_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {TABLE} (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    user_id BIGINT NULL,
+    face_id VARCHAR(64) NULL,
+    op VARCHAR(16) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    KEY idx_created_at (created_at)
+)
+"""
+
+#-----------------------------------------------#
+#   触发器: 名称 -> 定义
+#   user_face 的任何变更都记录; users 只在会影响
+#   底库或登录返回信息的字段变化, 且该用户录入过人脸时记录
+#-----------------------------------------------#
+TRIGGERS = {
+    'trg_face_change_insert': f"""
+CREATE TRIGGER trg_face_change_insert AFTER INSERT ON user_face FOR EACH ROW
+    INSERT INTO {TABLE} (user_id, face_id, op) VALUES (NEW.user_id, NEW.face_id, 'insert')
+""",
+    'trg_face_change_update': f"""
+CREATE TRIGGER trg_face_change_update AFTER UPDATE ON user_face FOR EACH ROW
+BEGIN
+    INSERT INTO {TABLE} (user_id, face_id, op) VALUES (NEW.user_id, NEW.face_id, 'update');
+    IF NOT (OLD.user_id <=> NEW.user_id AND OLD.face_id <=> NEW.face_id) THEN
+        INSERT INTO {TABLE} (user_id, face_id, op) VALUES (OLD.user_id, OLD.face_id, 'update');
+    END IF;
+END
+""",
+    'trg_face_change_delete': f"""
+CREATE TRIGGER trg_face_change_delete AFTER DELETE ON user_face FOR EACH ROW
+    INSERT INTO {TABLE} (user_id, face_id, op) VALUES (OLD.user_id, OLD.face_id, 'delete')
+""",
+    'trg_face_change_user': f"""
+CREATE TRIGGER trg_face_change_user AFTER UPDATE ON users FOR EACH ROW
+BEGIN
+    IF NOT (OLD.status <=> NEW.status AND OLD.username <=> NEW.username
+            AND OLD.phone <=> NEW.phone AND OLD.nickname <=> NEW.nickname
+            AND OLD.avatar <=> NEW.avatar AND OLD.role <=> NEW.role
+            AND OLD.balance <=> NEW.balance)
+       AND EXISTS (SELECT 1 FROM user_face WHERE user_id = NEW.id) THEN
+        INSERT INTO {TABLE} (user_id, face_id, op) VALUES (NEW.id, NULL, 'user');
+    END IF;
+END
+""",
+}
+
+
+def existing_triggers(cursor):
+    cursor.execute(
+        "SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s",
+        (db_manager.config.database,)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def install(dry_run=False):
+    """创建日志表和缺失的触发器 (已存在的触发器保持不变)"""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        installed = existing_triggers(cursor)
+        statements = [CREATE_TABLE] + [sql for name, sql in TRIGGERS.items() if name not in installed]
+        for sql in statements:
+            if dry_run:
+                print(sql.strip() + ';\n')
+            else:
+                cursor.execute(sql)
+    if not dry_run:
+        print(f"✅ 变更日志表 {TABLE} 已就绪, 新建触发器 {len(statements) - 1} 个")
+
+
+def drop(dry_run=False):
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        for name in TRIGGERS:
+            sql = f"DROP TRIGGER IF EXISTS {name}"
+            if dry_run:
+                print(sql + ';')
+            else:
+                cursor.execute(sql)
+    if not dry_run:
+        print(f"✅ 已删除触发器: {', '.join(TRIGGERS)}")
+
+
+def prune(days, dry_run=False):
+    """
+    删除 days 天前的变更记录
+    保留时间应远大于各节点的全量对账间隔, 被删除但尚未应用的变更由对账兜底
+    """
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        where = "created_at < NOW() - INTERVAL %s DAY"
+        if dry_run:
+            cursor.execute(f"SELECT COUNT(*) FROM {TABLE} WHERE {where}", (days,))
+            print(f"ℹ️  将删除 {cursor.fetchone()[0]} 条变更记录")
+            return
+        cursor.execute(f"DELETE FROM {TABLE} WHERE {where}", (days,))
+        print(f"✅ 已删除 {cursor.rowcount} 条 {days} 天前的变更记录")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="安装人脸数据变更日志 (触发器 + face_change_log 表)")
+    parser.add_argument('--dry-run', action='store_true', help="只打印SQL, 不写入数据库")
+    parser.add_argument('--prune-days', type=int, help="删除指定天数之前的变更记录")
+    parser.add_argument('--drop', action='store_true', help="删除触发器")
+    args = parser.parse_args()
+
+    if not db_manager.test_connection():
+        print("❌ 数据库连接失败，请检查配置")
+        return
+
+    if args.drop:
+        drop(args.dry_run)
+    elif args.prune_days is not None:
+        prune(args.prune_days, args.dry_run)
+    else:
+        install(args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
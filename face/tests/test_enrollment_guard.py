@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import enrollment_guard  # noqa: E402
+from face_gallery import FaceGallery  # noqa: E402
+
+
+def unit(vector):
+    return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+
+class FakeDatabase:
+    """只实现查重用到的 get_users_by_face_names: faceId -> 账号"""
+
+    def __init__(self, face_owners):
+        self.face_owners = face_owners
+
+    def get_users_by_face_names(self, names):
+        return {name: {'id': self.face_owners[name]} for name in names if name in self.face_owners}
+
+
+def make_gallery(rng):
+    """
+    与 Java 注册后的底库一致: 条目名为 faceId (UUID),
+    账号 7 已注册过一张人脸, 账号 8 的人脸与之无关
+    """
+    own_face = unit(rng.normal(size=128))
+    other_face = unit(rng.normal(size=128))
+    gallery = FaceGallery()
+    gallery.apply_changes([], [
+        {'username': 'uuid-old', 'id': 7, 'face_embedding': own_face},
+        {'username': 'uuid-other', 'id': 8, 'face_embedding': other_face},
+    ])
+    return gallery, own_face, other_face
+
+
+def test_resolve_owner_prefers_account_id_for_uuid_face_id():
+    db = FakeDatabase({'uuid-old': 7})
+    assert enrollment_guard.resolve_owner('7') == 7
+    assert enrollment_guard.resolve_owner('uuid-new', account_id='7', db_manager=db) == 7
+    assert enrollment_guard.resolve_owner('uuid-old', db_manager=db) == 7
+    assert enrollment_guard.resolve_owner('uuid-new', db_manager=db) is None
+
+
+def test_uuid_re_enrollment_of_own_face_is_not_a_conflict():
+    rng = np.random.default_rng(0)
+    gallery, own_face, _ = make_gallery(rng)
+    db = FakeDatabase({'uuid-old': 7, 'uuid-other': 8})
+    new_photo = unit(own_face + 0.02 * rng.normal(size=128))
+
+    # Java 每次注册都生成新的 faceId, 账号ID 在 account_id 中
+    owner = enrollment_guard.resolve_owner('uuid-new', account_id='7', db_manager=db)
+    conflicts = enrollment_guard.find_conflicts(gallery, [new_photo], [owner], db_manager=db)
+    assert conflicts == [[]]
+
+    # 不知道账号时, 本人已有的人脸会被当成其他账号的冲突 (调用方据此降级为 warn)
+    conflicts = enrollment_guard.find_conflicts(gallery, [new_photo], [None], db_manager=db)
+    assert [item['user_id'] for item in conflicts[0]] == [7]
+
+
+def test_uuid_enrollment_of_another_accounts_face_is_a_conflict():
+    rng = np.random.default_rng(1)
+    gallery, _, other_face = make_gallery(rng)
+    db = FakeDatabase({'uuid-old': 7, 'uuid-other': 8})
+    photo = unit(other_face + 0.02 * rng.normal(size=128))
+
+    owner = enrollment_guard.resolve_owner('uuid-new', account_id='7', db_manager=db)
+    conflicts = enrollment_guard.find_conflicts(gallery, [photo], [owner], db_manager=db)
+    assert [item['user_id'] for item in conflicts[0]] == [8]
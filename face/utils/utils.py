@@ -1,5 +1,6 @@
 import math
 import sys
+import time
 from operator import itemgetter
 
 import cv2
@@ -11,7 +12,7 @@ import numpy as np
 #   计算原始输入图像
 #   每一次缩放的比例
 #-----------------------------#
-def calculateScales(img):
+def calculateScales(img, min_face_size=None):
     pr_scale = 1.0
     h,w,_ = img.shape
     
@@ -40,8 +41,59 @@ def calculateScales(img):
         scales.append(pr_scale*pow(factor, factor_count))
         minl *= factor
         factor_count += 1
+
+    #------------------------------------------------#
+    #   缩放比例为s的层级检测的人脸约为 12/s 像素,
+    #   指定最小人脸尺寸时去掉只能检测更小人脸的精细层级
+    #------------------------------------------------#
+    if min_face_size:
+        pruned = [scale for scale in scales if scale * min_face_size <= 12]
+        scales = pruned or scales[-1:]
     return scales
 
+#-------------------------------------#
+#   按 面积 x 得分 保留前k个候选框
+#-------------------------------------#
+def top_k_rectangles(rectangles, k):
+    if len(rectangles) <= k:
+        return rectangles
+    area = (rectangles[:, 2] - rectangles[:, 0]) * (rectangles[:, 3] - rectangles[:, 1])
+    rank = area * rectangles[:, 4]
+    keep = np.argpartition(-rank, k - 1)[:k]
+    return rectangles[keep[np.argsort(-rank[keep])]]
+
+#-------------------------------------------------#
+#   将图像金字塔的各层拼接到同一张画布上
+#   sizes为各层的(h, w)，按从大到小排列
+#   返回画布的高宽以及每一层左上角的(y, x)
+#
+#   Pnet是全卷积网络，步长为2、感受野为12，
+#   只要每层的起点为偶数，该层有效区域内的输出
+#   与单独预测这一层的输出完全一致
+#-------------------------------------------------#
+def pack_pyramid(sizes, align=2):
+    def align_up(v):
+        return (v + align - 1) // align * align
+
+    if len(sizes) == 0:
+        return 0, 0, []
+    #--------------------------------------------#
+    #   画布宽度取最大两层的宽度之和，
+    #   之后按行(shelf)从左到右依次摆放
+    #--------------------------------------------#
+    canvas_w = sum(align_up(w) for _, w in sizes[:2])
+    offsets = []
+    x, y, shelf_h = 0, 0, 0
+    for h, w in sizes:
+        if x + w > canvas_w:
+            y += shelf_h
+            x, shelf_h = 0, 0
+        offsets.append((y, x))
+        x += align_up(w)
+        shelf_h = max(shelf_h, align_up(h))
+    canvas_h = y + shelf_h
+    return canvas_h, canvas_w, offsets
+
 #-----------------------------#
 #   将长方形调整为正方形
 #-----------------------------#
@@ -54,34 +106,71 @@ def rect2square(rectangles):
     rectangles[:,2:4] = rectangles[:,0:2] + np.repeat([l], 2, axis = 0).T 
     return rectangles
 
+#-------------------------------------#
+#   分块的非极大抑制，返回保留框的下标
+#   按得分从高到低每次取出一块：
+#   1. 块内用上三角重叠矩阵迭代求不动点，
+#      结果与逐个贪心抑制完全一致
+#   2. 用块内保留的框一次性抑制剩余的所有框
+#-------------------------------------#
+def nms_indices(boxes, scores, threshold, block_size=32):
+    x1 = np.ascontiguousarray(boxes[:, 0])
+    y1 = np.ascontiguousarray(boxes[:, 1])
+    x2 = np.ascontiguousarray(boxes[:, 2])
+    y2 = np.ascontiguousarray(boxes[:, 3])
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    def overlaps(a, b):
+        #-------------------------------------------------#
+        #   IoU > threshold  <=>  inter * (1 + threshold) > threshold * (area_a + area_b)
+        #   避免逐元素除法
+        #-------------------------------------------------#
+        w = np.maximum(0.0, np.minimum(x2[a][:, None], x2[b]) - np.maximum(x1[a][:, None], x1[b]) + 1)
+        h = np.maximum(0.0, np.minimum(y2[a][:, None], y2[b]) - np.maximum(y1[a][:, None], y1[b]) + 1)
+        return w * h * (1 + threshold) > threshold * (area[a][:, None] + area[b])
+
+    remaining = np.argsort(-scores, kind='stable')
+    kept = []
+    while len(remaining) > 0:
+        block, remaining = remaining[:block_size], remaining[block_size:]
+        suppress = np.triu(overlaps(block, block), 1)
+        keep = np.ones(len(block), dtype=bool)
+        while True:
+            new_keep = ~np.any(suppress & keep[:, None], axis=0)
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+        block = block[keep]
+        kept.append(block)
+
+        if len(remaining) > 0:
+            remaining = remaining[~np.any(overlaps(block, remaining), axis=0)]
+    return np.concatenate(kept)
+
 #-------------------------------------#
 #   非极大抑制
+#   rectangles: [num_box, 5+]，第5列为得分
+#   返回按得分从高到低排列的保留框
 #-------------------------------------#
-def NMS(rectangles,threshold):
-    if len(rectangles)==0:
-        return rectangles
-    boxes = np.array(rectangles)
-    x1 = boxes[:,0]
-    y1 = boxes[:,1]
-    x2 = boxes[:,2]
-    y2 = boxes[:,3]
-    s  = boxes[:,4]
-    area = np.multiply(x2-x1+1, y2-y1+1)
-    I = np.array(s.argsort())
-    pick = []
-    while len(I)>0:
-        xx1 = np.maximum(x1[I[-1]], x1[I[0:-1]]) #I[-1] have hightest prob score, I[0:-1]->others
-        yy1 = np.maximum(y1[I[-1]], y1[I[0:-1]])
-        xx2 = np.minimum(x2[I[-1]], x2[I[0:-1]])
-        yy2 = np.minimum(y2[I[-1]], y2[I[0:-1]])
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        o = inter / (area[I[-1]] + area[I[0:-1]] - inter)
-        pick.append(I[-1])
-        I = I[np.where(o<=threshold)[0]]
-    result_rectangle = boxes[pick].tolist()
-    return result_rectangle
+def NMS(rectangles, threshold):
+    boxes = np.asarray(rectangles)
+    if len(boxes) == 0:
+        return boxes
+    return boxes[nms_indices(boxes, boxes[:, 4], threshold)]
+
+#-------------------------------------#
+#   分组的非极大抑制
+#   每组(如图像金字塔的每一层)各自做NMS，
+#   通过给不同组的坐标加上互不重叠的偏移量，
+#   一次NMS即可完成所有组
+#-------------------------------------#
+def batched_NMS(rectangles, groups, threshold):
+    boxes = np.asarray(rectangles)
+    if len(boxes) == 0:
+        return boxes
+    offset = np.asarray(groups, dtype=boxes.dtype)[:, None] * (boxes[:, :4].max() + 2)
+    shifted = boxes[:, :4] + offset
+    return boxes[nms_indices(shifted, boxes[:, 4], threshold)]
 
 #-------------------------------------#
 #   对pnet处理后的结果进行处理
@@ -163,7 +252,7 @@ def filter_face_24net(cls_prob, roi, rectangles, width, height, threshold):
 
     rectangles[:, [1,3]] = np.clip(rectangles[:, [1,3]], 0, height)
     rectangles[:, [0,2]] = np.clip(rectangles[:, [0,2]], 0, width)
-    return np.array(NMS(rectangles, 0.7))
+    return NMS(rectangles, 0.7)
 
 #-------------------------------------#
 #   对onet处理后的结果进行处理
@@ -202,7 +291,7 @@ def filter_face_48net(cls_prob, roi, pts, rectangles, width, height, threshold):
 
     rectangles[:, [1,3]] = np.clip(rectangles[:, [1,3]], 0, height)
     rectangles[:, [0,2]] = np.clip(rectangles[:, [0,2]], 0, width)
-    return np.array(NMS(rectangles,0.3))
+    return NMS(rectangles, 0.3)
 
 #-------------------------------------#
 #   人脸对齐
@@ -225,22 +314,14 @@ def Alignment_1(img,landmark):
     RotationMatrix = cv2.getRotationMatrix2D(center, angle, 1)
     new_img = cv2.warpAffine(img,RotationMatrix,(img.shape[1],img.shape[0])) 
 
-    RotationMatrix = np.array(RotationMatrix)
-    new_landmark = []
-    for i in range(landmark.shape[0]):
-        pts = []    
-        pts.append(RotationMatrix[0,0]*landmark[i,0]+RotationMatrix[0,1]*landmark[i,1]+RotationMatrix[0,2])
-        pts.append(RotationMatrix[1,0]*landmark[i,0]+RotationMatrix[1,1]*landmark[i,1]+RotationMatrix[1,2])
-        new_landmark.append(pts)
-
-    new_landmark = np.array(new_landmark)
+    new_landmark = transform_points(RotationMatrix, landmark)
 
     return new_img, new_landmark
 
 def Alignment_2(img,std_landmark,landmark):
     def Transformation(std_landmark,landmark):
-        std_landmark = np.matrix(std_landmark).astype(np.float64)
-        landmark = np.matrix(landmark).astype(np.float64)
+        std_landmark = np.array(std_landmark, dtype=np.float64)
+        landmark = np.array(landmark, dtype=np.float64)
 
         c1 = np.mean(std_landmark, axis=0)
         c2 = np.mean(landmark, axis=0)
@@ -252,28 +333,94 @@ def Alignment_2(img,std_landmark,landmark):
         std_landmark /= s1
         landmark /= s2 
 
-        U, S, Vt = np.linalg.svd(std_landmark.T * landmark)
-        R = (U * Vt).T
+        U, S, Vt = np.linalg.svd(std_landmark.T @ landmark)
+        R = (U @ Vt).T
 
-        return np.vstack([np.hstack(((s2 / s1) * R, c2.T - (s2 / s1) * R * c1.T)),np.matrix([0., 0., 1.])])
+        return np.vstack([np.hstack(((s2 / s1) * R, (c2 - (s2 / s1) * R @ c1)[:, None])), [0., 0., 1.]])
 
     Trans_Matrix = Transformation(std_landmark,landmark) # Shape: 3 * 3
     Trans_Matrix = Trans_Matrix[:2]
     Trans_Matrix = cv2.invertAffineTransform(Trans_Matrix)
     new_img = cv2.warpAffine(img,Trans_Matrix,(img.shape[1],img.shape[0]))
 
-    Trans_Matrix = np.array(Trans_Matrix)
-    new_landmark = []
-    for i in range(landmark.shape[0]):
-        pts = []    
-        pts.append(Trans_Matrix[0,0]*landmark[i,0]+Trans_Matrix[0,1]*landmark[i,1]+Trans_Matrix[0,2])
-        pts.append(Trans_Matrix[1,0]*landmark[i,0]+Trans_Matrix[1,1]*landmark[i,1]+Trans_Matrix[1,2])
-        new_landmark.append(pts)
-
-    new_landmark = np.array(new_landmark)
+    new_landmark = transform_points(Trans_Matrix, landmark)
 
     return new_img, new_landmark
 
+#-------------------------------------#
+#   用 2x3 仿射矩阵变换关键点
+#   matrix 为 [2, 3] 或 [K, 2, 3]
+#   points 为 [N, 2] 或 [K, N, 2]
+#-------------------------------------#
+def transform_points(matrix, points):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    return points @ np.swapaxes(matrix[..., :2], -1, -2) + matrix[..., None, :, 2]
+
+#-------------------------------------------------------#
+#   批量人脸对齐
+#   与 "裁剪 -> Alignment_1 旋转 -> resize" 等价的变换合成为
+#   一个仿射矩阵, 每张人脸只需从原图做一次 warpAffine
+#   boxes:     [K, 4] 裁剪框 x1, y1, x2, y2 (已限制在图片内)
+#   landmarks: [K, 5, 2] 原图坐标系下的五个关键点
+#   返回 [K, 2, 3] 的仿射矩阵 (原图 -> size x size)
+#   对齐结果与逐张裁剪旋转的旧实现有差异 (插值位置不同,
+#   旋转后的四角不再填黑), 特征缓存以 ALIGNMENT_VERSION 区分
+#-------------------------------------------------------#
+ALIGNMENT_VERSION = 2
+
+def alignment_transforms(boxes, landmarks, size=160):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    x1, y1, x2, y2 = boxes.T
+    w = x2 - x1
+    h = y2 - y1
+
+    #---------------------------------#
+    #   两眼连线的倾角 (同 Alignment_1)
+    #---------------------------------#
+    dx = landmarks[:, 0, 0] - landmarks[:, 1, 0]
+    dy = landmarks[:, 0, 1] - landmarks[:, 1, 1]
+    angle = np.where(dx == 0, 0.0, np.arctan(dy / np.where(dx == 0, 1.0, dx)))
+    alpha = np.cos(angle)
+    beta = np.sin(angle)
+
+    #---------------------------------#
+    #   绕裁剪图中心旋转, 再平移回原图坐标
+    #---------------------------------#
+    cx = w // 2
+    cy = h // 2
+    tx = (1 - alpha) * cx - beta * cy - alpha * x1 - beta * y1
+    ty = beta * cx + (1 - alpha) * cy + beta * x1 - alpha * y1
+
+    #---------------------------------#
+    #   缩放到 size x size (与 cv2.resize 的像素中心对齐方式一致)
+    #---------------------------------#
+    sx = size / w
+    sy = size / h
+    matrix = np.empty((len(boxes), 2, 3))
+    matrix[:, 0, 0] = sx * alpha
+    matrix[:, 0, 1] = sx * beta
+    matrix[:, 0, 2] = sx * (tx + 0.5) - 0.5
+    matrix[:, 1, 0] = -sy * beta
+    matrix[:, 1, 1] = sy * alpha
+    matrix[:, 1, 2] = sy * (ty + 0.5) - 0.5
+    return matrix
+
+def align_faces(img, boxes, landmarks, size=160):
+    """
+    批量对齐人脸
+    Returns:
+        faces:     [K, size, size, 3]
+        landmarks: [K, 5, 2] 对齐后图像中的关键点
+    """
+    matrix = alignment_transforms(boxes, landmarks, size)
+    faces = np.empty((len(matrix), size, size, img.shape[2]), dtype=img.dtype)
+    for i in range(len(matrix)):
+        cv2.warpAffine(img, matrix[i], (size, size), dst=faces[i], flags=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return faces, transform_points(matrix, landmarks)
+
 #---------------------------------#
 #   图片预处理
 #   高斯归一化
@@ -301,6 +448,17 @@ def l2_normalize(x, axis=-1, epsilon=1e-10):
     output = x / np.sqrt(np.maximum(np.sum(np.square(x), axis=axis, keepdims=True), epsilon))
     return output
     
+#---------------------------------#
+#   记录阶段耗时
+#   timings 为 None 时不记录
+#---------------------------------#
+def record_stage(timings, stage, start):
+    """把 start 至今的秒数累加到 timings[stage], 返回当前时间 (作为下一阶段的起点)"""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
 #---------------------------------#
 #   计算128特征值
 #---------------------------------#
@@ -311,6 +469,18 @@ def calc_128_vec(model,img):
     pre = np.reshape(pre,[128])
     return pre
 
+#---------------------------------#
+#   批量计算128特征值
+#   imgs: [K, 160, 160, 3]
+#   一次前向传播，batch_size为单批最大数量
+#---------------------------------#
+def calc_128_vec_batch(model, imgs, batch_size=32):
+    if len(imgs) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+    face_imgs = pre_process(np.asarray(imgs, dtype=np.float32))
+    pre = model.predict(face_imgs, batch_size=batch_size)
+    return l2_normalize(pre)
+
 #---------------------------------#
 #   计算人脸距离
 #---------------------------------#
@@ -326,3 +496,27 @@ def compare_faces(known_face_encodings, face_encoding_to_check, tolerance=0.6):
     dis = face_distance(known_face_encodings, face_encoding_to_check) 
     return list(dis <= tolerance)
 
+#---------------------------------#
+#   批量查询最近的 k 个人脸
+#   整批查询一次矩阵乘法 + argpartition
+#   返回 (距离, 下标) 均为 [查询数, k], 不足 k 个时下标为 -1, 距离为 inf
+#---------------------------------#
+def face_top_k(face_encodings, queries, k):
+    queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    if len(face_encodings) == 0 or k <= 0:
+        return distances, indices
+    face_encodings = np.asarray(face_encodings, dtype=np.float32)
+    sq_dist = (np.einsum('ij,ij->i', face_encodings, face_encodings)[None, :]
+               + np.einsum('ij,ij->i', queries, queries)[:, None]
+               - 2.0 * (queries @ face_encodings.T))
+    np.maximum(sq_dist, 0.0, out=sq_dist)
+    kk = min(k, len(face_encodings))
+    top = np.argpartition(sq_dist, kk - 1, axis=1)[:, :kk]
+    top_dist = np.take_along_axis(sq_dist, top, axis=1)
+    order = np.argsort(top_dist, axis=1)
+    indices[:, :kk] = np.take_along_axis(top, order, axis=1)
+    distances[:, :kk] = np.sqrt(np.take_along_axis(top_dist, order, axis=1))
+    return distances, indices
+
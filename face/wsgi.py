@@ -0,0 +1,75 @@
+"""
+人脸识别API的生产环境入口 (预加载 + 多进程)
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+主进程导入本模块时加载人脸底库, 之后 fork 出各个工作进程, 底库所在的内存页
+由所有子进程以写时复制的方式共享。模型的加载取决于推理后端:
+    onnx   主进程加载 onnxruntime 会话, 子进程共享权重内存 (会话的线程池在 fork 后重建)
+    keras  tensorflow 的运行时 (线程池/设备上下文) 不能安全地 fork,
+           主进程不导入 tensorflow, 每个子进程 fork 后各自加载模型
+每个子进程 fork 后各自预热模型, 预热完成后才开始接收请求。
+
+环境变量:
+    FACE_WORKERS          工作进程数, 默认为CPU核数
+    TF_INTRA_OP_THREADS   每个进程内单个算子的线程数, 默认为 CPU核数 / 工作进程数
+    TF_INTER_OP_THREADS   每个进程内算子间并行的线程数, 默认为1
+    FACE_BACKEND          推理后端 keras / onnx, onnx 后端使用 ORT_INTRA_OP_THREADS / ORT_INTER_OP_THREADS
+    FACE_SYNC_INTERVAL    底库增量同步的轮询间隔(秒), 同步线程在每个子进程 fork 之后启动
+"""
+import os
+
+
+def worker_count():
+    return int(os.environ.get('FACE_WORKERS', os.cpu_count() or 1))
+
+
+# 只有 onnx 后端在主进程中加载模型
+PRELOAD_MODELS = os.environ.get('FACE_BACKEND', 'keras') == 'onnx'
+
+
+def configure_inference_threads():
+    """
+    固定每个进程的推理线程数, 避免 N 个进程各自占满所有核心
+    必须在创建任何模型之前调用 (keras 后端在子进程中调用)
+    """
+    cpus = os.cpu_count() or 1
+    default_intra = max(1, cpus // worker_count())
+
+    if os.environ.get('FACE_BACKEND', 'keras') == 'onnx':
+        # onnxruntime 在创建会话时读取 (见 onnx_backend.session_options)
+        os.environ.setdefault('ORT_INTRA_OP_THREADS', str(default_intra))
+        os.environ.setdefault('ORT_INTER_OP_THREADS', '1')
+        print(f"🧵 onnxruntime 线程数: intra_op={os.environ['ORT_INTRA_OP_THREADS']}, "
+              f"inter_op={os.environ['ORT_INTER_OP_THREADS']}")
+        return
+
+    intra = int(os.environ.get('TF_INTRA_OP_THREADS', default_intra))
+    inter = int(os.environ.get('TF_INTER_OP_THREADS', 1))
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+    print(f"🧵 tensorflow 线程数: intra_op={intra}, inter_op={inter}")
+
+
+if PRELOAD_MODELS:
+    configure_inference_threads()
+else:
+    os.environ['FACE_DEFER_MODELS'] = '1'
+
+from api_server_db import app, db_manager, warm_up as _warm_up  # noqa: E402
+
+
+def warm_up():
+    """子进程 fork 之后调用: 设置推理线程数 (keras 后端), 加载并预热模型"""
+    if not PRELOAD_MODELS:
+        configure_inference_threads()
+    _warm_up()
+
+
+#-----------------------------------------------#
+#   主进程加载底库时借出过数据库连接,
+#   fork 之前全部关闭, 子进程各自建立连接
+#-----------------------------------------------#
+db_manager.pool.close_all()
@@ -75,7 +75,7 @@ public class UserFaceServiceImpl implements UserFaceService {
         boolean pythonRegistered = false;
         try {
             // 2. 调用 Python 端进行特征提取
-            Map<String, Object> pythonResult = pythonFaceClient.register(imageBase64, faceId);
+            Map<String, Object> pythonResult = pythonFaceClient.register(imageBase64, faceId, userId);
             Boolean pythonSuccess = (Boolean) pythonResult.get("success");
             
             if (pythonSuccess == null || !pythonSuccess) {
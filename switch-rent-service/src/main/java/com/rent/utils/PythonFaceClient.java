@@ -49,12 +49,14 @@ public class PythonFaceClient {
      *
      * @param imageBase64 用户图像的Base64编码字符串
      * @param userId 用户唯一标识符
+     * @param accountId 数字账号ID, Python 端查重时据此排除该账号已有的人脸
      * @return 包含注册结果的Map，成功时返回Python服务的响应，失败时返回错误信息
      */
-    public Map<String, Object> register(String imageBase64, String userId) {
+    public Map<String, Object> register(String imageBase64, String userId, String accountId) {
         Map<String, String> request = new HashMap<>();
         request.put("image", imageBase64); 
         request.put("user_id", userId);     
+        request.put("account_id", accountId);
 
         try {
             // 使用 WebClient 发送异步 POST 请求到Python服务的注册接口